@@ -1,4 +1,40 @@
 __author__ = 'Yelysei Bondarenko'
 __email__ = 'yell.bondarenko@gmail.com'
-from dbm import *
-from ebm import *
+
+import sys
+import importlib
+from types import ModuleType
+
+
+# public names of the package, by submodule they are defined in;
+# submodules are imported on first access to any of their names, so that
+# TF-free ones (`np_inference`) can be used w/o importing TensorFlow
+_exports = {
+    'dbm': ('DBM',),
+    'ebm': ('EnergyBasedModel', 'ais_summary'),
+    'np_inference': ('NumpyLayer', 'NumpyRBM', 'NumpyDBM'),
+    'parallel': ('fit_parallel', 'imap_parallel'),
+}
+__all__ = sorted(name for names in _exports.values() for name in names)
+
+
+class _LazyPackage(ModuleType):
+    def __getattr__(self, name):
+        for submodule, names in _exports.items():
+            if name in names:
+                module = importlib.import_module('{0}.{1}'.format(__name__, submodule))
+                value = getattr(module, name)
+                setattr(self, name, value)
+                return value
+        raise AttributeError("module '{0}' has no attribute '{1}'".format(__name__, name))
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(__all__))
+
+
+# replace this module (keeping its attributes, e.g. `__path__`, and reference
+# to it, as its globals are cleared once it is garbage collected)
+_package = _LazyPackage(__name__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -3,7 +3,6 @@ from copy import deepcopy
 
 from base import is_param_name, is_attribute_name
 from mixin import SeedMixin
-from boltzmann_machines.utils import write_during_training
 
 
 class BaseModel(SeedMixin):
@@ -50,17 +49,9 @@ class BaseModel(SeedMixin):
         return self
 
     def _serialize(self, params):
-        """Class-specific parameters serialization routine."""
-        for k, v in params.items():
-            if isinstance(v, np.ndarray):
-                if v.size > 1e6:
-                    msg = "WARNING: parameter `{0}` won't be serialized because it is too large:"
-                    msg += ' ({1:.2f} > 1 Mio elements)'
-                    msg = msg.format(k, 1e-6 * v.size)
-                    write_during_training(msg)
-                    params[k] = None
-                else:
-                    params[k] = v.tolist()
+        """Class-specific parameters serialization routine.
+        Array-valued parameters can be left as is, they are
+        stored separately from the rest (see `TensorFlowModel`)."""
         return params
 
     def _deserialize(self, params):
@@ -0,0 +1,143 @@
+import os
+import threading
+import Queue
+import tensorflow as tf
+
+
+class CheckpointWriter(object):
+    """
+    Background thread writing TF checkpoints from snapshots of variables
+    held in host memory, so that training can continue while they are
+    serialized and written to disk.
+
+    Checkpoints are written (in the order of submission) by a separate
+    `tf.train.Saver` built in a private graph, with variables of the same
+    names as in the model graph, so they can be restored by the model's
+    Saver as usual. This Saver also keeps only the newest `max_to_keep`
+    of them (see `saver_params`).
+
+    Parameters
+    ----------
+    meta_graph_def : tf.MetaGraphDef
+        Meta graph of the model, written next to each checkpoint.
+    saver_params : dict
+        Parameters of `tf.train.Saver` (except `var_list`).
+    max_pending : positive int
+        Maximum number of snapshots in flight. Once reached, `submit`
+        blocks until the oldest of them is written.
+    last_checkpoints : list of (str, float)
+        Checkpoints (with timestamps) already kept by the model's Saver,
+        that count towards `max_to_keep`.
+    """
+    def __init__(self, meta_graph_def, saver_params=None, max_pending=1,
+                 last_checkpoints=None):
+        self.meta_graph_def = meta_graph_def
+        self.saver_params = dict(saver_params or {})
+        self.saver_params.pop('var_list', None)
+        self.max_pending = max_pending
+        self._last_checkpoints = list(last_checkpoints or [])
+
+        self._slots = threading.Semaphore(self.max_pending)
+        self._queue = Queue.Queue()
+        self._error = None
+        self._graph = None
+        self._session = None
+        self._saver = None
+        self._init_ops = None
+        self._placeholders = None
+
+        self._thread = threading.Thread(target=self._run, name='checkpoint_writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def last_checkpoints(self):
+        """Checkpoints kept so far with their timestamps."""
+        self.wait()
+        if self._saver is None:
+            return list(self._last_checkpoints)
+        return list(self._saver._last_checkpoints)
+
+    def _build(self, values):
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._placeholders = {}
+            var_list = []
+            for name, value in sorted(values.items()):
+                t = tf.placeholder(tf.as_dtype(value.dtype), value.shape)
+                var_list.append(tf.Variable(t, name=name))
+                self._placeholders[name] = t
+            self._init_ops = [v.initializer for v in var_list]
+            self._saver = tf.train.Saver(var_list=var_list, **self.saver_params)
+            self._saver.set_last_checkpoints_with_time(self._last_checkpoints)
+        self._session = tf.Session(graph=self._graph)
+
+    def _write(self, values, save_path, global_step, callback):
+        if self._graph is None:
+            self._build(values)
+        feed_dict = {self._placeholders[name]: value for name, value in values.items()}
+        self._session.run(self._init_ops, feed_dict=feed_dict)
+        checkpoint_path = self._saver.save(self._session, save_path,
+                                           global_step=global_step,
+                                           write_meta_graph=False)
+        meta_filepath = checkpoint_path + '.meta'
+        with open(meta_filepath + '.tmp', 'wb') as f:
+            f.write(self.meta_graph_def.SerializeToString())
+        os.rename(meta_filepath + '.tmp', meta_filepath)
+        if callback is not None:
+            callback()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    self._write(*job)
+            except Exception as e:
+                self._error = e
+            finally:
+                if job is not None:
+                    self._slots.release()
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
+
+    def submit(self, snapshot, save_path, global_step=None, callback=None):
+        """Write checkpoint of variables to `save_path` in background.
+
+        Parameters
+        ----------
+        snapshot : callable
+            Returns dict of variables' values (np.ndarray) by their names.
+            It is called once there is a free slot for a new snapshot.
+        callback : None or callable
+            Called (in the writer thread) after the checkpoint is written,
+            e.g. to write the rest of model files.
+        """
+        self._raise_error()
+        self._slots.acquire()
+        try:
+            values = snapshot()
+        except:
+            self._slots.release()
+            raise
+        self._queue.put((values, save_path, global_step, callback))
+
+    def wait(self):
+        """Block until all submitted checkpoints are written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Write remaining checkpoints and stop the thread."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        self._raise_error()
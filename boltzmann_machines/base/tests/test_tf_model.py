@@ -1,3 +1,4 @@
+import tensorflow as tf
 from nose.tools import eq_
 
 from boltzmann_machines.base import TensorFlowModel as TFM
@@ -12,7 +13,8 @@ class TestWorkingPaths(object):
         eq_(tf_model._model_dirpath, './')
         eq_(tf_model._model_filepath, './model')
         eq_(tf_model._params_filepath, './params.json')
-        eq_(tf_model._random_state_filepath, './random_state.json')
+        eq_(tf_model._params_arrays_dirpath, './params_arrays/')
+        eq_(tf_model._random_state_filepath, './random_state.npz')
         eq_(tf_model._train_summary_dirpath, './logs/train')
         eq_(tf_model._val_summary_dirpath, './logs/val')
         eq_(tf_model._tf_meta_graph_filepath, './model.meta')
@@ -21,7 +23,8 @@ class TestWorkingPaths(object):
         eq_(tf_model._model_dirpath, './')
         eq_(tf_model._model_filepath, './model-1')
         eq_(tf_model._params_filepath, './params.json')
-        eq_(tf_model._random_state_filepath, './random_state.json')
+        eq_(tf_model._params_arrays_dirpath, './params_arrays/')
+        eq_(tf_model._random_state_filepath, './random_state.npz')
         eq_(tf_model._train_summary_dirpath, './logs/train')
         eq_(tf_model._val_summary_dirpath, './logs/val')
         eq_(tf_model._tf_meta_graph_filepath, './model-1.meta')
@@ -31,7 +34,8 @@ class TestWorkingPaths(object):
         eq_(tf_model._model_dirpath, 'a/')
         eq_(tf_model._model_filepath, 'a/model')
         eq_(tf_model._params_filepath, 'a/params.json')
-        eq_(tf_model._random_state_filepath, 'a/random_state.json')
+        eq_(tf_model._params_arrays_dirpath, 'a/params_arrays/')
+        eq_(tf_model._random_state_filepath, 'a/random_state.npz')
         eq_(tf_model._train_summary_dirpath, 'a/logs/train')
         eq_(tf_model._val_summary_dirpath, 'a/logs/val')
         eq_(tf_model._tf_meta_graph_filepath, 'a/model.meta')
@@ -40,7 +44,8 @@ class TestWorkingPaths(object):
         eq_(tf_model._model_dirpath, './')
         eq_(tf_model._model_filepath, './model')
         eq_(tf_model._params_filepath, './params.json')
-        eq_(tf_model._random_state_filepath, './random_state.json')
+        eq_(tf_model._params_arrays_dirpath, './params_arrays/')
+        eq_(tf_model._random_state_filepath, './random_state.npz')
         eq_(tf_model._train_summary_dirpath, './logs/train')
         eq_(tf_model._val_summary_dirpath, './logs/val')
         eq_(tf_model._tf_meta_graph_filepath, './model.meta')
@@ -49,7 +54,8 @@ class TestWorkingPaths(object):
         eq_(tf_model._model_dirpath, 'b/a/')
         eq_(tf_model._model_filepath, 'b/a/model')
         eq_(tf_model._params_filepath, 'b/a/params.json')
-        eq_(tf_model._random_state_filepath, 'b/a/random_state.json')
+        eq_(tf_model._params_arrays_dirpath, 'b/a/params_arrays/')
+        eq_(tf_model._random_state_filepath, 'b/a/random_state.npz')
         eq_(tf_model._train_summary_dirpath, 'b/a/logs/train')
         eq_(tf_model._val_summary_dirpath, 'b/a/logs/val')
         eq_(tf_model._tf_meta_graph_filepath, 'b/a/model.meta')
@@ -59,7 +65,8 @@ class TestWorkingPaths(object):
         eq_(tf_model._model_dirpath, './')
         eq_(tf_model._model_filepath, './model')
         eq_(tf_model._params_filepath, './params.json')
-        eq_(tf_model._random_state_filepath, './random_state.json')
+        eq_(tf_model._params_arrays_dirpath, './params_arrays/')
+        eq_(tf_model._random_state_filepath, './random_state.npz')
         eq_(tf_model._train_summary_dirpath, './logs/train')
         eq_(tf_model._val_summary_dirpath, './logs/val')
         eq_(tf_model._tf_meta_graph_filepath, './model.meta')
@@ -69,7 +76,8 @@ class TestWorkingPaths(object):
         eq_(tf_model._model_dirpath, 'a/')
         eq_(tf_model._model_filepath, 'a/b')
         eq_(tf_model._params_filepath, 'a/params.json')
-        eq_(tf_model._random_state_filepath, 'a/random_state.json')
+        eq_(tf_model._params_arrays_dirpath, 'a/params_arrays/')
+        eq_(tf_model._random_state_filepath, 'a/random_state.npz')
         eq_(tf_model._train_summary_dirpath, 'a/logs/train')
         eq_(tf_model._val_summary_dirpath, 'a/logs/val')
         eq_(tf_model._tf_meta_graph_filepath, 'a/b.meta')
@@ -78,7 +86,8 @@ class TestWorkingPaths(object):
         eq_(tf_model._model_dirpath, './')
         eq_(tf_model._model_filepath, './b')
         eq_(tf_model._params_filepath, './params.json')
-        eq_(tf_model._random_state_filepath, './random_state.json')
+        eq_(tf_model._params_arrays_dirpath, './params_arrays/')
+        eq_(tf_model._random_state_filepath, './random_state.npz')
         eq_(tf_model._train_summary_dirpath, './logs/train')
         eq_(tf_model._val_summary_dirpath, './logs/val')
         eq_(tf_model._tf_meta_graph_filepath, './b.meta')
@@ -87,7 +96,26 @@ class TestWorkingPaths(object):
         eq_(tf_model._model_dirpath, 'a/b/')
         eq_(tf_model._model_filepath, 'a/b/c')
         eq_(tf_model._params_filepath, 'a/b/params.json')
-        eq_(tf_model._random_state_filepath, 'a/b/random_state.json')
+        eq_(tf_model._params_arrays_dirpath, 'a/b/params_arrays/')
+        eq_(tf_model._random_state_filepath, 'a/b/random_state.npz')
         eq_(tf_model._train_summary_dirpath, 'a/b/logs/train')
         eq_(tf_model._val_summary_dirpath, 'a/b/logs/val')
         eq_(tf_model._tf_meta_graph_filepath, 'a/b/c.meta')
+
+
+class TestMetricsAccumulator(object):
+    def test_missing_accumulator(self):
+        # graphs restored from older checkpoints have no accumulators,
+        # so they are made on demand
+        with tf.Graph().as_default():
+            x = tf.placeholder(tf.float32, shape=[])
+            metrics = dict(a=x, b=2. * x)
+            tf_model = TFM()
+            update, reset, averages = tf_model._get_metrics_accumulator('metrics', metrics)
+            assert tf.get_collection('metrics_update') == [update]
+            with tf.Session() as tf_model._tf_session:
+                tf_model._tf_session.run(reset)
+                eq_(tf_model._fetch_metrics(averages), dict(a=None, b=None))
+                for value in (1., 2., 6.):
+                    tf_model._tf_session.run(update, feed_dict={x: value})
+                eq_(tf_model._fetch_metrics(averages), dict(a=3., b=6.))
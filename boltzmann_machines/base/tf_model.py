@@ -1,40 +1,59 @@
 import os
+import glob
 import json
+import hashlib
+import numpy as np
 import tensorflow as tf
-from functools import wraps
+from contextlib import contextmanager
+from functools import wraps, partial
 
 from boltzmann_machines.base import (BaseModel, DtypeMixin,
                                      is_param_name)
+from boltzmann_machines.utils import RNG, progress_bar
+from checkpoint_writer import CheckpointWriter
 
 
-def run_in_tf_session(check_initialized=True, update_seed=False):
+def _is_loaded_from(X, filepath):
+    """Check whether array `X` is memory-mapped .npy file `filepath` as a whole."""
+    m = X
+    while isinstance(m, np.ndarray) and not isinstance(m, np.memmap):
+        m = m.base
+    if not isinstance(m, np.memmap) or not m.filename or not os.path.isfile(filepath):
+        return False
+    return os.path.realpath(m.filename) == os.path.realpath(filepath) and \
+           m.shape == X.shape and m.dtype == X.dtype and m.ctypes.data == X.ctypes.data
+
+def run_in_tf_session(check_initialized=True, update_seed=False, invalidate_session=False):
     """Decorator function that takes care to load appropriate graph/session,
     depending on whether model can be loaded from disk or is just created,
     and to execute `f` inside this session.
+
+    If the model keeps its session alive (see `TensorFlowModel.open_session`),
+    `f` is executed in the already loaded graph/session, unless
+    `invalidate_session` is True, in which case they are rebuilt first.
     """
     def wrap(f):
         @wraps(f)  # preserve bound method properties
         def wrapped_f(model, *args, **kwargs):
-            tf.reset_default_graph()
-            model._tf_graph = tf.get_default_graph()
-            if update_seed:
-                tf.set_random_seed(model.make_random_seed())
-            if model.initialized_:  # model should be loaded from disk
-                model._tf_saver = tf.train.import_meta_graph(model._tf_meta_graph_filepath)
+            if invalidate_session:
+                model._close_tf_session()
+            if model._tf_session is not None:  # reuse warm session
                 with model._tf_graph.as_default():
-                    with tf.Session(config=model._tf_session_config) as model._tf_session:
-                        model._tf_saver.restore(model._tf_session, model._model_filepath)
-                        model._init_tf_writers()
-                        res = f(model, *args, **kwargs)
-            elif check_initialized:
+                    with model._tf_session.as_default():
+                        return f(model, *args, **kwargs)
+
+            if check_initialized and not model.initialized_:
                 raise RuntimeError('`fit` or `init` must be called before calling `{0}`'.format(f.__name__))
-            else:
+            model._load_tf_graph(update_seed=update_seed)
+            try:
                 with model._tf_graph.as_default():
-                    with tf.Session(config=model._tf_session_config) as model._tf_session:
-                        model._make_tf_model()
-                        model._init_tf_ops()
-                        model._init_tf_writers()
+                    with model._tf_session.as_default():
                         res = f(model, *args, **kwargs)
+            except:
+                model._close_tf_session()
+                raise
+            if not model._keep_tf_session:
+                model._close_tf_session()
             return res
         return wrapped_f
     return wrap
@@ -43,11 +62,12 @@ def run_in_tf_session(check_initialized=True, update_seed=False):
 class TensorFlowModel(BaseModel, DtypeMixin):
     def __init__(self, model_path='tf_model/', paths=None,
                  tf_session_config=None, tf_saver_params=None, json_params=None,
-                 *args, **kwargs):
+                 max_pending_saves=1, *args, **kwargs):
         super(TensorFlowModel, self).__init__(*args, **kwargs)
         self._model_dirpath = None
         self._model_filepath = None
         self._params_filepath = None
+        self._params_arrays_dirpath = None
         self._random_state_filepath = None
         self._train_summary_dirpath = None
         self._val_summary_dirpath = None
@@ -56,17 +76,23 @@ class TensorFlowModel(BaseModel, DtypeMixin):
 
         self._tf_session_config = tf_session_config or tf.ConfigProto()
         self.tf_saver_params = tf_saver_params or {}
+        self.max_pending_saves = max_pending_saves
         self.json_params = json_params or {}
         self.json_params.setdefault('sort_keys', True)
         self.json_params.setdefault('indent', 4)
         self.initialized_ = False
+        self._transform_cache = None
+        self._checkpoint_fingerprint_memo = None
+        self._checkpoint_writer = None
 
         self._tf_graph = tf.Graph()
         self._tf_session = None
+        self._keep_tf_session = False
         self._tf_saver = None
         self._tf_merged_summaries = None
         self._tf_train_writer = None
         self._tf_val_writer = None
+        self._input_staged = False
 
     @staticmethod
     def compute_working_paths(model_path):
@@ -85,7 +111,8 @@ class TensorFlowModel(BaseModel, DtypeMixin):
         paths['model_dirpath'] = head
         paths['model_filepath'] = os.path.join(paths['model_dirpath'], tail)
         paths['params_filepath'] = os.path.join(paths['model_dirpath'], 'params.json')
-        paths['random_state_filepath'] = os.path.join(paths['model_dirpath'], 'random_state.json')
+        paths['params_arrays_dirpath'] = os.path.join(paths['model_dirpath'], 'params_arrays/')
+        paths['random_state_filepath'] = os.path.join(paths['model_dirpath'], 'random_state.npz')
         paths['train_summary_dirpath'] = os.path.join(paths['model_dirpath'], 'logs/train')
         paths['val_summary_dirpath'] = os.path.join(paths['model_dirpath'], 'logs/val')
         paths['tf_meta_graph_filepath'] = paths['model_filepath'] + '.meta'
@@ -98,9 +125,232 @@ class TensorFlowModel(BaseModel, DtypeMixin):
         for k, v in paths.items():
             setattr(self, '_{0}'.format(k), v)
 
+    def open_session(self):
+        """Keep TF graph and session alive across subsequent calls
+        (`transform`, `get_tf_params` etc.) instead of rebuilding
+        them and restoring the model from disk on every call.
+
+        The session is rebuilt whenever the parameters change
+        (`fit`, `init` or `set_params`) and is released by `close_session`,
+        or automatically when the model is used as a context manager
+        (`with model: ...`). Note that random ops are not re-seeded between calls
+        that reuse the session.
+        """
+        self._keep_tf_session = True
+        return self
+
+    def load_graph(self):
+        """Open session (see `open_session`) and load TF graph and
+        the model into it right away, instead of on the first call
+        that needs them, e.g. to access graph collections or to run
+        its ops directly via `_tf_session`.
+        """
+        if not self.initialized_:
+            raise RuntimeError('`fit` or `init` must be called before calling `load_graph`')
+        self.open_session()
+        if self._tf_session is None:
+            self._load_tf_graph()
+        return self
+
+    def close_session(self):
+        """Release TF graph and session kept alive by `open_session`."""
+        self._keep_tf_session = False
+        self._close_tf_session()
+        return self
+
+    @contextmanager
+    def _kept_session(self):
+        """Keep TF session alive (see `open_session`) within the block,
+        e.g. across the steps of a generator, and release it afterwards,
+        unless it had already been kept alive before."""
+        keep_session = self._keep_tf_session
+        self.open_session()
+        try:
+            yield
+        finally:
+            if not keep_session:
+                self.close_session()
+
+    def __enter__(self):
+        return self.open_session()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close_session()
+
+    def _load_tf_graph(self, update_seed=False):
+        """Build new TF graph and session, and load the model into them:
+        restore it from disk if it is initialized, or create and
+        initialize it from scratch otherwise."""
+        if self._keep_tf_session:
+            self._tf_graph = tf.Graph()
+        else:
+            tf.reset_default_graph()
+            self._tf_graph = tf.get_default_graph()
+        with self._tf_graph.as_default():
+            if update_seed:
+                tf.set_random_seed(self.make_random_seed())
+            if self.initialized_:  # model should be loaded from disk
+                self._tf_saver = tf.train.import_meta_graph(self._tf_meta_graph_filepath)
+            self._tf_session = tf.Session(config=self._tf_session_config)
+            try:
+                with self._tf_session.as_default():
+                    if self.initialized_:
+                        self._tf_saver.restore(self._tf_session, self._model_filepath)
+                    else:
+                        self._make_tf_model()
+                        self._init_tf_ops()
+                    self._init_tf_writers()
+            except:
+                self._close_tf_session()
+                raise
+
+    def _close_tf_session(self):
+        if self._tf_session is not None:
+            self._tf_session.close()
+            self._tf_session = None
+        for writer in (self._tf_train_writer, self._tf_val_writer):
+            if writer is not None:
+                writer.close()
+        self._tf_train_writer = None
+        self._tf_val_writer = None
+
+    def set_params(self, **params):
+        # graph might depend on the parameters, so it has to be rebuilt
+        self._close_tf_session()
+        return super(TensorFlowModel, self).set_params(**params)
+
     def _make_tf_model(self):
         raise NotImplementedError('`_make_tf_model` is not implemented')
 
+    def _make_input_pipeline(self, n_features, batch_size):
+        """Create ops for staging training data into the graph
+        (once per `fit`) and slicing shuffled batches from it inside
+        TF runtime, without feeding data batch by batch.
+        Should be called within 'input_data' name scope.
+
+        Parameters
+        ----------
+        batch_size : tf.Tensor
+            Size of one batch (the same as used in `_train_feed_dicts`).
+
+        Returns
+        -------
+        X_batches : (None, n_features) tf.Tensor
+            `n_batches` consecutive batches starting from `batch_index`
+            of staged data, in the order of the current permutation.
+        """
+        batch_index = tf.placeholder(tf.int32, [], name='batch_index')
+        n_batches = tf.placeholder_with_default(1, [], name='n_batches')
+
+        with tf.name_scope('input_pipeline'):
+            X_new = tf.placeholder(self._tf_dtype, [None, n_features], name='X_new')
+            # local variables are neither initialized, nor saved with the model
+            X_staged = tf.Variable(tf.zeros([0, n_features], dtype=self._tf_dtype),
+                                   trainable=False, validate_shape=False,
+                                   collections=[tf.GraphKeys.LOCAL_VARIABLES], name='X_staged')
+            perm = tf.Variable(tf.zeros([0], dtype=tf.int32),
+                               trainable=False, validate_shape=False,
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES], name='permutation')
+
+            stage_op = tf.assign(X_staged, X_new, validate_shape=False, name='stage')
+            tf.add_to_collection('stage_input_op', stage_op)
+
+            T = tf.random_shuffle(tf.range(tf.shape(X_staged)[0]), seed=self.make_random_seed())
+            shuffle_op = tf.assign(perm, T, validate_shape=False, name='shuffle')
+            tf.add_to_collection('shuffle_input_op', shuffle_op)
+
+            start = batch_index * batch_size
+            X_batches = tf.gather(X_staged, perm[start:(start + n_batches * batch_size)])
+            X_batches.set_shape([None, n_features])
+        return X_batches
+
+    def _stage_input(self, X):
+        """Copy training data into the graph if it supports input pipeline
+        (see `_make_input_pipeline`), otherwise data will be fed batch by batch."""
+        stage_op = tf.get_collection('stage_input_op')
+        self._input_staged = bool(stage_op)
+        if self._input_staged:
+            X_new = stage_op[0].op.inputs[1]
+            self._tf_session.run(stage_op[0], feed_dict={X_new: X})
+
+    def _make_metrics_accumulator(self, name, metrics):
+        """Create running averages of scalar `metrics` (dict of tf.Tensor
+        by names) over session calls, kept in the graph, so that the values
+        are fetched once (e.g. per epoch) rather than on every call.
+
+        Op updating the sums (to run along with the metrics' inputs), op
+        resetting them (to run before the first update) and the averages
+        (NaN if there were no updates) are added to the collections
+        '<name>_update', '<name>_reset' and '<name>/<metric name>'.
+        """
+        with tf.name_scope(name):
+            # local variables are neither initialized, nor saved with the model
+            count = tf.Variable(0., dtype=tf.float64, trainable=False,
+                                collections=[tf.GraphKeys.LOCAL_VARIABLES], name='count')
+            update_ops, reset_ops = [count.assign_add(1.)], [count.assign(0.)]
+            for m, metric in sorted(metrics.items()):
+                total = tf.Variable(0., dtype=tf.float64, trainable=False,
+                                    collections=[tf.GraphKeys.LOCAL_VARIABLES], name=m)
+                update_ops.append(total.assign_add(tf.cast(metric, tf.float64)))
+                reset_ops.append(total.assign(0.))
+                tf.add_to_collection('{0}/{1}'.format(name, m), total / count)
+            tf.add_to_collection('{0}_update'.format(name), tf.group(*update_ops))
+            tf.add_to_collection('{0}_reset'.format(name), tf.group(*reset_ops))
+
+    def _get_metrics_accumulator(self, name, metrics):
+        """Get update and reset ops, and dict of averages (by metrics'
+        names) of the accumulator made by `_make_metrics_accumulator`
+        for `metrics` (dict of tf.Tensor by names).
+
+        If the graph has no such accumulator (it was restored from
+        a checkpoint that predates them), it is made now, and saved
+        along with the model from then on.
+        """
+        if not tf.get_collection('{0}_update'.format(name)):
+            self._make_metrics_accumulator(name, metrics)
+        update_op = tf.get_collection('{0}_update'.format(name))[0]
+        reset_op = tf.get_collection('{0}_reset'.format(name))[0]
+        averages = {m: tf.get_collection('{0}/{1}'.format(name, m))[0] for m in metrics}
+        return update_op, reset_op, averages
+
+    def _fetch_metrics(self, averages):
+        """Fetch values of averages of an accumulator in one session call
+        (None for the ones with no updates)."""
+        values = self._tf_session.run(averages)
+        return {m: (None if np.isnan(v) else v) for m, v in values.items()}
+
+    def _train_feed_dicts(self, X, feed_dict, batch_size, verbose=False, block_size=None):
+        """Yield `feed_dict` updated with consecutive batches of `X`
+        (or with indices of shuffled batches of staged data, if any),
+        along with the number of batches it contains.
+
+        Parameters
+        ----------
+        block_size : None or callable
+            Number of consecutive batches to put into one feed dict,
+            given the index of the first one. If None, use one batch.
+        """
+        n_batches = (len(X) + batch_size - 1) // batch_size
+        if self._input_staged:
+            self._tf_session.run(tf.get_collection('shuffle_input_op')[0])
+        elif not hasattr(X, 'shape'):
+            X = np.asarray(X)
+
+        if verbose:
+            pbar = progress_bar(total=n_batches, leave=False, ncols=64, desc='epoch')
+        i = 0
+        while i < n_batches:
+            n = min(block_size(i) if block_size else 1, n_batches - i)
+            if self._input_staged:
+                feed_dict['input_data/batch_index:0'] = i
+                feed_dict['input_data/n_batches:0'] = n
+            else:
+                feed_dict['input_data/X_batch:0'] = X[i * batch_size:(i + n) * batch_size]
+            yield feed_dict, n
+            i += n
+            if verbose: pbar.update(n)
+        if verbose: pbar.close()
+
     def _init_tf_ops(self):
         """Initialize all TF variables and Saver"""
         init_op = tf.global_variables_initializer()
@@ -114,30 +364,104 @@ class TensorFlowModel(BaseModel, DtypeMixin):
         self._tf_val_writer = tf.summary.FileWriter(self._val_summary_dirpath,
                                                     self._tf_graph)
 
-    def _save_model(self, global_step=None):
+    def _save_params_arrays(self, params):
+        """Store array-valued `params` as .npy files in `params_arrays_dirpath`
+        and replace them with references to the latter. Arrays that were
+        (lazily) loaded from these very files are not rewritten."""
+        filenames = set()
+        for k, v in params.items():
+            if not isinstance(v, np.ndarray):
+                continue
+            filename = '{0}.npy'.format(k)
+            filepath = os.path.join(self._params_arrays_dirpath, filename)
+            if not _is_loaded_from(v, filepath):
+                tmp_filepath = filepath + '.tmp.npy'
+                np.save(tmp_filepath, v)
+                os.rename(tmp_filepath, filepath)
+            params[k] = {'__ndarray__': filename}
+            filenames.add(filename)
+
+        # remove arrays of params that are no longer array-valued
+        for filepath in glob.glob(os.path.join(self._params_arrays_dirpath, '*.npy')):
+            if os.path.basename(filepath) not in filenames:
+                os.remove(filepath)
+        return params
+
+    @staticmethod
+    def _load_params_arrays(params, paths):
+        """Complementary method to `_save_params_arrays`,
+        arrays are memory-mapped in read-only mode."""
+        for k, v in params.items():
+            if isinstance(v, dict) and '__ndarray__' in v:
+                filepath = os.path.join(paths['params_arrays_dirpath'], v['__ndarray__'])
+                params[k] = np.load(filepath, mmap_mode='r')
+        return params
+
+    def _write_params(self, params, random_state=None):
+        """Write serialized `params` (JSON manifest and arrays)
+        and `random_state` (if any) to the model directory."""
         # (recursively) create all folders needed
-        for dirpath in (self._train_summary_dirpath, self._val_summary_dirpath):
+        for dirpath in (self._train_summary_dirpath, self._val_summary_dirpath,
+                        self._params_arrays_dirpath):
             if not os.path.exists(dirpath):
                 os.makedirs(dirpath)
 
-        # save params
-        params = self.get_params(deep=False)
-        params = self._serialize(params)
+        params = self._save_params_arrays(params)
         params['__class_name__'] = self.__class__.__name__
-        with open(self._params_filepath, 'w') as params_file:
+        tmp_filepath = self._params_filepath + '.tmp'
+        with open(tmp_filepath, 'w') as params_file:
             json.dump(params, params_file, **self.json_params)
+        os.rename(tmp_filepath, self._params_filepath)
+
+        if random_state is not None:
+            RNG().set_state(random_state).save_state(self._random_state_filepath)
+
+    def _save_model(self, global_step=None):
+        self._wait_for_saves()
 
-        # dump random state if needed
-        if self.random_seed is not None:
-            random_state = self._rng.get_state()
-            with open(self._random_state_filepath, 'w') as random_state_file:
-                json.dump(random_state, random_state_file)
+        # save params and random state if needed
+        params = self._serialize(self.get_params(deep=False))
+        random_state = self._rng.get_state() if self.random_seed is not None else None
+        self._write_params(params, random_state)
 
         # save tf model
         self._tf_saver.save(self._tf_session,
                             self._model_filepath,
                             global_step=global_step)
 
+    def _save_model_async(self, global_step=None):
+        """The same as `_save_model`, but only snapshots variables to host
+        memory, and all the files are written in background thread (with at
+        most `max_pending_saves` snapshots in flight), so that training is
+        not stalled. If `max_pending_saves` is 0, save synchronously."""
+        if not self.max_pending_saves:
+            return self._save_model(global_step=global_step)
+
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = CheckpointWriter(self._tf_saver.export_meta_graph(),
+                                                       saver_params=self.tf_saver_params,
+                                                       max_pending=self.max_pending_saves,
+                                                       last_checkpoints=self._tf_saver._last_checkpoints)
+        params = self._serialize(self.get_params(deep=False))
+        random_state = self._rng.get_state() if self.random_seed is not None else None
+        tf_vars = tf.global_variables()
+
+        def snapshot():
+            values = self._tf_session.run(tf_vars)
+            return {v.op.name: value for v, value in zip(tf_vars, values)}
+
+        self._checkpoint_writer.submit(snapshot, self._model_filepath,
+                                       global_step=global_step,
+                                       callback=partial(self._write_params, params, random_state))
+
+    def _wait_for_saves(self):
+        """Wait until checkpoints being written in background are done,
+        and hand their bookkeeping over to the model's Saver."""
+        if self._checkpoint_writer is not None:
+            writer, self._checkpoint_writer = self._checkpoint_writer, None
+            writer.close()
+            self._tf_saver.set_last_checkpoints_with_time(writer.last_checkpoints)
+
     @classmethod
     def load_model(cls, model_path):
         paths = TensorFlowModel.compute_working_paths(model_path)
@@ -148,13 +472,17 @@ class TensorFlowModel(BaseModel, DtypeMixin):
         class_name = params.pop('__class_name__')
         if class_name != cls.__name__:
             raise RuntimeError("attempt to load {0} with class {1}".format(class_name, cls.__name__))
+        params = cls._load_params_arrays(params, paths)
         model = cls(paths=paths, **{k: params[k] for k in params if is_param_name(k)})
         params = model._deserialize(params)
         model.set_params(**params)  # set attributes and deserialized params
 
         # restore random state if needed
+        legacy_filepath = os.path.join(paths['model_dirpath'], 'random_state.json')
         if os.path.isfile(model._random_state_filepath):
-            with open(model._random_state_filepath, 'r') as random_state_file:
+            model._rng.load_state(model._random_state_filepath)
+        elif os.path.isfile(legacy_filepath):
+            with open(legacy_filepath, 'r') as random_state_file:
                 random_state = json.load(random_state_file)
             model._rng.set_state(random_state)
 
@@ -165,21 +493,94 @@ class TensorFlowModel(BaseModel, DtypeMixin):
         """Class-specific `fit` routine."""
         raise NotImplementedError('`fit` is not implemented')
 
-    @run_in_tf_session(check_initialized=False)
+    @run_in_tf_session(check_initialized=False, invalidate_session=True)
     def init(self):
         if not self.initialized_:
             self.initialized_ = True
             self._save_model()
         return self
 
-    @run_in_tf_session(check_initialized=False, update_seed=True)
+    @run_in_tf_session(check_initialized=False, update_seed=True, invalidate_session=True)
     def fit(self, X, X_val=None, *args, **kwargs):
         """Fit the model according to the given training data."""
         self.initialized_ = True
-        self._fit(X, X_val=X_val, *args, **kwargs)
+        try:
+            self._fit(X, X_val=X_val, *args, **kwargs)
+        finally:
+            self._wait_for_saves()
         self._save_model()
         return self
 
+    def set_transform_cache(self, cache):
+        """Cache results of `transform` in `cache` (`TransformCache`),
+        keyed by the saved model checkpoint and the input data,
+        so that they are recomputed only when either of them changes.
+        If `cache` is None, disable caching.
+        """
+        self._transform_cache = cache
+        return self
+
+    def _checkpoint_fingerprint(self):
+        """Hash of the saved params and TF checkpoint of the model.
+
+        The hash is memoized and recomputed only if paths, sizes or
+        modification times of the checkpoint files have changed.
+        """
+        filepaths = [self._params_filepath]
+        filepaths += sorted(glob.glob(os.path.join(self._params_arrays_dirpath, '*.npy')))
+        filepaths += sorted(glob.glob(self._model_filepath + '.*'))
+        stats = []
+        for filepath in filepaths:
+            stat = os.stat(filepath)
+            stats.append((os.path.realpath(filepath), stat.st_size, stat.st_mtime))
+        if self._checkpoint_fingerprint_memo is not None and \
+                self._checkpoint_fingerprint_memo[0] == stats:
+            return self._checkpoint_fingerprint_memo[1]
+
+        h = hashlib.sha1()
+        h.update(self.__class__.__name__)
+        for filepath in filepaths:
+            h.update(os.path.basename(filepath))
+            with open(filepath, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+        self._checkpoint_fingerprint_memo = (stats, h.hexdigest())
+        return self._checkpoint_fingerprint_memo[1]
+
+    def _inference_size(self):
+        """Number of values per example held in memory during inference
+        (rough estimate, used to choose batch size within memory budget)."""
+        raise NotImplementedError('`_inference_size` is not implemented')
+
+    def _inference_batch_size(self, batch_size=None, max_memory=None):
+        """Batch size for inference (`transform` etc.).
+
+        Parameters
+        ----------
+        batch_size : None or positive int
+            If None, use `batch_size` of the model (the one for training).
+        max_memory : None or positive int
+            If given, use the largest batch size for which intermediate
+            results fit into this many bytes instead.
+        """
+        if max_memory is not None:
+            example_bytes = self._inference_size() * np.dtype(self._np_dtype).itemsize
+            return max(int(max_memory) // example_bytes, 1)
+        return batch_size or self.batch_size
+
+    def _cached_transform(self, f, name, X, np_dtype):
+        """Return `f(X, np_dtype)`, looking it up in (and storing it to)
+        transform cache first, if the latter is set."""
+        if self._transform_cache is None or not self.initialized_:
+            return f(X, np_dtype)
+        model_fingerprint = '{0}:{1}'.format(self._checkpoint_fingerprint(), name)
+        key = self._transform_cache.make_key(model_fingerprint, X, np_dtype)
+        Y = self._transform_cache.get(key)
+        if Y is None:
+            Y = f(X, np_dtype)
+            self._transform_cache.put(key, Y)
+        return Y
+
     @run_in_tf_session()
     def get_tf_params(self, scope=None):
         """Get tf params of the model.
@@ -1,14 +1,12 @@
 import numpy as np
 import tensorflow as tf
+from functools import partial
 from tensorflow.core.framework import summary_pb2
-from tensorflow.contrib.distributions import Bernoulli
 
 from base import run_in_tf_session
 from ebm import EnergyBasedModel
-from layers import BernoulliLayer
 from utils import (make_list_from, write_during_training,
-                   batch_iter, epoch_iter,
-                   log_sum_exp, log_diff_exp, log_mean_exp, log_std_exp)
+                   batch_iter, epoch_iter)
 
 
 class DBM(EnergyBasedModel):
@@ -33,13 +31,21 @@ class DBM(EnergyBasedModel):
         Maximum number of mean-field updates per weight update.
     mf_tol : positive float
         Mean-field tolerance.
+    mf_per_sample : bool
+        Whether to check convergence of mean-field updates for each sample
+        separately, and to keep updating only the ones that have not converged
+        yet (instead of the whole batch until all of them converge).
     learning_rate, momentum : positive float or iterable
         Gradient descent parameters. Values are updated after each epoch.
     max_epoch : positive int
         Train till this epoch.
     batch_size : positive int
-        Input batch size for training. Total number of training examples should
-        be divisible by this number.
+        Input batch size for training (the last batch may be smaller).
+        Inference (`transform` etc.) accepts batches of any size.
+    stage_input : bool
+        Whether to copy training data into the graph once per `fit`
+        and to slice shuffled batches from it inside TF runtime,
+        instead of feeding the data batch by batch.
     l2 : non-negative float
         L2 weight decay coefficient.
     max_norm : positive float
@@ -63,6 +69,10 @@ class DBM(EnergyBasedModel):
         Whether to display progress during training.
     save_after_each_epoch : bool
         If False, save model only after the whole training is complete.
+        Otherwise checkpoints are written by a background thread, with at most
+        `max_pending_saves` snapshots of variables in flight (if 0, they are
+        written synchronously), and only `tf_saver_params['max_to_keep']`
+        newest of them are kept.
     display_filters : non-negative int
         Number of weights filters to display during training (in TensorBoard).
     display_particles : non-negative int
@@ -88,8 +98,8 @@ class DBM(EnergyBasedModel):
     """
     def __init__(self, rbms=None,
                  n_particles=100, v_particle_init=None, h_particles_init=None,
-                 n_gibbs_steps=5, max_mf_updates=10, mf_tol=1e-7,
-                 learning_rate=0.0005, momentum=0.9, max_epoch=10, batch_size=100,
+                 n_gibbs_steps=5, max_mf_updates=10, mf_tol=1e-7, mf_per_sample=False,
+                 learning_rate=0.0005, momentum=0.9, max_epoch=10, batch_size=100, stage_input=False,
                  l2=0., max_norm=np.inf,
                  sample_v_states=True, sample_h_states=None,
                  sparsity_target=0.1, sparsity_cost=0., sparsity_damping=0.9,
@@ -110,11 +120,13 @@ class DBM(EnergyBasedModel):
         self.n_gibbs_steps = make_list_from(n_gibbs_steps)
         self.max_mf_updates = max_mf_updates
         self.mf_tol = mf_tol
+        self.mf_per_sample = mf_per_sample
 
         self.learning_rate = make_list_from(learning_rate)
         self.momentum = make_list_from(momentum)
         self.max_epoch = max_epoch
         self.batch_size = batch_size
+        self.stage_input = stage_input
         self.l2 = l2
         self.max_norm = max_norm
 
@@ -164,7 +176,6 @@ class DBM(EnergyBasedModel):
         self._batch_size = None
         self._l2 = None
         self._max_norm = None
-        self._N = None
         self._M = None
 
         # tf input data
@@ -172,8 +183,6 @@ class DBM(EnergyBasedModel):
         self._momentum = None
         self._n_gibbs_steps = None
         self._X_batch = None
-        self._delta_beta = None
-        self._n_ais_runs = None
 
         # tf vars
         self._W = []
@@ -184,8 +193,6 @@ class DBM(EnergyBasedModel):
         self._dvb = None
         self._dhb = []
 
-        self._mu = []
-        self._mu_new = []
         self._q_means = []
         self._mu_means = []
 
@@ -197,11 +204,14 @@ class DBM(EnergyBasedModel):
         # tf operations
         self._train_op = None
         self._transform_op = None
-        self._msre = None
         self._reconstruction = None
-        self._n_mf_updates = None
+        self._train_metrics_update = None
+        self._train_metrics_reset = None
+        self._train_metrics_map = {}
+        self._val_metrics_update = None
+        self._val_metrics_reset = None
+        self._val_metrics_map = {}
         self._sample_v = None
-        self._log_Z = None
         self._log_proba = None
 
     def load_rbms(self, rbms):
@@ -251,7 +261,6 @@ class DBM(EnergyBasedModel):
             self._batch_size = tf.constant(self.batch_size, dtype=tf.int32, name='batch_size')
             self._l2 = tf.constant(self.l2, dtype=self._tf_dtype, name='L2_coef')
             self._max_norm = tf.constant(self.max_norm, dtype=self._tf_dtype, name='max_norm_coef')
-            self._N = tf.cast(self._batch_size, dtype=self._tf_dtype, name='N')
             self._M = tf.cast(self._n_particles, dtype=self._tf_dtype, name='M')
 
     def _make_placeholders(self):
@@ -259,9 +268,12 @@ class DBM(EnergyBasedModel):
             self._learning_rate = tf.placeholder(self._tf_dtype, [], name='learning_rate')
             self._momentum = tf.placeholder(self._tf_dtype, [], name='momentum')
             self._n_gibbs_steps = tf.placeholder(tf.int32, [], name='n_gibbs_steps')
-            self._X_batch = tf.placeholder(self._tf_dtype, [None, self.n_visible_], name='X_batch')
-            self._delta_beta = tf.placeholder(self._tf_dtype, [], name='delta_beta')
-            self._n_ais_runs = tf.placeholder(tf.int32, [], name='n_ais_runs')
+            X_staged = self._make_input_pipeline(self.n_visible_, self._batch_size) \
+                       if self.stage_input else None
+            if X_staged is not None:
+                self._X_batch = tf.placeholder_with_default(X_staged, [None, self.n_visible_], name='X_batch')
+            else:
+                self._X_batch = tf.placeholder(self._tf_dtype, [None, self.n_visible_], name='X_batch')
 
     def _make_vars(self):
         # compose weights and biases of DBM from trained RBMs' ones
@@ -339,17 +351,6 @@ class DBM(EnergyBasedModel):
                 tf.summary.histogram('dhb_hist', dhb)
                 self._dhb.append(dhb)
 
-        # initialize variational parameters
-        with tf.name_scope('variational_params'):
-            for i in xrange(self.n_layers_):
-                t = tf.zeros([self._batch_size, self.n_hiddens_[i]], dtype=self._tf_dtype)
-                mu = tf.Variable(t, name='mu')
-                t_new = tf.zeros([self._batch_size, self.n_hiddens_[i]], dtype=self._tf_dtype)
-                mu_new = tf.Variable(t_new, name='mu_new')
-                tf.summary.histogram('mu_hist', mu)
-                self._mu.append(mu)
-                self._mu_new.append(mu_new)
-
         # initialize running means of hidden activations means
         with tf.name_scope('hidden_means_accumulators'):
             for i in xrange(self.n_layers_):
@@ -427,11 +428,19 @@ class DBM(EnergyBasedModel):
         return v, H, v_new, H_new
 
     def _make_mf(self):
-        """Run mean-field updates for current mini-batch"""
+        """Run mean-field updates for current mini-batch (of any size).
+
+        Returns
+        -------
+        n_mf_updates : tf.Tensor
+            Number of updates made.
+        mu : [(batch_size, n_hiddens[i]) tf.Tensor]
+            Variational parameters for all hidden layers.
+        """
         with tf.name_scope('mean_field'):
-            # initialize mu_new using approximate inference
+            # initialize mu using approximate inference
             # as suggested in [1]
-            init_ops = []
+            mu = []
             T = None
             for i in xrange(self.n_layers_):
                 if i == 0:
@@ -441,41 +450,85 @@ class DBM(EnergyBasedModel):
                     if i < self.n_layers_ - 1:
                         T *= 2.
                 T = self._h_layers[i].activation(T, self._hb[i])
-                q_new = tf.identity(T, name='approx_inference')
-                init_op = tf.assign(self._mu_new[i], q_new)
-                init_ops.append(init_op)
+                mu.append(tf.identity(T, name='approx_inference'))
 
             # run mean-field updates until convergence
-            def cond(step, max_step, tol, X_batch, mu, mu_new):
-                c1 = step < max_step
-                c2 = tf.reduce_max([tf.norm(u - v, ord=np.inf) for u, v in zip(mu, mu_new)]) > tol
-                return tf.logical_and(c1, c2)
-
-            def body(step, max_step, tol, X_batch, mu, mu_new):
-                _, mu, _, mu_new = self._make_gibbs_step(X_batch, mu, X_batch, mu_new,
-                                                         update_v=False, sample=False)
-                return step + 1, max_step, tol, X_batch, mu_new, mu  # swap mu and mu_new
-
-            with tf.control_dependencies(init_ops):  # make sure mu's are initialized
-                i = tf.constant(0)
-                n_mf_updates, _, _, _, mu, _ = \
-                    tf.while_loop(cond=cond, body=body,
-                                  loop_vars=[i,
-                                             self._max_mf_updates,
-                                             self._mf_tol,
-                                             self._X_batch,
-                                             self._mu, self._mu_new],
-                                  shape_invariants=[i.get_shape(),
-                                                    self._max_mf_updates.get_shape(),
-                                                    self._mf_tol.get_shape(),
-                                                    self._X_batch.get_shape(),
-                                                    [tf.TensorShape([None, n]) for n in self.n_hiddens_],
-                                                    [tf.TensorShape([None, n]) for n in self.n_hiddens_]],
-                                  back_prop=False,
-                                  parallel_iterations=1,
-                                  name='mean_field_updates')
-                mu_updates = [self._mu[i].assign(mu[i]) for i in xrange(self.n_layers_)]
-            return n_mf_updates, mu_updates
+            if self.mf_per_sample:
+                return self._make_mf_per_sample(mu)
+            return self._make_mf_batch(mu)
+
+    def _make_mf_batch(self, mu):
+        """Run mean-field updates starting from `mu` (at least one)
+        until the largest change across the batch falls below tolerance."""
+        def cond(step, max_step, tol, X_batch, mu, mu_new):
+            c1 = step < max_step
+            c2 = tf.reduce_max([tf.norm(u - v, ord=np.inf) for u, v in zip(mu, mu_new)]) > tol
+            return tf.logical_and(c1, tf.logical_or(tf.equal(step, 0), c2))
+
+        def body(step, max_step, tol, X_batch, mu, mu_new):
+            _, mu, _, mu_new = self._make_gibbs_step(X_batch, mu, X_batch, mu_new,
+                                                     update_v=False, sample=False)
+            return step + 1, max_step, tol, X_batch, mu_new, mu  # swap mu and mu_new
+
+        i = tf.constant(0)
+        n_mf_updates, _, _, _, mu, _ = \
+            tf.while_loop(cond=cond, body=body,
+                          loop_vars=[i,
+                                     self._max_mf_updates,
+                                     self._mf_tol,
+                                     self._X_batch,
+                                     mu, list(mu)],
+                          shape_invariants=[i.get_shape(),
+                                            self._max_mf_updates.get_shape(),
+                                            self._mf_tol.get_shape(),
+                                            self._X_batch.get_shape(),
+                                            [tf.TensorShape([None, n]) for n in self.n_hiddens_],
+                                            [tf.TensorShape([None, n]) for n in self.n_hiddens_]],
+                          back_prop=False,
+                          parallel_iterations=1,
+                          name='mean_field_updates')
+        return n_mf_updates, mu
+
+    def _make_mf_per_sample(self, mu):
+        """Run mean-field updates starting from `mu`, only for the samples
+        (rows) that have not converged yet, gathered into a compact batch
+        on each iteration. Per-sample numbers of updates are added
+        to the `n_mf_updates_per_sample` collection."""
+        N = tf.shape(self._X_batch)[0]
+
+        def cond(step, ix, n_updates, mu, mu_new):
+            return tf.logical_and(step < self._max_mf_updates, tf.size(ix) > 0)
+
+        def body(step, ix, n_updates, mu, mu_new):
+            X_a = tf.gather(self._X_batch, ix)
+            mu_a = [tf.gather(t, ix) for t in mu]
+            mu_new_a = [tf.gather(t, ix) for t in mu_new]
+            _, _, _, mu_new_a = self._make_gibbs_step(X_a, mu_a, X_a, list(mu_new_a),
+                                                      update_v=False, sample=False)
+            # write updated rows back, converged ones stay as they are
+            mu_new = [tf.dynamic_stitch([tf.range(N), ix], [u, v]) for u, v in zip(mu, mu_new_a)]
+            delta = tf.reduce_max([tf.reduce_max(tf.abs(u - v), axis=1)
+                                   for u, v in zip(mu_new_a, mu_a)], axis=0)
+            n_updates += tf.unsorted_segment_sum(tf.ones_like(ix), ix, N)
+            ix = tf.boolean_mask(ix, delta > self._mf_tol)
+            return step + 1, ix, n_updates, mu_new, mu  # swap mu and mu_new
+
+        i = tf.constant(0)
+        ix = tf.range(N)
+        n_mf_updates, _, n_updates, mu, _ = \
+            tf.while_loop(cond=cond, body=body,
+                          loop_vars=[i, ix, tf.zeros_like(ix),
+                                     mu, list(mu)],
+                          shape_invariants=[i.get_shape(),
+                                            tf.TensorShape([None]),
+                                            tf.TensorShape([None]),
+                                            [tf.TensorShape([None, n]) for n in self.n_hiddens_],
+                                            [tf.TensorShape([None, n]) for n in self.n_hiddens_]],
+                          back_prop=False,
+                          parallel_iterations=1,
+                          name='mean_field_updates')
+        tf.add_to_collection('n_mf_updates_per_sample', n_updates)
+        return n_mf_updates, mu
 
     def _make_particles_update(self, n_steps=None, sample=True, G_fed=False):
         """Update negative particles by running Gibbs sampler
@@ -514,18 +567,29 @@ class DBM(EnergyBasedModel):
 
     def _make_train_op(self):
         # run mean-field updates for current mini-batch
-        n_mf_updates, mu_updates = self._make_mf()
+        n_mf_updates, mu = self._make_mf()
+
+        # encoded data, used by the transform method
+        with tf.name_scope('transform'):
+            transform_op = tf.identity(mu[-1])
+            tf.add_to_collection('transform_op', transform_op)
+
+        # compute metrics
+        with tf.name_scope('mean_squared_reconstruction_error'):
+            T = tf.matmul(a=mu[0], b=self._W[0], transpose_b=True)
+            v_means = self._v_layer.activation(T, self._vb)
+            v_means = tf.identity(v_means, name='x_reconstruction')
+            msre = tf.reduce_mean(tf.square(self._X_batch - v_means))
+            tf.add_to_collection('msre', msre)
+
+        tf.add_to_collection('reconstruction', v_means)
+        tf.add_to_collection('n_mf_updates', n_mf_updates)
 
         # update negative particles by running Gibbs sampler
         # for specified number of steps
         v_update, H_updates, v_new_update, H_new_updates = self._make_particles_update()
 
-        with tf.control_dependencies([v_update, v_new_update] + H_updates + H_new_updates + mu_updates):
-
-            # encoded data, used by the transform method
-            with tf.name_scope('transform'):
-                transform_op = tf.identity(self._mu[-1])
-                tf.add_to_collection('transform_op', transform_op)
+        with tf.control_dependencies([v_update, v_new_update] + H_updates + H_new_updates):
 
             # visualize particles
             if self.display_particles:
@@ -548,6 +612,9 @@ class DBM(EnergyBasedModel):
 
             # compute gradients estimates (= positive - negative associations)
             with tf.name_scope('grads_estimates'):
+                # number of training examples might not be divisible by batch size
+                N = tf.cast(tf.shape(self._X_batch)[0], dtype=self._tf_dtype)
+
                 # visible bias
                 with tf.name_scope('dvb'):
                     dvb = tf.reduce_mean(self._X_batch, axis=0) - tf.reduce_mean(self._v, axis=0)
@@ -555,7 +622,7 @@ class DBM(EnergyBasedModel):
                 dW = []
                 # first layer of weights
                 with tf.name_scope('dW'):
-                    dW_0_positive = tf.matmul(a=self._X_batch, b=self._mu[0], transpose_a=True) / self._N
+                    dW_0_positive = tf.matmul(a=self._X_batch, b=mu[0], transpose_a=True) / N
                     dW_0_negative = tf.matmul(a=self._v, b=self._H[0], transpose_a=True) / self._M
                     dW_0 = (dW_0_positive - dW_0_negative) - self._l2 * self._W[0]
                     dW.append(dW_0)
@@ -563,7 +630,7 @@ class DBM(EnergyBasedModel):
                 # ... rest of them
                 for i in xrange(1, self.n_layers_):
                     with tf.name_scope('dW'):
-                        dW_i_positive = tf.matmul(a=self._mu[i - 1], b=self._mu[i], transpose_a=True) / self._N
+                        dW_i_positive = tf.matmul(a=mu[i - 1], b=mu[i], transpose_a=True) / N
                         dW_i_negative = tf.matmul(a=self._H[i - 1], b=self._H[i], transpose_a=True) / self._M
                         dW_i = (dW_i_positive - dW_i_negative) - self._l2 * self._W[i]
                         dW.append(dW_i)
@@ -572,7 +639,7 @@ class DBM(EnergyBasedModel):
                 # hidden biases
                 for i in xrange(self.n_layers_):
                     with tf.name_scope('dhb'):
-                        dhb_i = tf.reduce_mean(self._mu[i], axis=0) - tf.reduce_mean(self._H[i], axis=0)
+                        dhb_i = tf.reduce_mean(mu[i], axis=0) - tf.reduce_mean(self._H[i], axis=0)
                         dhb.append(dhb_i)
 
             # apply sparsity targets if needed
@@ -581,7 +648,7 @@ class DBM(EnergyBasedModel):
                     q_means = tf.reduce_sum(self._H[i], axis=0)
                     q_update = self._q_means[i].assign(self._sparsity_damping * self._q_means[i] + \
                                                        (1 - self._sparsity_damping) * q_means[i])
-                    mu_means = tf.reduce_sum(self._mu[i], axis=0)
+                    mu_means = tf.reduce_sum(mu[i], axis=0)
                     mu_update = self._mu_means[i].assign(self._sparsity_damping * self._mu_means[i] + \
                                                         (1 - self._sparsity_damping) * mu_means[i])
                     sparsity_penalty = self._sparsity_costs[i] * (q_update - self._sparsity_targets[i])
@@ -621,22 +688,20 @@ class DBM(EnergyBasedModel):
                                     tf.group(*hb_updates))
                 tf.add_to_collection('train_op', train_op)
 
-            # compute metrics
-            with tf.name_scope('mean_squared_reconstruction_error'):
-                T = tf.matmul(a=self._mu[0], b=self._W[0], transpose_b=True)
-                v_means = self._v_layer.activation(T, self._vb)
-                v_means = tf.identity(v_means, name='x_reconstruction')
-                msre = tf.reduce_mean(tf.square(self._X_batch - v_means))
-                tf.add_to_collection('msre', msre)
-
-            tf.add_to_collection('reconstruction', v_means)
-            tf.add_to_collection('n_mf_updates', n_mf_updates)
-
             # collect summaries
             tf.summary.scalar('mean_squared_recon_error', msre)
             tf.summary.scalar('n_mf_updates', n_mf_updates)
+            if self.mf_per_sample:
+                tf.summary.histogram('n_mf_updates_per_sample',
+                                     tf.get_collection('n_mf_updates_per_sample')[0])
             for i in xrange(self.n_layers_):
                 tf.summary.scalar('W_norm', W_norms[i])
+                tf.summary.histogram('mu_hist', mu[i])
+
+        # running averages of metrics over epoch (validation set)
+        metrics = dict(msre=msre, n_mf_updates=n_mf_updates)
+        self._make_metrics_accumulator('train_metrics', metrics)
+        self._make_metrics_accumulator('val_metrics', metrics)
 
     def _make_sample_v(self):
         with tf.name_scope('sample_v'):
@@ -647,114 +712,124 @@ class DBM(EnergyBasedModel):
                 sample_v = self._v.assign(v_means)
         tf.add_to_collection('sample_v', sample_v)
 
-    def _unnormalized_log_prob_H0(self, x, beta):
-        T1 = tf.einsum('ij,j->i', x, self._hb[0])
-        T1 *= beta
-        log_p = T1
-        T2 = tf.matmul(x, b=self._W[0], transpose_b=True) + self._vb
-        T2 *= beta
-        log_p += tf.reduce_sum(tf.nn.softplus(T2), axis=1)
-        T3 = tf.matmul(x, self._W[1]) + self._hb[1]
-        T3 *= beta
-        log_p += tf.reduce_sum(tf.nn.softplus(T3), axis=1)
+    def _layers_biases(self):
+        """Layers [v, h_1, ..., h_L] and corresponding biases."""
+        return [self._v_layer] + self._h_layers, [self._vb] + self._hb
+
+    def _total_input(self, S, i):
+        """Total input to the i-th of the layers [v, h_1, ..., h_L]
+        from (scaled) states `S` of the adjacent ones."""
+        layers, _ = self._layers_biases()
+        T = 0.
+        if i > 0:
+            T += tf.matmul(layers[i - 1].scale(S[i - 1]), self._W[i - 1])
+        if i < self.n_layers_:
+            T += tf.matmul(a=layers[i + 1].scale(S[i + 1]), b=self._W[i], transpose_b=True)
+        return T
+
+    def _split_ais_state(self, x):
+        """Split AIS state x = {h_1, h_3, ...} into the states of odd layers,
+        placing them into the list indexed as [v, h_1, ..., h_L]."""
+        S = [None] * (self.n_layers_ + 1)
+        S[1::2] = tf.split(x, self.n_hiddens_[0::2], axis=1)
+        return S
+
+    def _unnormalized_log_prob_ais(self, x, beta):
+        layers, biases = self._layers_biases()
+        S = self._split_ais_state(x)
+        log_p = 0.
+        for i, L in enumerate(layers):
+            if i % 2:
+                log_p += L.log_prob_states(S[i], biases[i], beta)
+            else:
+                # even layers are conditionally independent given odd ones
+                log_p += L.log_partition(self._total_input(S, i), biases[i], beta)
         return log_p
 
-    def _make_ais_next_sample(self, x, beta):
-        def cond(step, max_step, x):
-            return step < max_step
-
-        def body(step, max_step, x):
-            # v_hat <- P(v|h=x)
-            T1 = tf.matmul(a=x, b=self._W[0], transpose_b=True)
-            v = self._v_layer.activation(beta * T1, beta * self._vb)
-            if self.sample_v_states:
-                v = self._v_layer.sample(means=v)
-
-            # h2_hat <- P(h2|h=x)
-            T2 = tf.matmul(x, self._W[1])
-            h2 = self._h_layers[1].activation(beta * T2, beta * self._hb[1])
-            if self.sample_h_states[1]:
-                h2 = self._h_layers[1].sample(means=h2)
-
-            # x_hat <- P(h|v=v_hat, h2=h2_hat)
-            T3 = tf.matmul(v, self._W[0])
-            T4 = tf.matmul(a=h2, b=self._W[1], transpose_b=True)
-            x_hat = self._h_layers[0].activation(beta * (T3 + T4), beta * self._hb[0])
-            if self.sample_h_states[0]:
-                x_hat = self._h_layers[0].sample(means=x_hat)
-
-            return step + 1, max_step, x_hat
-
-        _, _, x_new = tf.while_loop(cond=cond, body=body,
-                                    loop_vars=[tf.constant(0),
-                                               self._n_gibbs_steps,
-                                               x],
-                                    parallel_iterations=1,
-                                    back_prop=False)
+    def _make_ais_transition(self, x, beta, step):
+        layers, biases = self._layers_biases()
+
+        def cond(j, x):
+            return j < self._ais_n_gibbs_steps
+
+        def body(j, x):
+            # one sample per layer per Gibbs step
+            counter = step * tf.cast(self._ais_n_gibbs_steps, tf.int64) + tf.cast(j, tf.int64)
+            counter *= len(layers)
+            S = self._split_ais_state(x)
+            # sample even layers given odd ones, and then vice versa
+            for parity in (0, 1):
+                for i in xrange(parity, len(layers), 2):
+                    T = self._total_input(S, i)
+                    S[i] = layers[i].sample_stateless(T, biases[i], self._ais_seed_for(counter + i), beta)
+            return j + 1, tf.concat(S[1::2], axis=1)
+
+        _, x_new = tf.while_loop(cond=cond, body=body,
+                                 loop_vars=[tf.constant(0), x],
+                                 parallel_iterations=1,
+                                 back_prop=False)
         return x_new
 
-    def _make_ais(self):
-        with tf.name_scope('annealed_importance_sampling'):
-
-            # x_0 ~ Ber(0.5) of size (M, H_1)
-            logits = tf.zeros([self._n_ais_runs, self._n_hiddens[0]])
-            T = Bernoulli(logits=logits).sample(seed=self.make_random_seed())
-            x_0 = tf.cast(T, dtype=self._tf_dtype)
-
-            # x_1 ~ T_1(x_1 | x_0)
-            x_1 = self._make_ais_next_sample(x_0, self._delta_beta)
-
-            # -log p_0(x_1)
-            log_Z = -self._unnormalized_log_prob_H0(x_1, 0.)
-
-            def cond(log_Z, x, beta, delta_beta):
-                return beta < 1. - delta_beta + 1e-5
-
-            def body(log_Z, x, beta, delta_beta):
-                # + log p_i(x_i)
-                log_Z += self._unnormalized_log_prob_H0(x, beta)
-                # x_{i + 1} ~ T_{i + 1}(x_{i + 1} | x_i)
-                x_new = self._make_ais_next_sample(x, beta + delta_beta)
-                # - log p_i(x_{i + 1})
-                log_Z -= self._unnormalized_log_prob_H0(x_new, beta)
-                return log_Z, x_new, beta + delta_beta, delta_beta
-
-            log_Z, x_M, _, _ = tf.while_loop(cond=cond, body=body,
-                                             loop_vars=[log_Z, x_1, self._delta_beta,
-                                                                    self._delta_beta],
-                                             back_prop=False,
-                                             parallel_iterations=1)
-            # + log p_M(x_M)
-            log_Z += self._unnormalized_log_prob_H0(x_M, 1.)
-
-            # + log(Z_0) = (V + H_1 + H_2) * log(2)
-            log_Z0 = self._n_visible + self._n_hiddens[0] + self._n_hiddens[1]
-            log_Z0 = tf.cast(log_Z0, dtype=self._tf_dtype)
-            log_Z0 *= tf.cast(tf.log(2.), dtype=self._tf_dtype)
-            log_Z += log_Z0
-
-        tf.add_to_collection('log_Z', log_Z)
+    def _make_ais_base(self):
+        # for beta = 0 all the layers are independent
+        layers, biases = self._layers_biases()
+        x_0 = [layers[i].sample_base_stateless(biases[i], self._ais_n_runs, self._ais_seed_for(-i))
+               for i in xrange(1, len(layers), 2)]
+        x_0 = tf.concat(x_0, axis=1)
+        log_Z0 = sum(L.base_log_Z(b) for L, b in zip(layers, biases))
+        log_Z0 = tf.constant(log_Z0, dtype=self._tf_dtype)
+        return x_0, log_Z0
+
+    def _make_sampler_v_base(self):
+        return self._v_layer.sample_base_stateless(self._vb, self._sampler_n_chains,
+                                                   self._sampler_seed_for(-1))
+
+    def _sample_odd_layers(self, S, seed_for):
+        layers, biases = self._layers_biases()
+        for i in xrange(1, len(layers), 2):
+            S[i] = layers[i].sample_stateless(self._total_input(S, i), biases[i], seed_for(i))
+        return S[1::2]
+
+    def _make_sampler_particles(self, n_chains):
+        # cycle through the stored particles of odd layers
+        ix = tf.mod(tf.range(n_chains), self._n_particles)
+        return [tf.gather(self._H[i - 1], ix) for i in xrange(1, self.n_layers_ + 1, 2)]
+
+    def _make_sampler_init(self, v):
+        # even hidden layers from the base-rate model, then odd ones given the rest
+        layers, biases = self._layers_biases()
+        S = [v] + [None] * self.n_layers_
+        for i in xrange(2, len(layers), 2):
+            S[i] = layers[i].sample_base_stateless(biases[i], tf.shape(v)[0],
+                                                   self._sampler_seed_for(-1 - i))
+        return self._sample_odd_layers(S, lambda i: self._sampler_seed_for(-1 - i))
+
+    def _make_sampler_step(self, state, step):
+        # same block Gibbs updates as in AIS transitions for beta = 1
+        with tf.name_scope('sampler_step'):
+            layers, biases = self._layers_biases()
+            seed_for = lambda i: self._sampler_seed_for(step * len(layers) + i)
+            S = [None] * (self.n_layers_ + 1)
+            S[1::2] = state
+            v_means = layers[0].activation(self._total_input(S, 0), self._vb)
+            for i in xrange(0, len(layers), 2):
+                S[i] = layers[i].sample_stateless(self._total_input(S, i), biases[i], seed_for(i))
+            state = self._sample_odd_layers(S, seed_for)
+        return state, S[0], v_means
 
     def _make_log_proba(self):
         with tf.name_scope('log_proba'):
 
-            n_mf_updates, mu_updates = self._make_mf()
-            with tf.control_dependencies(mu_updates):
-                t1 = tf.matmul(self._X_batch, self._W[0])
-                minus_E = tf.reduce_sum(t1 * self._mu[0], axis=1)
-                t2 = tf.matmul(self._mu[0], self._W[1])
-                minus_E += tf.reduce_sum(t2 * self._mu[1], axis=1)
-                minus_E += tf.einsum('ij,j->i', self._X_batch, self._vb)
-                minus_E += tf.einsum('ij,j->i', self._mu[0], self._hb[0])
-                minus_E += tf.einsum('ij,j->i', self._mu[1], self._hb[1])
-
-                s1 = tf.clip_by_value(self._mu[0], 1e-7, 1. - 1e-7)
-                s2 = tf.clip_by_value(self._mu[1], 1e-7, 1. - 1e-7)
-                S1 = -s1 * tf.log(s1) - (1. - s1) * tf.log(1. - s1)
-                S2 = -s2 * tf.log(s2) - (1. - s2) * tf.log(1. - s2)
-                H = tf.reduce_sum(S1, axis=1) + tf.reduce_sum(S2, axis=1)
-
-                log_p = minus_E + H
+            _, mu = self._make_mf()
+            layers, biases = self._layers_biases()
+            S = [self._X_batch] + mu
+            # E_q[-E(v, h)] + H(q)
+            log_p = layers[0].log_prob_states(self._X_batch, self._vb)
+            for i in xrange(1, len(layers)):
+                log_p += layers[i].mean_field_terms(S[i], biases[i])
+            for i in xrange(self.n_layers_):
+                T = tf.matmul(layers[i].scale(S[i]), self._W[i])
+                log_p += tf.reduce_sum(T * layers[i + 1].scale(S[i + 1]), axis=1)
 
         tf.add_to_collection('log_proba', log_p)
 
@@ -765,20 +840,17 @@ class DBM(EnergyBasedModel):
 
         self._make_train_op()
         self._make_sample_v()
-        self._make_ais()
+        self._make_ais(sum(self.n_hiddens_[0::2]))
         self._make_log_proba()
+        self._make_sampler(self.n_visible_)
 
-    def _make_tf_feed_dict(self, X_batch=None, delta_beta=None, n_ais_runs=None, n_gibbs_steps=None):
+    def _make_tf_feed_dict(self, X_batch=None, n_gibbs_steps=None):
         d = {}
         d['learning_rate'] = self.learning_rate[min(self.epoch_, len(self.learning_rate) - 1)]
         d['momentum'] = self.momentum[min(self.epoch_, len(self.momentum) - 1)]
 
         if X_batch is not None:
             d['X_batch'] = X_batch
-        if delta_beta is not None:
-            d['delta_beta'] = delta_beta
-        if n_ais_runs is not None:
-            d['n_ais_runs'] = n_ais_runs
         if n_gibbs_steps is not None:
             d['n_gibbs_steps'] = n_gibbs_steps
         else:
@@ -791,31 +863,29 @@ class DBM(EnergyBasedModel):
         return feed_dict
 
     def _train_epoch(self, X):
-        train_msres, train_n_mf_updates = [], []
-        for X_batch in batch_iter(X, self.batch_size, verbose=self.verbose):
+        self._tf_session.run(self._train_metrics_reset)
+        feed_dicts = self._train_feed_dicts(X, self._make_tf_feed_dict(), self.batch_size,
+                                            verbose=self.verbose)
+        for feed_dict, _ in feed_dicts:
             self.iter_ += 1
             if self.iter_ % self.train_metrics_every_iter == 0:
-                msre, n_mf_upds, _, s = self._tf_session.run([self._msre, self._n_mf_updates,
-                                                              self._train_op, self._tf_merged_summaries],
-                                                              feed_dict=self._make_tf_feed_dict(X_batch))
-                train_msres.append(msre)
-                train_n_mf_updates.append(n_mf_upds)
+                # metrics are accumulated in the graph and fetched once per epoch
+                _, _, s = self._tf_session.run([self._train_metrics_update, self._train_op,
+                                                self._tf_merged_summaries],
+                                               feed_dict=feed_dict)
                 self._tf_train_writer.add_summary(s, self.iter_)
             else:
-                self._tf_session.run(self._train_op,
-                                     feed_dict=self._make_tf_feed_dict(X_batch))
-        return (np.mean(train_msres) if train_msres else None,
-                np.mean(train_n_mf_updates) if train_n_mf_updates else None)
+                self._tf_session.run(self._train_op, feed_dict=feed_dict)
+        results = self._fetch_metrics(self._train_metrics_map)
+        return results['msre'], results['n_mf_updates']
 
     def _run_val_metrics(self, X_val):
-        val_msres, val_n_mf_updates = [], []
+        self._tf_session.run(self._val_metrics_reset)
         for X_vb in batch_iter(X_val, batch_size=self.batch_size):
-            msre, n_mf_upds = self._tf_session.run([self._msre, self._n_mf_updates],
-                                                    feed_dict=self._make_tf_feed_dict(X_vb))
-            val_msres.append(msre)
-            val_n_mf_updates.append(n_mf_upds)
-        mean_msre = np.mean(val_msres)
-        mean_n_mf_updates = np.mean(val_n_mf_updates)
+            self._tf_session.run(self._val_metrics_update,
+                                 feed_dict=self._make_tf_feed_dict(X_vb))
+        results = self._fetch_metrics(self._val_metrics_map)
+        mean_msre, mean_n_mf_updates = results['msre'], results['n_mf_updates']
         s = summary_pb2.Summary(value=[
             summary_pb2.Summary.Value(tag='mean_squared_recon_error', simple_value=mean_msre),
             summary_pb2.Summary.Value(tag='n_mf_updates', simple_value=mean_n_mf_updates),
@@ -826,8 +896,16 @@ class DBM(EnergyBasedModel):
     def _fit(self, X, X_val=None, *args, **kwargs):
         # load ops requested
         self._train_op = tf.get_collection('train_op')[0]
-        self._msre = tf.get_collection('msre')[0]
-        self._n_mf_updates = tf.get_collection('n_mf_updates')[0]
+        metrics = {m: tf.get_collection(m)[0] for m in ('msre', 'n_mf_updates')}
+        self._train_metrics_update, self._train_metrics_reset, self._train_metrics_map = \
+            self._get_metrics_accumulator('train_metrics', metrics)
+        self._val_metrics_update, self._val_metrics_reset, self._val_metrics_map = \
+            self._get_metrics_accumulator('val_metrics', metrics)
+
+        # copy training data into the graph if needed
+        self._input_staged = False
+        if self.stage_input:
+            self._stage_input(X)
 
         # main loop
         val_msre, val_n_mf_updates = None, None
@@ -854,41 +932,79 @@ class DBM(EnergyBasedModel):
 
             # save if needed
             if self.save_after_each_epoch:
-                self._save_model(global_step=self.epoch_)
+                self._save_model_async(global_step=self.epoch_)
 
-    @run_in_tf_session()
-    def transform(self, X, np_dtype=None):
-        """Compute hidden units' (from last layer) activation probabilities."""
+    def _inference_size(self):
+        # input batch and reconstruction, mu, mu_new
+        # and temporaries of mean-field updates for each layer
+        return 2 * self.n_visible_ + 4 * sum(self.n_hiddens_)
+
+    def transform(self, X, np_dtype=None, batch_size=None, max_memory=None):
+        """Compute hidden units' (from last layer) activation probabilities.
+
+        If transform cache is set (see `set_transform_cache`),
+        the result is loaded from it when possible.
+
+        Parameters
+        ----------
+        batch_size : None or positive int
+            Number of examples per TF session call, not tied to the one
+            used for training. If None, use `batch_size` of the model.
+        max_memory : None or positive int
+            If given, choose the largest batch size for which intermediate
+            results fit into this many bytes (instead of `batch_size`).
+        """
         np_dtype = np_dtype or self._np_dtype
+        batch_size = self._inference_batch_size(batch_size, max_memory)
+        return self._cached_transform(partial(self._transform, batch_size=batch_size),
+                                      'transform', X, np_dtype)
 
+    @run_in_tf_session()
+    def _transform(self, X, np_dtype, batch_size):
         self._transform_op = tf.get_collection('transform_op')[0]
         G = np.zeros((len(X), self.n_hiddens_[-1]), dtype=np_dtype)
         start = 0
-        for X_b in batch_iter(X, batch_size=self.batch_size,
+        for X_b in batch_iter(X, batch_size=batch_size,
                               verbose=self.verbose, desc='transform'):
-            G_b = self._transform_op.eval(feed_dict=self._make_tf_feed_dict(X_b))
-            G[start:(start + self.batch_size)] = G_b
-            start += self.batch_size
+            G_b = self._transform_op.eval(feed_dict={'input_data/X_batch:0': X_b})
+            G[start:(start + len(X_b))] = G_b
+            start += len(X_b)
         return G
 
     @run_in_tf_session(update_seed=True)
-    def reconstruct(self, X):
-        """Compute p(v|h_0=q, h...)=p(v|h_0=q), where q=p(h_0|v=x)"""
+    def reconstruct(self, X, batch_size=None, max_memory=None):
+        """Compute p(v|h_0=q, h...)=p(v|h_0=q), where q=p(h_0|v=x)
+
+        See `transform` for `batch_size` and `max_memory`.
+        """
         self._reconstruction = tf.get_collection('reconstruction')[0]
-        X_recon = np.zeros_like(X)
+        X_recon = np.zeros((len(X), self.n_visible_), dtype=self._np_dtype)
         start = 0
-        for X_b in batch_iter(X, batch_size=self.batch_size,
+        for X_b in batch_iter(X, batch_size=self._inference_batch_size(batch_size, max_memory),
                               verbose=self.verbose, desc='reconstruction'):
-            X_recon_b = self._reconstruction.eval(feed_dict=self._make_tf_feed_dict(X_b))
-            X_recon[start:(start + self.batch_size)] = X_recon_b
-            start += self.batch_size
+            X_recon_b = self._reconstruction.eval(feed_dict={'input_data/X_batch:0': X_b})
+            X_recon[start:(start + len(X_b))] = X_recon_b
+            start += len(X_b)
         return X_recon
 
-    @run_in_tf_session(update_seed=True)
-    def sample_v(self, n_gibbs_steps=0, save_model=False):
+    def sample_v(self, n_gibbs_steps=0, save_model=False, n_particles=None):
         """Compute visible particle activation probabilities
         after `n_gibbs_steps` chain iterations.
+
+        If `n_particles` is given, run that many new chains instead,
+        started from the stored particles (cycling through them if needed),
+        which are left intact. These chains are run in the sampling graph
+        (see `sample`), which is not tied to the number of particles.
         """
+        if n_particles is None:
+            return self._sample_stored_v(n_gibbs_steps, save_model)
+        if save_model:
+            raise ValueError('`save_model` is supported only for the stored particles')
+        return self.sample(n_particles, n_gibbs_steps=1, burn_in=n_gibbs_steps,
+                           n_chains=n_particles, from_particles=True, means=True)
+
+    @run_in_tf_session(update_seed=True)
+    def _sample_stored_v(self, n_gibbs_steps, save_model):
         self._sample_v = tf.get_collection('sample_v')[0]
         v = self._sample_v.eval(feed_dict=self._make_tf_feed_dict(n_gibbs_steps=n_gibbs_steps))
         if save_model:
@@ -896,12 +1012,13 @@ class DBM(EnergyBasedModel):
             self._save_model()
         return v
 
-    @run_in_tf_session(update_seed=True)
-    def log_Z(self, n_betas=100, n_runs=100, n_gibbs_steps=5):
+    def log_Z(self, n_betas=100, n_runs=100, n_gibbs_steps=5,
+              n_jobs=1, runs_per_job=None, chunk_size=1000, tol=None):
         """Estimate log partition function using Annealed Importance Sampling.
-        Currently implemented only for 2-layer binary BM.
-        AIS is run on a state space x = {h_1} with v and h_2
-        analytically summed out, as in [1] and using formulae from [4].
+        AIS is run on a state space x = {h_1, h_3, ...} of odd layers, with
+        the even ones {v, h_2, ...} analytically summed out, as in [1]
+        and using formulae from [4] (generalized to any number of layers
+        and any types of units, see `BaseLayer.log_partition`).
         To obtain reasonable estimate, parameter `n_betas` should be at least 10000 or more.
 
         Parameters
@@ -912,6 +1029,18 @@ class DBM(EnergyBasedModel):
             Number of AIS runs.
         n_gibbs_steps : positive int
             Number of Gibbs steps per transition.
+        n_jobs : positive int
+            Number of processes to distribute AIS runs across.
+        runs_per_job : None or positive int
+            Number of AIS runs per job (with independent random seed).
+            If None, split `n_runs` evenly between `n_jobs`.
+        chunk_size : positive int
+            Number of transitions per TF session call.
+        tol : None or positive float
+            If not None, stop early once standard error of log(Z) estimate
+            falls below this value (checked after each completed job).
+            Unless `runs_per_job` is given, runs are then split into
+            10 jobs per process, so that it is checked along the way.
 
         Returns
         -------
@@ -919,41 +1048,32 @@ class DBM(EnergyBasedModel):
             `log_mean` = log(Z_mean)
             `log_low`  = log(Z_mean - std(Z))
             `log_high` = log(Z_mean + std(Z))
-        values : (`n_runs`,) np.ndarray
+        values : np.ndarray
             All estimates.
+
+        See Also
+        --------
+        EnergyBasedModel.iter_log_Z : yields estimates as jobs complete.
         """
-        assert self.n_layers_ == 2
-        for L in [self._v_layer] + self._h_layers:
-            assert isinstance(L, BernoulliLayer)
-
-        self._log_Z = tf.get_collection('log_Z')[0]
-        values = self._tf_session.run(self._log_Z,
-                                      feed_dict=self._make_tf_feed_dict(delta_beta=1./n_betas,
-                                                                        n_ais_runs=n_runs,
-                                                                        n_gibbs_steps=n_gibbs_steps))
-
-        log_mean = log_mean_exp(values)
-        log_std  = log_std_exp(values, log_mean_exp_x=log_mean)
-        log_high = log_sum_exp([log_std, log_mean])
-        log_low  = log_diff_exp([log_std, log_mean])[0]
-        return log_mean, (log_low, log_high), values
+        return super(DBM, self).log_Z(n_betas=n_betas, n_runs=n_runs, n_gibbs_steps=n_gibbs_steps,
+                                      n_jobs=n_jobs, runs_per_job=runs_per_job,
+                                      chunk_size=chunk_size, tol=tol)
 
     @run_in_tf_session()
-    def log_proba(self, X_test, log_Z):
-        """Estimate variational lower-bound on a test set, as in [5].
-        Currently implemented only for 2-layer binary BM.
-        """
-        assert self.n_layers_ == 2
-        for L in [self._v_layer] + self._h_layers:
-            assert isinstance(L, BernoulliLayer)
+    def log_proba(self, X_test, log_Z, batch_size=None, max_memory=None):
+        """Estimate variational lower-bound on a test set, as in [5]
+        (using mean-field approximate posterior for all hidden layers).
 
+        See `transform` for `batch_size` and `max_memory`.
+        """
         self._log_proba = tf.get_collection('log_proba')[0]
         P = np.zeros(len(X_test))
         start = 0
-        for X_b in batch_iter(X_test, batch_size=self.batch_size, verbose=self.verbose):
-            P_b = self._log_proba.eval(feed_dict=self._make_tf_feed_dict(X_b))
-            P[start:(start + self.batch_size)] = P_b
-            start += self.batch_size
+        for X_b in batch_iter(X_test, batch_size=self._inference_batch_size(batch_size, max_memory),
+                              verbose=self.verbose):
+            P_b = self._log_proba.eval(feed_dict={'input_data/X_batch:0': X_b})
+            P[start:(start + len(X_b))] = P_b
+            start += len(X_b)
         return P - log_Z
 
 
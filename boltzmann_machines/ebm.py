@@ -1,4 +1,47 @@
-from base import TensorFlowModel
+import numpy as np
+import tensorflow as tf
+from functools import partial
+
+from base import TensorFlowModel, run_in_tf_session
+from layers import stateless_bernoulli, stateless_gaussian, stateless_multinomial
+from parallel import imap_parallel
+from utils import (progress_bar, write_during_training,
+                   log_sum_exp, log_diff_exp, log_mean_exp, log_std_exp)
+
+
+def _ais_job_from_checkpoint(cls, model_path, *args):
+    """Load model from `model_path` and run AIS job (in a worker process)."""
+    model = cls.load_model(model_path)
+    return model._ais_job(*args)
+
+def ais_summary(values):
+    """Summarize AIS estimates `values` of log partition function.
+
+    Returns
+    -------
+    log_mean, (log_low, log_high) : float
+        `log_mean` = log(Z_mean)
+        `log_low`  = log(Z_mean - std(Z))
+        `log_high` = log(Z_mean + std(Z))
+    std_err : float
+        Standard error of `log_mean` (by the delta method),
+        std(Z) / (Z_mean * sqrt(n_runs)).
+
+    Examples
+    --------
+    >>> log_mean, (log_low, log_high), std_err = ais_summary(np.log([1., 3.]))
+    >>> np.exp([log_mean, log_low, log_high])
+    array([ 2.,  1.,  3.])
+    >>> std_err #doctest: +ELLIPSIS
+    0.35355...
+    """
+    values = np.asarray(values)
+    log_mean = log_mean_exp(values)
+    log_std  = log_std_exp(values, log_mean_exp_x=log_mean)
+    log_high = log_sum_exp([log_std, log_mean])
+    log_low  = log_diff_exp([log_std, log_mean])[0]
+    std_err = np.exp(log_std - log_mean) / np.sqrt(len(values))
+    return log_mean, (log_low, log_high), std_err
 
 
 class EnergyBasedModel(TensorFlowModel):
@@ -6,6 +49,40 @@ class EnergyBasedModel(TensorFlowModel):
     def __init__(self, *args, **kwargs):
         super(EnergyBasedModel, self).__init__(*args, **kwargs)
 
+        # tf AIS input data
+        self._delta_beta = None
+        self._ais_x = None
+        self._ais_log_w = None
+        self._ais_step = None
+        self._ais_n_steps = None
+        self._ais_seed = None
+        self._ais_n_runs = None
+        self._ais_n_gibbs_steps = None
+
+        # tf sampler input data
+        self._sampler_v_init = None
+        self._sampler_n_chains = None
+        self._sampler_seed = None
+        self._sampler_step = None
+        self._sampler_n_steps = None
+        self._sampler_n_records = None
+        self._sampler_means = None
+        self._sampler_from_particles = None
+
+    def _free_energies(self, v):
+        """
+        Compute free energy of each of visible vectors `v`.
+
+        Parameters
+        ----------
+        v : (batch_size, n_visible) tf.Tensor
+
+        Returns
+        -------
+        fe : (batch_size,) tf.Tensor
+        """
+        raise NotImplementedError('`free_energies` is not implemented')
+
     def _free_energy(self, v):
         """
         Compute (average) free energy of a visible vectors `v`.
@@ -14,4 +91,453 @@ class EnergyBasedModel(TensorFlowModel):
         ----------
         v : (batch_size, n_visible) tf.Tensor
         """
-        raise NotImplementedError('`free_energy` is not implemented')
+        return tf.reduce_mean(self._free_energies(v), axis=0)
+
+    def _make_ais_placeholders(self, n_state):
+        """Create placeholders for (a chunk of) AIS runs
+        on a state space of size `n_state`."""
+        with tf.name_scope('input_data/'):
+            self._delta_beta = tf.placeholder(self._tf_dtype, [], name='delta_beta')
+            self._ais_x = tf.placeholder(self._tf_dtype, [None, n_state], name='ais_x')
+            self._ais_log_w = tf.placeholder(self._tf_dtype, [None], name='ais_log_w')
+            self._ais_step = tf.placeholder(tf.int64, [], name='ais_step')
+            self._ais_n_steps = tf.placeholder(tf.int64, [], name='ais_n_steps')
+            self._ais_seed = tf.placeholder(tf.int64, [], name='ais_seed')
+            self._ais_n_runs = tf.placeholder(tf.int32, [], name='ais_n_runs')
+            self._ais_n_gibbs_steps = tf.placeholder(tf.int32, [], name='ais_n_gibbs_steps')
+
+    def _ais_seed_for(self, counter):
+        """Seed for stateless random op number `counter` (int64 tensor)."""
+        return tf.stack([self._ais_seed, tf.cast(counter, tf.int64)])
+
+    # Samplers below use stateless random ops, so that AIS is
+    # reproducible given `ais_seed` regardless of how it is split into chunks.
+    def _ais_sample_bernoulli(self, means, seed):
+        return stateless_bernoulli(means, seed, self._tf_dtype)
+
+    def _ais_sample_gaussian(self, means, seed, sigma=1.):
+        return stateless_gaussian(means, seed, self._tf_dtype, sigma=sigma)
+
+    def _ais_sample_multinomial(self, logits, n_samples, seed):
+        return stateless_multinomial(logits, n_samples, seed, self._tf_dtype)
+
+    def _unnormalized_log_prob_ais(self, x, beta):
+        """Compute log of unnormalized probability of AIS state `x`
+        for inverse temperature `beta`."""
+        raise NotImplementedError('`_unnormalized_log_prob_ais` is not implemented')
+
+    def _make_ais_transition(self, x, beta, step):
+        """Make AIS transition x' ~ T_beta(x'|x), using stateless random
+        ops with seeds derived from `step` (see `_ais_seed_for`)."""
+        raise NotImplementedError('`_make_ais_transition` is not implemented')
+
+    def _make_ais_base(self):
+        """Make `ais_n_runs` initial AIS states sampled from
+        the base-rate model (using `_ais_seed_for(-1)`) and log
+        partition function of the latter."""
+        raise NotImplementedError('`_make_ais_base` is not implemented')
+
+    def _make_ais(self, n_state):
+        """Make ops to sample initial AIS states, and to continue AIS
+        runs from states `ais_x` and log importance weights `ais_log_w`
+        for `ais_n_steps` transitions, starting from `ais_step`-th one
+        of a linear schedule with step `delta_beta`."""
+        self._make_ais_placeholders(n_state)
+        with tf.name_scope('annealed_importance_sampling'):
+            x_0, log_Z0 = self._make_ais_base()
+            stop = self._ais_step + self._ais_n_steps
+
+            def cond(step, log_w, x):
+                return step < stop
+
+            def body(step, log_w, x):
+                beta = tf.cast(step, dtype=self._tf_dtype) * self._delta_beta
+                beta_new = tf.minimum(beta + self._delta_beta, 1.)
+                # += log p_{k + 1}(x_k) - log p_k(x_k)
+                log_w += self._unnormalized_log_prob_ais(x, beta_new)
+                log_w -= self._unnormalized_log_prob_ais(x, beta)
+                # x_{k + 1} ~ T_{k + 1}(x_{k + 1} | x_k)
+                x_new = self._make_ais_transition(x, beta_new, step)
+                return step + 1, log_w, x_new
+
+            _, log_w, x = tf.while_loop(cond=cond, body=body,
+                                        loop_vars=[self._ais_step, self._ais_log_w, self._ais_x],
+                                        back_prop=False,
+                                        parallel_iterations=1)
+        tf.add_to_collection('ais_x0', x_0)
+        tf.add_to_collection('ais_log_Z0', log_Z0)
+        tf.add_to_collection('ais_log_w', log_w)
+        tf.add_to_collection('ais_x', x)
+
+    def _make_sampler_placeholders(self, n_visible):
+        with tf.name_scope('input_data/'):
+            self._sampler_v_init = tf.placeholder_with_default(
+                tf.zeros([0, n_visible], dtype=self._tf_dtype), [None, n_visible], name='sampler_v_init')
+            self._sampler_n_chains = tf.placeholder(tf.int32, [], name='sampler_n_chains')
+            self._sampler_seed = tf.placeholder(tf.int64, [], name='sampler_seed')
+            self._sampler_step = tf.placeholder(tf.int64, [], name='sampler_step')
+            self._sampler_n_steps = tf.placeholder(tf.int32, [], name='sampler_n_steps')
+            self._sampler_n_records = tf.placeholder(tf.int32, [], name='sampler_n_records')
+            self._sampler_means = tf.placeholder_with_default(False, [], name='sampler_means')
+            self._sampler_from_particles = tf.placeholder_with_default(False, [], name='sampler_from_particles')
+
+    def _sampler_seed_for(self, counter):
+        """Seed for stateless random op number `counter` of the sampler."""
+        return tf.stack([self._sampler_seed, tf.cast(counter, tf.int64)])
+
+    def _make_sampler_v_base(self):
+        """Make `sampler_n_chains` visible states sampled from the
+        base-rate model (using seeds `_sampler_seed_for(c)`, c < 0),
+        to start the chains from when no `sampler_v_init` is fed."""
+        raise NotImplementedError('`_make_sampler_v_base` is not implemented')
+
+    def _make_sampler_init(self, v):
+        """Make initial state of the chains (list of tensors)
+        given their visible states `v`."""
+        raise NotImplementedError('`_make_sampler_init` is not implemented')
+
+    def _make_sampler_particles(self, n_chains):
+        """Make initial state of `n_chains` chains from persistent
+        particles of the model, or return None if it keeps none."""
+        return None
+
+    def _make_sampler_step(self, state, step):
+        """Make one block Gibbs step of the chains in `state`,
+        using stateless random ops with seeds derived from `step`.
+
+        Returns
+        -------
+        state : list of tf.Tensor
+            New state of the chains.
+        v_states, v_means : tf.Tensor
+            Visible states and their means after this step.
+        """
+        raise NotImplementedError('`_make_sampler_step` is not implemented')
+
+    def _make_sampler(self, n_visible):
+        """Make ops to initialize a batch of `sampler_n_chains` Gibbs chains,
+        and to continue them from their last state (kept in local variables
+        of the session) recording `sampler_n_records` visible samples,
+        one per `sampler_n_steps` Gibbs steps, starting from `sampler_step`-th one."""
+        self._make_sampler_placeholders(n_visible)
+        with tf.name_scope('sampler'):
+            v_0 = tf.cond(tf.shape(self._sampler_v_init)[0] > 0,
+                          lambda: self._sampler_v_init,
+                          self._make_sampler_v_base)
+            state_0 = self._make_sampler_init(v_0)
+            particles = self._make_sampler_particles(tf.shape(v_0)[0])
+            if particles is not None:
+                state_0 = [tf.cond(self._sampler_from_particles, lambda p=p: p, lambda s=s: s)
+                           for p, s in zip(particles, state_0)]
+            else:
+                check = tf.Assert(tf.logical_not(self._sampler_from_particles),
+                                  ['model does not keep persistent particles'])
+                with tf.control_dependencies([check]):
+                    state_0 = [tf.identity(s) for s in state_0]
+            state_vars = [tf.Variable(tf.zeros([0, s.get_shape()[1]], dtype=s.dtype),
+                                      trainable=False, validate_shape=False,
+                                      collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                      name='chain_state') for s in state_0]
+            init_op = tf.group(*[tf.assign(var, s, validate_shape=False)
+                                 for var, s in zip(state_vars, state_0)])
+            state = []
+            for var, s in zip(state_vars, state_0):
+                t = tf.identity(var)
+                t.set_shape(s.get_shape())
+                state.append(t)
+
+            def run_steps(step_0, state):
+                def cond(j, v, v_means, *state):
+                    return j < self._sampler_n_steps
+
+                def body(j, v, v_means, *state):
+                    state, v, v_means = self._make_sampler_step(list(state), step_0 + tf.cast(j, tf.int64))
+                    return [j + 1, v, v_means] + state
+
+                v = tf.zeros(tf.stack([tf.shape(state[0])[0], n_visible]), dtype=self._tf_dtype)
+                v.set_shape([None, n_visible])
+                res = tf.while_loop(cond=cond, body=body,
+                                    loop_vars=[tf.constant(0), v, v] + state,
+                                    parallel_iterations=1,
+                                    back_prop=False)
+                return res[1], res[2], list(res[3:])
+
+            def cond(r, samples, *state):
+                return r < self._sampler_n_records
+
+            def body(r, samples, *state):
+                step_0 = self._sampler_step + tf.cast(r * self._sampler_n_steps, tf.int64)
+                v, v_means, state = run_steps(step_0, list(state))
+                samples = samples.write(r, tf.where(self._sampler_means, v_means, v))
+                return [r + 1, samples] + state
+
+            samples = tf.TensorArray(self._tf_dtype, size=self._sampler_n_records)
+            res = tf.while_loop(cond=cond, body=body,
+                                loop_vars=[tf.constant(0), samples] + state,
+                                parallel_iterations=1,
+                                back_prop=False)
+            updates = [tf.assign(var, s, validate_shape=False)
+                       for var, s in zip(state_vars, res[2:])]
+            with tf.control_dependencies(updates):
+                samples = tf.reshape(res[1].stack(), [-1, n_visible])
+        tf.add_to_collection('sampler_init_op', init_op)
+        tf.add_to_collection('sampler_samples', samples)
+
+    @run_in_tf_session()
+    def _run_sampler(self, d, init=False):
+        """Initialize the chains if `init`, otherwise continue them and return samples."""
+        feed_dict = {'input_data/{0}:0'.format(k): v for k, v in d.items()}
+        if init:
+            self._tf_session.run(tf.get_collection('sampler_init_op')[0], feed_dict=feed_dict)
+            return None
+        return self._tf_session.run(tf.get_collection('sampler_samples')[0], feed_dict=feed_dict)
+
+    def iter_samples(self, n_samples, n_gibbs_steps=1, burn_in=0, thin=1,
+                     n_chains=100, v_init=None, from_particles=False, means=False,
+                     random_seed=None, chunk_size=100):
+        """Draw samples from the model by running a batch of `n_chains`
+        block Gibbs chains in parallel, and yield them in chunks.
+
+        Each chain makes `burn_in` transitions (of `n_gibbs_steps` Gibbs
+        steps each) first, and then its visible units are recorded after
+        every `thin` transitions. Chains are kept in the TF session between
+        chunks, and use stateless random ops, so that the samples depend only
+        on `random_seed` (and not on `chunk_size`). The batch size of the
+        sampling graph is not fixed, so any number of chains can be run
+        in the same graph (e.g. kept alive by `open_session`).
+
+        Parameters
+        ----------
+        n_samples : positive int
+            Total number of samples.
+        n_gibbs_steps : positive int
+            Number of Gibbs steps per transition.
+        burn_in : non-negative int
+            Number of transitions before the first sample.
+        thin : positive int
+            Number of transitions between successive samples of a chain.
+        n_chains : positive int
+            Number of chains (ignored if `v_init` is given).
+        v_init : None or (n_chains, n_visible) array-like
+            Initial visible states of the chains. If None, start
+            from the samples of the base-rate model.
+        from_particles : bool
+            Whether to start the chains from persistent particles of the
+            model (e.g. DBM), cycling through them if there are fewer
+            of them than `n_chains`.
+        means : bool
+            Whether to record means of visible units given
+            the rest of the state, instead of their states.
+        random_seed : None or int
+            If None, use `make_random_seed`.
+        chunk_size : positive int
+            Number of samples recorded from each chain
+            per TF session call (and per yielded chunk).
+
+        Yields
+        ------
+        samples : (n_records * n_chains, n_visible) np.ndarray
+            Samples of all the chains after each of `n_records` (<= `chunk_size`)
+            successive transitions, i.e. ordered by time and then by chain.
+        """
+        if random_seed is None:
+            random_seed = self.make_random_seed()
+        d = {'sampler_seed': random_seed}
+        if v_init is not None:
+            v_init = np.asarray(v_init, dtype=self._np_dtype)
+            d['sampler_v_init'] = v_init
+            n_chains = len(v_init)
+        d['sampler_n_chains'] = n_chains
+        d['sampler_from_particles'] = from_particles
+
+        with self._kept_session():
+            self._run_sampler(d, init=True)
+            step = 0
+            if burn_in > 0:
+                d.update(sampler_step=step, sampler_n_steps=burn_in * n_gibbs_steps,
+                         sampler_n_records=1)
+                self._run_sampler(d)
+                step += burn_in * n_gibbs_steps
+            d['sampler_means'] = means
+            n_records = -(-n_samples // n_chains)
+            for start in xrange(0, n_records, chunk_size):
+                n = min(chunk_size, n_records - start)
+                d.update(sampler_step=step, sampler_n_steps=thin * n_gibbs_steps,
+                         sampler_n_records=n)
+                samples = self._run_sampler(d)
+                step += n * thin * n_gibbs_steps
+                yield samples[:(n_samples - start * n_chains)]
+
+    def sample(self, n_samples, n_gibbs_steps=1, burn_in=0, thin=1,
+               n_chains=100, v_init=None, from_particles=False, means=False,
+               random_seed=None, chunk_size=100, out=None):
+        """Draw `n_samples` samples from the model using block Gibbs sampling,
+        writing them to `out` as they are generated.
+
+        Parameters
+        ----------
+        n_samples, n_gibbs_steps, burn_in, thin, n_chains, v_init, from_particles,
+        means, random_seed, chunk_size
+            See `iter_samples`.
+        out : None, str or (n_samples, n_visible) np.ndarray
+            Where to write the samples. If str, they are written to a
+            memory-mapped .npy file with this path, so that they do not
+            need to fit into memory.
+
+        Returns
+        -------
+        samples : (n_samples, n_visible) np.ndarray or np.memmap
+        """
+        it = self.iter_samples(n_samples, n_gibbs_steps=n_gibbs_steps, burn_in=burn_in,
+                               thin=thin, n_chains=n_chains, v_init=v_init,
+                               from_particles=from_particles, means=means,
+                               random_seed=random_seed, chunk_size=chunk_size)
+        start = 0
+        for samples in it:
+            if out is None or isinstance(out, basestring):
+                shape = (n_samples, samples.shape[1])
+                if out is None:
+                    out = np.zeros(shape, dtype=samples.dtype)
+                else:
+                    out = np.lib.format.open_memmap(out, mode='w+', dtype=samples.dtype, shape=shape)
+            out[start:(start + len(samples))] = samples
+            start += len(samples)
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    @run_in_tf_session()
+    def _ais_job(self, random_seed, n_runs, n_betas, n_gibbs_steps, chunk_size, verbose=False):
+        """Run `n_runs` AIS runs with `n_betas` intermediate distributions,
+        in chunks of `chunk_size` transitions. Return their estimates of log(Z)."""
+        if not tf.get_collection('ais_x0'):
+            return self._run_legacy_ais(n_runs, n_betas, n_gibbs_steps)
+        ais_x0 = tf.get_collection('ais_x0')[0]
+        ais_log_Z0 = tf.get_collection('ais_log_Z0')[0]
+        ais_log_w = tf.get_collection('ais_log_w')[0]
+        ais_x = tf.get_collection('ais_x')[0]
+
+        feed_dict = {'input_data/ais_seed:0': random_seed,
+                     'input_data/ais_n_runs:0': n_runs}
+        x, log_Z0 = self._tf_session.run([ais_x0, ais_log_Z0], feed_dict=feed_dict)
+        log_w = np.zeros(n_runs, dtype=self._np_dtype)
+        pbar = progress_bar(total=n_betas, leave=False, ncols=64, desc='ais') if verbose else None
+        for step in xrange(0, n_betas, chunk_size):
+            n_steps = min(chunk_size, n_betas - step)
+            d = {'delta_beta': 1. / n_betas,
+                 'ais_x': x,
+                 'ais_log_w': log_w,
+                 'ais_step': step,
+                 'ais_n_steps': n_steps,
+                 'ais_seed': random_seed,
+                 'ais_n_gibbs_steps': n_gibbs_steps}
+            feed_dict = {'input_data/{0}:0'.format(k): v for k, v in d.items()}
+            log_w, x = self._tf_session.run([ais_log_w, ais_x], feed_dict=feed_dict)
+            if pbar is not None:
+                pbar.update(n_steps)
+        if pbar is not None:
+            pbar.close()
+        return log_w + log_Z0
+
+    def _run_legacy_ais(self, n_runs, n_betas, n_gibbs_steps):
+        """`_ais_job` for graphs restored from checkpoints that predate
+        chunked AIS, and only have op running all the transitions at once
+        ('log_Z' collection), seeded by the graph-level random seed."""
+        log_Z = tf.get_collection('log_Z')
+        if not log_Z:
+            raise RuntimeError("graph restored from checkpoint has no AIS ops, "
+                               "initialize the model anew to estimate log(Z)")
+        d = {'delta_beta': 1. / n_betas,
+             'n_ais_runs': n_runs,
+             'n_gibbs_steps': n_gibbs_steps}
+        feed_dict = {'input_data/{0}:0'.format(k): v for k, v in d.items()}
+        return self._tf_session.run(log_Z[0], feed_dict=feed_dict)
+
+    def iter_log_Z(self, n_betas=100, n_runs=100, n_gibbs_steps=5,
+                   n_jobs=1, runs_per_job=None, chunk_size=1000):
+        """Estimate log partition function using Annealed Importance Sampling,
+        yielding the estimate after each completed job (batch of runs).
+
+        Runs are split into jobs with independent random seeds, that are
+        distributed across `n_jobs` worker processes (see `imap_parallel`),
+        which load the model from its last saved checkpoint, and each job runs
+        the schedule of inverse temperatures in chunks of `chunk_size` transitions.
+
+        Parameters
+        ----------
+        n_betas : >1 int
+            Number of intermediate distributions.
+        n_runs : positive int
+            Number of AIS runs.
+        n_gibbs_steps : positive int
+            Number of Gibbs steps per transition.
+        n_jobs : positive int
+            Number of worker processes. If 1, run all the jobs
+            in the current process.
+        runs_per_job : None or positive int
+            Number of AIS runs per job. If None, split `n_runs`
+            evenly between `n_jobs`.
+        chunk_size : positive int
+            Number of transitions per TF session call.
+
+        Yields
+        ------
+        log_mean, (log_low, log_high), std_err : float
+            Current estimates, see `ais_summary`.
+        values : np.ndarray
+            All estimates obtained so far.
+        """
+        runs_per_job = runs_per_job or -(-n_runs // n_jobs)
+        jobs = []
+        for start in xrange(0, n_runs, runs_per_job):
+            args = (self.make_random_seed(), min(runs_per_job, n_runs - start),
+                    n_betas, n_gibbs_steps, chunk_size)
+            if n_jobs > 1:
+                jobs.append(partial(_ais_job_from_checkpoint, self.__class__,
+                                    self._model_filepath, *args))
+            else:
+                jobs.append(partial(self._ais_job, *args, verbose=self.verbose))
+
+        values = np.zeros(0)
+        for _, job_values in imap_parallel(jobs, n_jobs=n_jobs):
+            values = np.concatenate((values, job_values))
+            yield ais_summary(values), values
+
+    def log_Z(self, n_betas=100, n_runs=100, n_gibbs_steps=5,
+              n_jobs=1, runs_per_job=None, chunk_size=1000, tol=None):
+        """Estimate log partition function using Annealed Importance Sampling.
+
+        Parameters
+        ----------
+        n_betas, n_runs, n_gibbs_steps, n_jobs, runs_per_job, chunk_size
+            See `iter_log_Z`.
+        tol : None or positive float
+            If not None, stop once standard error of the estimate of log(Z)
+            falls below this value (checked after each completed job).
+            Unless `runs_per_job` is given, runs are then split into
+            10 jobs per process, so that it is checked along the way.
+
+        Returns
+        -------
+        log_mean, (log_low, log_high) : float
+            `log_mean` = log(Z_mean)
+            `log_low`  = log(Z_mean - std(Z))
+            `log_high` = log(Z_mean + std(Z))
+        values : np.ndarray
+            All estimates.
+        """
+        if tol is not None and runs_per_job is None:
+            runs_per_job = max(-(-n_runs // (10 * n_jobs)), 2)
+        it = self.iter_log_Z(n_betas=n_betas, n_runs=n_runs, n_gibbs_steps=n_gibbs_steps,
+                             n_jobs=n_jobs, runs_per_job=runs_per_job, chunk_size=chunk_size)
+        try:
+            for (log_mean, log_band, std_err), values in it:
+                if self.verbose:
+                    s = "AIS: {0}/{1} runs; log(Z) = {2:.4f} in ({3:.4f}, {4:.4f}); std. err. {5:.4f}"
+                    write_during_training(s.format(len(values), n_runs, log_mean,
+                                                   log_band[0], log_band[1], std_err))
+                if tol is not None and len(values) > 1 and std_err < tol:
+                    break
+        finally:
+            it.close()
+        return log_mean, log_band, values
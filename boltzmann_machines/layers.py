@@ -1,10 +1,33 @@
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.distributions import Bernoulli, Multinomial, Normal
+from tensorflow.contrib.stateless import stateless_random_uniform, stateless_random_normal
 
 from base import DtypeMixin
 
 
+# Samplers below use stateless random ops (with `seed` being (2,) int64 tensor),
+# so that e.g. AIS is reproducible regardless of how it is split into chunks.
+def stateless_bernoulli(means, seed, dtype):
+    u = stateless_random_uniform(tf.shape(means), seed=seed, dtype=dtype)
+    return tf.cast(u < means, dtype=dtype)
+
+def stateless_gaussian(means, seed, dtype, sigma=1.):
+    t = stateless_random_normal(tf.shape(means), seed=seed, dtype=dtype)
+    return means + sigma * t
+
+def stateless_multinomial(logits, n_samples, seed, dtype):
+    """Counts of `n_samples` draws from categorical distributions
+    given by (unnormalized) `logits` (using Gumbel-max trick)."""
+    n_categories = tf.shape(logits)[1]
+    shape = tf.stack([tf.shape(logits)[0], n_samples, n_categories])
+    u = stateless_random_uniform(shape, seed=seed, dtype=dtype)
+    ind = tf.argmax(tf.expand_dims(logits, 1) - tf.log(-tf.log(u)), axis=2)
+    counts = tf.reduce_sum(tf.one_hot(ind, n_categories, dtype=dtype), axis=1)
+    counts.set_shape(logits.get_shape())
+    return counts
+
+
 class BaseLayer(DtypeMixin):
     """Class encapsulating one layer of stochastic units."""
     def __init__(self, n_units, *args, **kwargs):
@@ -35,6 +58,55 @@ class BaseLayer(DtypeMixin):
         T = self._sample(means).sample()
         return tf.cast(T, dtype=self._tf_dtype)
 
+    # Methods below describe the contribution of the layer to the energy
+    # function (scaled by inverse temperature `beta`), which is used to
+    # evaluate models analytically summing out some of the layers (e.g. AIS).
+    # Gaussian units `s` interact with adjacent layers through `s / sigma`.
+    def scale(self, s):
+        """Scale states `s` before propagating them to adjacent layers."""
+        return s
+
+    def log_partition(self, x, b, beta=1.):
+        """Compute log of sum (or integral) of unnormalized probabilities
+        over the states of the layer (= to sum the layer out).
+
+        Parameters
+        ----------
+        x : (batch_size, n_units) tf.Tensor
+            Total input received (excluding bias).
+        b : (n_units,) tf.Tensor
+            Bias.
+        beta : float or tf.Tensor
+            Inverse temperature.
+
+        Returns
+        -------
+        (batch_size,) tf.Tensor
+        """
+        raise NotImplementedError('`log_partition` is not implemented')
+
+    def log_prob_states(self, s, b, beta=1.):
+        """Compute terms of the log of unnormalized probability that depend
+        only on the states `s` of the layer, (batch_size,) tf.Tensor."""
+        raise NotImplementedError('`log_prob_states` is not implemented')
+
+    def sample_stateless(self, x, b, seed, beta=1.):
+        """Sample states given total input `x` using stateless random ops."""
+        raise NotImplementedError('`sample_stateless` is not implemented')
+
+    def base_log_Z(self, b):
+        """Log partition function of the layer for `beta` = 0 (float)."""
+        raise NotImplementedError('`base_log_Z` is not implemented')
+
+    def sample_base_stateless(self, b, batch_size, seed):
+        """Sample states for `beta` = 0 using stateless random ops."""
+        raise NotImplementedError('`sample_base_stateless` is not implemented')
+
+    def mean_field_terms(self, means, b):
+        """Compute expectation of `log_prob_states` plus entropy w.r.t. factorial
+        distribution of states with `means` (for variational lower-bound)."""
+        raise NotImplementedError('`mean_field_terms` is not implemented')
+
 
 class BernoulliLayer(BaseLayer):
     def __init__(self, *args, **kwargs):
@@ -50,6 +122,28 @@ class BernoulliLayer(BaseLayer):
     def _sample(self, means):
         return Bernoulli(probs=means)
 
+    def log_partition(self, x, b, beta=1.):
+        return tf.reduce_sum(tf.nn.softplus(beta * (x + b)), axis=1)
+
+    def log_prob_states(self, s, b, beta=1.):
+        return beta * tf.einsum('ij,j->i', s, b)
+
+    def sample_stateless(self, x, b, seed, beta=1.):
+        means = self.activation(beta * x, beta * b)
+        return stateless_bernoulli(means, seed, self._tf_dtype)
+
+    def base_log_Z(self, b):
+        return self.n_units * np.log(2.)
+
+    def sample_base_stateless(self, b, batch_size, seed):
+        means = 0.5 * tf.ones(tf.stack([batch_size, self.n_units]), dtype=self._tf_dtype)
+        return stateless_bernoulli(means, seed, self._tf_dtype)
+
+    def mean_field_terms(self, means, b):
+        s = tf.clip_by_value(means, 1e-7, 1. - 1e-7)
+        S = -s * tf.log(s) - (1. - s) * tf.log(1. - s)
+        return tf.einsum('ij,j->i', means, b) + tf.reduce_sum(S, axis=1)
+
 
 class MultinomialLayer(BaseLayer):
     def __init__(self, n_samples=100, *args, **kwargs):
@@ -69,6 +163,30 @@ class MultinomialLayer(BaseLayer):
         probs = tf.to_float(means / tf.reduce_sum(means))
         return Multinomial(total_count=self.n_samples, probs=probs)
 
+    def log_partition(self, x, b, beta=1.):
+        return self.n_samples * tf.reduce_logsumexp(beta * (x + b), axis=1)
+
+    def log_prob_states(self, s, b, beta=1.):
+        # multinomial coefficient accounts for all the orderings of samples
+        log_c = tf.lgamma(self.n_samples + 1.) - tf.reduce_sum(tf.lgamma(s + 1.), axis=1)
+        return beta * tf.einsum('ij,j->i', s, b) + log_c
+
+    def sample_stateless(self, x, b, seed, beta=1.):
+        return stateless_multinomial(beta * (x + b), int(self.n_samples), seed, self._tf_dtype)
+
+    def base_log_Z(self, b):
+        return self.n_samples * np.log(self.n_units)
+
+    def sample_base_stateless(self, b, batch_size, seed):
+        logits = tf.zeros(tf.stack([batch_size, self.n_units]), dtype=self._tf_dtype)
+        return stateless_multinomial(logits, int(self.n_samples), seed, self._tf_dtype)
+
+    def mean_field_terms(self, means, b):
+        # `n_samples` independent categorical units with probs `means / n_samples`
+        p = tf.clip_by_value(means / self.n_samples, 1e-7, 1.)
+        S = -self.n_samples * tf.reduce_sum(p * tf.log(p), axis=1)
+        return tf.einsum('ij,j->i', means, b) + S
+
 
 class GaussianLayer(BaseLayer):
     def __init__(self, sigma, *args, **kwargs):
@@ -87,3 +205,36 @@ class GaussianLayer(BaseLayer):
 
     def _sample(self, means):
         return Normal(loc=means, scale=tf.cast(self.sigma, dtype=self._tf_dtype))
+
+    def _sigma(self):
+        sigma = np.broadcast_to(self.sigma, (self.n_units,))
+        return tf.constant(sigma, dtype=self._tf_dtype)
+
+    def scale(self, s):
+        return s / self._sigma()
+
+    def log_partition(self, x, b, beta=1.):
+        sigma = self._sigma()
+        t = beta * x
+        T = b * t / sigma + 0.5 * tf.square(t)
+        return tf.reduce_sum(T, axis=1) + self.base_log_Z(b)
+
+    def log_prob_states(self, s, b, beta=1.):
+        T = tf.square(s - b) / (2. * tf.square(self._sigma()))
+        return -tf.reduce_sum(T, axis=1)
+
+    def sample_stateless(self, x, b, seed, beta=1.):
+        means = self.activation(beta * x, b)
+        return stateless_gaussian(means, seed, self._tf_dtype, sigma=self._sigma())
+
+    def base_log_Z(self, b):
+        sigma = np.broadcast_to(self.sigma, (self.n_units,))
+        return np.sum(np.log(sigma)) + 0.5 * self.n_units * np.log(2. * np.pi)
+
+    def sample_base_stateless(self, b, batch_size, seed):
+        means = b * tf.ones(tf.stack([batch_size, self.n_units]), dtype=self._tf_dtype)
+        return stateless_gaussian(means, seed, self._tf_dtype, sigma=self._sigma())
+
+    def mean_field_terms(self, means, b):
+        # states ~ N(means, sigma^2)
+        return self.log_prob_states(means, b) + self.base_log_Z(b)
@@ -0,0 +1,454 @@
+import json
+import heapq
+import numpy as np
+
+
+__all__ = ['NumpyLayer', 'NumpyRBM', 'NumpyDBM', 'top_k_indices']
+
+
+def _sigmoid(x):
+    """In-place logistic sigmoid."""
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1.
+    np.reciprocal(x, out=x)
+    return x
+
+def _softmax(x):
+    """In-place row-wise softmax."""
+    x -= x.max(axis=1)[:, np.newaxis]
+    np.exp(x, out=x)
+    x /= x.sum(axis=1)[:, np.newaxis]
+    return x
+
+def top_k_indices(batches, k):
+    """Find indices of `k` largest values given in consecutive batches,
+    keeping at most `k` of them in a bounded min-heap, so that all the
+    values never have to be held in memory.
+
+    Parameters
+    ----------
+    batches : iterable of 1D array-like
+    k : positive int
+
+    Returns
+    -------
+    ind : (min(k, n_values),) np.ndarray
+        Indices (within concatenation of the batches) of the largest values,
+        in decreasing order of values.
+
+    Examples
+    --------
+    >>> top_k_indices([[3., 1., 4.], [1., 5.], [9., 2., 6.]], k=3)
+    array([5, 7, 4])
+    >>> top_k_indices(iter([[3., 1.]]), k=5)
+    array([0, 1])
+    """
+    heap = []  # of (value, index) pairs
+    start = 0
+    for values in batches:
+        values = np.asarray(values).ravel()
+        # only k largest values of the batch might get into the heap
+        ind = np.argpartition(values, -k)[-k:] if len(values) > k else np.arange(len(values))
+        for i in ind:
+            item = (values[i], start + i)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        start += len(values)
+    return np.array([i for _, i in sorted(heap, reverse=True)], dtype=np.int64)
+
+
+class NumpyLayer(object):
+    """NumPy counterpart of the layers from `boltzmann_machines.layers`,
+    that only computes activations (means) of the units.
+
+    Parameters
+    ----------
+    name : {'BernoulliLayer', 'MultinomialLayer', 'GaussianLayer'}
+        Name of the respective TF layer class.
+    params : dict
+        Parameters of the layer (`n_samples` or `sigma`).
+    """
+    def __init__(self, name, params=None):
+        self.name = name
+        self.params = params or {}
+
+    @classmethod
+    def from_layer(cls, layer):
+        name = layer.__class__.__name__
+        params = {}
+        if name == 'MultinomialLayer':
+            params['n_samples'] = layer.n_samples
+        elif name == 'GaussianLayer':
+            params['sigma'] = np.asarray(layer.sigma).tolist()
+        elif name != 'BernoulliLayer':
+            raise ValueError("layer `{0}` is not supported".format(name))
+        return cls(name, params)
+
+    def activation(self, x, b):
+        """Compute activations in-place.
+
+        Parameters
+        ----------
+        x : (batch_size, n_units) np.ndarray
+            Total input received (excluding bias), overwritten with the result.
+        b : (n_units,) np.ndarray
+            Bias.
+        """
+        if self.name == 'GaussianLayer':
+            x *= np.asarray(self.params['sigma'], dtype=x.dtype)
+            x += b
+            return x
+        x += b
+        if self.name == 'BernoulliLayer':
+            return _sigmoid(x)
+        x = _softmax(x)
+        x *= self.params['n_samples']
+        return x
+
+    def log_partition(self, x, b):
+        """Compute log of sum of unnormalized probabilities over the
+        states of the layer (= to sum the layer out), in-place.
+
+        Parameters
+        ----------
+        x : (batch_size, n_units) np.ndarray
+            Total input received (excluding bias), overwritten.
+        b : (n_units,) np.ndarray
+            Bias.
+
+        Returns
+        -------
+        log_Z : (batch_size,) np.ndarray
+        """
+        x += b
+        if self.name == 'BernoulliLayer':
+            return np.logaddexp(0., x, out=x).sum(axis=1)
+        if self.name == 'MultinomialLayer':
+            m = x.max(axis=1)
+            x -= m[:, np.newaxis]
+            np.exp(x, out=x)
+            return self.params['n_samples'] * (m + np.log(x.sum(axis=1)))
+        raise ValueError("summing out `{0}` is not supported".format(self.name))
+
+
+class NumpyRBM(object):
+    """TensorFlow-free inference for trained RBM.
+
+    Computes E(h|v) and free energies in batches using preallocated buffers.
+    Note that `transform` returns E(h|v) of the data itself, i.e. the same
+    as `BaseRBM.transform` with no Gibbs steps and no dropout, while the
+    latter returns hidden means at the end of Gibbs chain of `n_gibbs_steps`.
+
+    Parameters
+    ----------
+    W : (n_visible, n_hidden) np.ndarray
+    vb : (n_visible,) np.ndarray
+    hb : (n_hidden,) np.ndarray
+    v_layer, h_layer : NumpyLayer
+    propup_multiplier : float
+        2. for the first RBM in a stack used for DBM pre-training, 1. otherwise.
+    batch_size : positive int
+    dtype : str
+
+    Examples
+    --------
+    >>> W = np.array([[1., -1.], [0., 2.], [-1., 1.]])
+    >>> rbm = NumpyRBM(W, np.zeros(3), np.array([0., -1.]),
+    ...                NumpyLayer('BernoulliLayer'), NumpyLayer('BernoulliLayer'),
+    ...                batch_size=2)
+    >>> X = np.array([[1., 0., 0.], [0., 1., 1.], [1., 1., 1.]])
+    >>> np.allclose(rbm.transform(X), 1. / (1. + np.exp(-(X.dot(W) + [0., -1.]))))
+    True
+    >>> np.allclose(rbm.free_energy(X), -np.logaddexp(0., X.dot(W) + [0., -1.]).sum(axis=1))
+    True
+    >>> rbm.score_samples(X, top_k=2)
+    array([0, 2])
+    """
+    def __init__(self, W, vb, hb, v_layer, h_layer, propup_multiplier=1.,
+                 batch_size=1024, dtype='float32'):
+        self.dtype = dtype
+        self.W = np.ascontiguousarray(W, dtype=self.dtype)
+        self.vb = np.asarray(vb, dtype=self.dtype)
+        self.hb = np.asarray(hb, dtype=self.dtype)
+        self.n_visible, self.n_hidden = self.W.shape
+        self.v_layer = v_layer
+        self.h_layer = h_layer
+        self.propup_multiplier = propup_multiplier
+        self.batch_size = batch_size
+
+        # GaussianRBM divides input by resp. sigmas before any operation
+        self._v_scale = None
+        if self.v_layer.name == 'GaussianLayer':
+            sigma = np.asarray(self.v_layer.params['sigma'], dtype=self.dtype)
+            self._v_scale = np.ones(self.n_visible, dtype=self.dtype) / sigma
+        self._H = None
+
+    @classmethod
+    def from_model(cls, rbm, **kwargs):
+        """Create from trained `BaseRBM` instance."""
+        weights = rbm.get_tf_params(scope='weights')
+        kwargs.setdefault('dtype', rbm.dtype)
+        return cls(W=weights['W'], vb=weights['vb'], hb=weights['hb'],
+                   v_layer=NumpyLayer.from_layer(rbm._v_layer),
+                   h_layer=NumpyLayer.from_layer(rbm._h_layer),
+                   propup_multiplier=2. if rbm.dbm_first else 1., **kwargs)
+
+    def _means_h_given_v(self, X_b):
+        n = len(X_b)
+        if self._v_scale is not None:
+            X_b = X_b * self._v_scale
+        H = self._H[:n]
+        np.dot(X_b, self.W, out=H)
+        H *= self.propup_multiplier
+        return self.h_layer.activation(H, self.propup_multiplier * self.hb)
+
+    def transform(self, X):
+        """Compute hidden units' activation probabilities."""
+        if self._H is None or len(self._H) != self.batch_size:
+            self._H = np.empty((self.batch_size, self.n_hidden), dtype=self.dtype)
+        H = np.empty((len(X), self.n_hidden), dtype=self.dtype)
+        for start in xrange(0, len(X), self.batch_size):
+            X_b = np.asarray(X[start:(start + self.batch_size)], dtype=self.dtype)
+            H[start:(start + len(X_b))] = self._means_h_given_v(X_b)
+        if self.h_layer.name == 'MultinomialLayer':
+            H /= self.h_layer.params['n_samples']
+        return H
+
+    def _free_energies(self, X_b):
+        n = len(X_b)
+        if self._v_scale is not None:
+            X_b = X_b * self._v_scale
+            T = X_b - self.vb * self._v_scale
+            F = 0.5 * np.einsum('ij,ij->i', T, T)
+        else:
+            F = -X_b.dot(self.vb)
+        H = self._H[:n]
+        np.dot(X_b, self.W, out=H)
+        F -= self.h_layer.log_partition(H, self.hb)
+        return F
+
+    def iter_free_energy(self, X):
+        """Compute free energies of samples of `X` (e.g. memory-mapped),
+        and yield them batch by batch."""
+        if self._H is None or len(self._H) != self.batch_size:
+            self._H = np.empty((self.batch_size, self.n_hidden), dtype=self.dtype)
+        for start in xrange(0, len(X), self.batch_size):
+            X_b = np.asarray(X[start:(start + self.batch_size)], dtype=self.dtype)
+            yield self._free_energies(X_b)
+
+    def free_energy(self, X):
+        """Compute free energy of each sample of `X`."""
+        F = np.empty(len(X), dtype=self.dtype)
+        start = 0
+        for F_b in self.iter_free_energy(X):
+            F[start:(start + len(F_b))] = F_b
+            start += len(F_b)
+        return F
+
+    def score_samples(self, X, top_k=None):
+        """Compute unnormalized log-probabilities -F(v) of samples of `X`
+        (lower for anomalies), or if `top_k` is given, indices of `top_k`
+        samples with the lowest ones (from the most anomalous sample)."""
+        if top_k is not None:
+            return top_k_indices(self.iter_free_energy(X), top_k)
+        return -self.free_energy(X)
+
+    def save(self, filepath):
+        _save(filepath, self, arrays=dict(W=self.W, vb=self.vb, hb=self.hb),
+              config=dict(v_layer=[self.v_layer.name, self.v_layer.params],
+                          h_layer=[self.h_layer.name, self.h_layer.params],
+                          propup_multiplier=self.propup_multiplier))
+
+    @classmethod
+    def load(cls, filepath, **kwargs):
+        arrays, config = _load(filepath, cls)
+        return cls(W=arrays['W'], vb=arrays['vb'], hb=arrays['hb'],
+                   v_layer=NumpyLayer(*config['v_layer']),
+                   h_layer=NumpyLayer(*config['h_layer']),
+                   propup_multiplier=config['propup_multiplier'], **kwargs)
+
+
+class NumpyDBM(object):
+    """TensorFlow-free inference for trained DBM.
+
+    Runs the same mean-field updates as `DBM`: variational parameters are
+    initialized using approximate inference with doubled bottom-up input
+    (except for the last layer) and updated until the maximum change
+    falls below `mf_tol` or `max_mf_updates` is reached.
+
+    Parameters
+    ----------
+    W : [(n_visible, n_hiddens[0]), ...] list of np.ndarray
+    vb : (n_visible,) np.ndarray
+    hb : [(n_hiddens[0],), ...] list of np.ndarray
+    v_layer : NumpyLayer
+    h_layers : [NumpyLayer]
+    max_mf_updates : positive int
+    mf_tol : positive float
+    batch_size : positive int
+    dtype : str
+
+    Examples
+    --------
+    >>> rng = np.random.RandomState(1337)
+    >>> W = [rng.randn(6, 4), rng.randn(4, 3)]
+    >>> dbm = NumpyDBM(W, np.zeros(6), [np.zeros(4), np.zeros(3)],
+    ...                NumpyLayer('BernoulliLayer'), [NumpyLayer('BernoulliLayer')] * 2,
+    ...                max_mf_updates=100, mf_tol=1e-6, batch_size=4)
+    >>> X = rng.rand(10, 6)
+    >>> G = dbm.transform(X)
+    >>> G.shape
+    (10, 3)
+    >>> Q = dbm.mean_field(X)[0]
+    >>> np.allclose(G, 1. / (1. + np.exp(-Q.dot(W[1]))), atol=1e-5)
+    True
+    >>> dbm.reconstruct(X).shape
+    (10, 6)
+    """
+    def __init__(self, W, vb, hb, v_layer, h_layers,
+                 max_mf_updates=10, mf_tol=1e-7, batch_size=1024, dtype='float32'):
+        self.dtype = dtype
+        self.W = [np.ascontiguousarray(W_i, dtype=self.dtype) for W_i in W]
+        self.W_T = [np.ascontiguousarray(W_i.T) for W_i in self.W]
+        self.vb = np.asarray(vb, dtype=self.dtype)
+        self.hb = [np.asarray(hb_i, dtype=self.dtype) for hb_i in hb]
+        self.n_layers = len(self.W)
+        self.n_visible = self.W[0].shape[0]
+        self.n_hiddens = [W_i.shape[1] for W_i in self.W]
+        self.v_layer = v_layer
+        self.h_layers = h_layers
+        self.max_mf_updates = max_mf_updates
+        self.mf_tol = mf_tol
+        self.batch_size = batch_size
+        self._mu = None
+        self._mu_new = None
+        self._T = None
+
+    @classmethod
+    def from_model(cls, dbm, **kwargs):
+        """Create from trained `DBM` instance (with RBMs loaded,
+        if it was loaded from disk)."""
+        if not hasattr(dbm, '_v_layer'):
+            raise RuntimeError('`load_rbms` must be called before exporting DBM')
+        weights = dbm.get_tf_params(scope='weights')
+        suffix = lambda i: '_{0}'.format(i) if i else ''
+        kwargs.setdefault('max_mf_updates', dbm.max_mf_updates)
+        kwargs.setdefault('mf_tol', dbm.mf_tol)
+        kwargs.setdefault('dtype', dbm.dtype)
+        return cls(W=[weights['W' + suffix(i)] for i in xrange(dbm.n_layers_)],
+                   vb=weights['vb'],
+                   hb=[weights['hb' + suffix(i)] for i in xrange(dbm.n_layers_)],
+                   v_layer=NumpyLayer.from_layer(dbm._v_layer),
+                   h_layers=[NumpyLayer.from_layer(L) for L in dbm._h_layers],
+                   **kwargs)
+
+    def _allocate(self):
+        if self._mu is None or len(self._mu[0]) != self.batch_size:
+            self._mu = [np.empty((self.batch_size, n), dtype=self.dtype) for n in self.n_hiddens]
+            self._mu_new = [np.empty((self.batch_size, n), dtype=self.dtype) for n in self.n_hiddens]
+            self._T = [np.empty((self.batch_size, n), dtype=self.dtype) for n in self.n_hiddens]
+
+    def _mf_batch(self, X_b):
+        """Run mean-field updates for one batch, return views of the buffers."""
+        n = len(X_b)
+        mu = [m[:n] for m in self._mu]
+        mu_new = [m[:n] for m in self._mu_new]
+        T = [t[:n] for t in self._T]
+
+        # initialize using approximate inference
+        for i in xrange(self.n_layers):
+            np.dot(X_b if i == 0 else mu[i - 1], self.W[i], out=mu[i])
+            if i == 0 or i < self.n_layers - 1:
+                mu[i] *= 2.
+            self.h_layers[i].activation(mu[i], self.hb[i])
+
+        # run mean-field updates until convergence
+        for _ in xrange(self.max_mf_updates):
+            for i in xrange(self.n_layers):
+                np.dot(X_b if i == 0 else mu_new[i - 1], self.W[i], out=mu_new[i])
+                if i < self.n_layers - 1:
+                    np.dot(mu[i + 1], self.W_T[i + 1], out=T[i])
+                    mu_new[i] += T[i]
+                self.h_layers[i].activation(mu_new[i], self.hb[i])
+            delta = max(np.max(np.abs(u - v)) for u, v in zip(mu, mu_new))
+            mu, mu_new = mu_new, mu
+            if delta <= self.mf_tol:
+                break
+        return mu
+
+    def _batches(self, X):
+        self._allocate()
+        for start in xrange(0, len(X), self.batch_size):
+            X_b = np.asarray(X[start:(start + self.batch_size)], dtype=self.dtype)
+            yield start, X_b, self._mf_batch(X_b)
+
+    def mean_field(self, X):
+        """Compute variational parameters for all hidden layers."""
+        Q = [np.empty((len(X), n), dtype=self.dtype) for n in self.n_hiddens]
+        for start, X_b, mu in self._batches(X):
+            for i in xrange(self.n_layers):
+                Q[i][start:(start + len(X_b))] = mu[i]
+        return Q
+
+    def transform(self, X):
+        """Compute hidden units' (from last layer) activation probabilities."""
+        G = np.empty((len(X), self.n_hiddens[-1]), dtype=self.dtype)
+        for start, X_b, mu in self._batches(X):
+            G[start:(start + len(X_b))] = mu[-1]
+        return G
+
+    def reconstruct(self, X):
+        """Compute p(v|h_0=q, h...)=p(v|h_0=q), where q=p(h_0|v=x)"""
+        X_recon = np.empty((len(X), self.n_visible), dtype=self.dtype)
+        for start, X_b, mu in self._batches(X):
+            V = X_recon[start:(start + len(X_b))]
+            np.dot(mu[0], self.W_T[0], out=V)
+            self.v_layer.activation(V, self.vb)
+        return X_recon
+
+    def save(self, filepath):
+        arrays = dict(vb=self.vb)
+        for i in xrange(self.n_layers):
+            arrays['W_{0}'.format(i)] = self.W[i]
+            arrays['hb_{0}'.format(i)] = self.hb[i]
+        _save(filepath, self, arrays=arrays,
+              config=dict(v_layer=[self.v_layer.name, self.v_layer.params],
+                          h_layers=[[L.name, L.params] for L in self.h_layers],
+                          max_mf_updates=self.max_mf_updates,
+                          mf_tol=self.mf_tol))
+
+    @classmethod
+    def load(cls, filepath, **kwargs):
+        arrays, config = _load(filepath, cls)
+        n_layers = len(config['h_layers'])
+        kwargs.setdefault('max_mf_updates', config['max_mf_updates'])
+        kwargs.setdefault('mf_tol', config['mf_tol'])
+        return cls(W=[arrays['W_{0}'.format(i)] for i in xrange(n_layers)],
+                   vb=arrays['vb'],
+                   hb=[arrays['hb_{0}'.format(i)] for i in xrange(n_layers)],
+                   v_layer=NumpyLayer(*config['v_layer']),
+                   h_layers=[NumpyLayer(*c) for c in config['h_layers']],
+                   **kwargs)
+
+
+def _save(filepath, model, arrays, config):
+    config['__class_name__'] = model.__class__.__name__
+    np.savez(filepath, __config__=json.dumps(config), **arrays)
+
+def _load(filepath, cls):
+    with np.load(filepath) as f:
+        arrays = {k: f[k] for k in f.files if k != '__config__'}
+        config = json.loads(f['__config__'].item())
+    class_name = config.pop('__class_name__')
+    if class_name != cls.__name__:
+        raise RuntimeError("attempt to load {0} with class {1}".format(class_name, cls.__name__))
+    return arrays, config
+
+
+if __name__ == '__main__':
+    # run corresponding tests
+    from boltzmann_machines.utils.testing import run_tests
+    run_tests(__file__)
@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import time
+import shutil
+import pickle
+import tempfile
+import subprocess
+import multiprocessing as mp
+import tensorflow as tf
+
+from boltzmann_machines.base import TensorFlowModel
+
+
+# jobs for the worker processes, which inherit them when forked
+# (so that training data is not pickled and copied to each of them)
+_jobs = None
+
+
+def _is_trained(model):
+    """Check whether `model_path` of the `model` holds a checkpoint
+    of the model trained up to `max_epoch`."""
+    paths = TensorFlowModel.compute_working_paths(model._model_filepath)
+    if not (os.path.isfile(paths['params_filepath']) and
+            os.path.isfile(paths['tf_meta_graph_filepath'])):
+        return False
+    with open(paths['params_filepath'], 'r') as params_file:
+        params = json.load(params_file)
+    return params.get('__class_name__') == model.__class__.__name__ and \
+           params.get('initialized_', False) and \
+           params.get('epoch_', 0) >= params.get('max_epoch', 0)
+
+def _fit_job(i):
+    model, data, n_threads = _jobs[i]
+    if _is_trained(model):
+        return False
+
+    # resume training if there is a checkpoint
+    paths = TensorFlowModel.compute_working_paths(model._model_filepath)
+    if os.path.isfile(paths['params_filepath']):
+        model = model.__class__.load_model(model._model_filepath)
+
+    if n_threads:
+        config = tf.ConfigProto()
+        config.CopyFrom(model._tf_session_config)
+        config.intra_op_parallelism_threads = n_threads
+        config.inter_op_parallelism_threads = n_threads
+        model._tf_session_config = config
+
+    X, X_val = data() if callable(data) else data
+    model.fit(X, X_val)
+    return True
+
+def fit_parallel(models, data, n_jobs=None, n_threads=1):
+    """Train independent models concurrently in a pool of processes.
+
+    Each model is trained in a separate (forked) process and saved to its
+    `model_path`. Models whose `model_path` already holds a checkpoint
+    trained up to `max_epoch` are skipped, and the ones with unfinished
+    checkpoint continue training from it, so that the whole job
+    can be resumed after interruption.
+
+    Note that TF runtime is not fork-safe, so the pool of processes
+    should be started before any TF session is run in the current
+    process (otherwise workers may hang). Models are trained in the
+    current process if `n_jobs` is 1.
+
+    Parameters
+    ----------
+    models : list of TensorFlowModel
+        Models to train (with distinct `model_path`s).
+    data : list of (X, X_val) tuples or callables returning such
+        Training and validation data (X_val can be None) for each model.
+        Callables are called within the worker process, which allows
+        to prepare the data there.
+    n_jobs : None or positive int
+        Number of worker processes. If None, use as many as allowed by
+        the number of CPUs and `n_threads`. If 1, train all the models
+        sequentially in the current process.
+    n_threads : None or positive int
+        Number of TF intra- and inter-op threads for each model. If None,
+        use TF defaults (= all the cores for each model).
+
+    Returns
+    -------
+    models : list of TensorFlowModel
+        Trained models, loaded from their `model_path`s.
+    """
+    global _jobs
+    if len(models) != len(data):
+        raise ValueError('`models` and `data` should have the same length')
+    if len(set(m._model_dirpath for m in models)) != len(models):
+        raise ValueError('all the models should have distinct `model_path`s')
+
+    if n_jobs is None:
+        n_jobs = max(mp.cpu_count() // (n_threads or mp.cpu_count()), 1)
+    n_jobs = min(n_jobs, len(models))
+
+    _jobs = [(model, d, n_threads) for model, d in zip(models, data)]
+    try:
+        if n_jobs <= 1:
+            map(_fit_job, xrange(len(_jobs)))
+        else:
+            # new process for each model, to start from clean TF runtime
+            pool = mp.Pool(processes=n_jobs, maxtasksperchild=1)
+            try:
+                pool.map(_fit_job, xrange(len(_jobs)), chunksize=1)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+    finally:
+        _jobs = None
+
+    return [model.__class__.load_model(model._model_filepath) for model in models]
+
+def _run_pickled_job(job_filepath, result_filepath):
+    """Entry point of worker processes started by `imap_parallel`."""
+    with open(job_filepath, 'rb') as f:
+        job = pickle.load(f)
+    result = job()
+    with open(result_filepath + '.tmp', 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(result_filepath + '.tmp', result_filepath)
+
+def imap_parallel(jobs, n_jobs=None, poll_interval=0.05):
+    """Run independent jobs in a pool of worker processes and
+    yield their results as soon as they are ready.
+
+    Unlike `fit_parallel`, each job is run in a fresh Python interpreter
+    (rather than in a forked process), so this can be used after TF
+    sessions were run in the current process, but the jobs should be
+    picklable. Once the generator is closed (e.g. when the consumer stops
+    iterating early), remaining jobs are cancelled.
+
+    Parameters
+    ----------
+    jobs : list of callables
+        Picklable jobs w/o arguments (e.g. `functools.partial`
+        of module-level functions), returning picklable results.
+    n_jobs : None or positive int
+        Number of worker processes. If None, use as many as there are CPUs.
+        If 1, run the jobs sequentially in the current process.
+    poll_interval : positive float
+        Interval (in seconds) of polling the workers.
+
+    Yields
+    ------
+    i, result : int, object
+        Index of the job and its result, in the order of completion.
+
+    Examples
+    --------
+    >>> from functools import partial
+    >>> sorted(imap_parallel([partial(pow, 2, k) for k in xrange(3)], n_jobs=2))
+    [(0, 1), (1, 2), (2, 4)]
+    """
+    n_jobs = min(n_jobs or mp.cpu_count(), len(jobs))
+    if n_jobs <= 1:
+        for i, job in enumerate(jobs):
+            yield i, job()
+        return
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p or os.getcwd() for p in sys.path)
+    cmd = [sys.executable, '-c', 'import sys; from boltzmann_machines.parallel import '
+                                 '_run_pickled_job; _run_pickled_job(*sys.argv[1:])']
+    tmp_dirpath = tempfile.mkdtemp(prefix='imap_parallel_')
+    pending, running = range(len(jobs)), {}
+    try:
+        while pending or running:
+            while pending and len(running) < n_jobs:
+                i = pending.pop(0)
+                job_filepath = os.path.join(tmp_dirpath, 'job_{0}.pkl'.format(i))
+                result_filepath = os.path.join(tmp_dirpath, 'result_{0}.pkl'.format(i))
+                with open(job_filepath, 'wb') as f:
+                    pickle.dump(jobs[i], f, protocol=pickle.HIGHEST_PROTOCOL)
+                running[i] = (subprocess.Popen(cmd + [job_filepath, result_filepath], env=env),
+                              result_filepath)
+            for i, (p, result_filepath) in running.items():
+                if p.poll() is None:
+                    continue
+                del running[i]
+                if p.returncode != 0:
+                    raise RuntimeError('job {0} failed with exit code {1}'.format(i, p.returncode))
+                with open(result_filepath, 'rb') as f:
+                    result = pickle.load(f)
+                yield i, result
+            if running:
+                time.sleep(poll_interval)
+    finally:
+        for p, _ in running.values():
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+        shutil.rmtree(tmp_dirpath, ignore_errors=True)
+
+if __name__ == '__main__':
+    # run corresponding tests
+    from boltzmann_machines.utils.testing import run_tests
+    run_tests(__file__)
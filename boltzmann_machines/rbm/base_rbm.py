@@ -1,10 +1,12 @@
 import numpy as np
 import tensorflow as tf
+from functools import partial
 from tensorflow.core.framework import summary_pb2
 
-from boltzmann_machines import EnergyBasedModel
+from boltzmann_machines import EnergyBasedModel, ais_summary
 from boltzmann_machines.base import run_in_tf_session, is_attribute_name
-from boltzmann_machines.utils import (make_list_from, batch_iter, epoch_iter,
+from boltzmann_machines.np_inference import top_k_indices
+from boltzmann_machines.utils import (RNG, make_list_from, batch_iter, epoch_iter,
                                       write_during_training)
 from boltzmann_machines.utils.testing import assert_len, assert_shape
 
@@ -33,6 +35,15 @@ class BaseRBM(EnergyBasedModel):
         Train till this epoch.
     batch_size : positive int
         Input batch size for training.
+    stage_input : bool
+        Whether to copy training data into the graph once per `fit`
+        and to slice shuffled batches from it inside TF runtime,
+        instead of feeding the data batch by batch.
+    fuse_train_steps : bool
+        Whether to apply consecutive updates for several batches within
+        a single `session.run` call (with an in-graph loop), instead of
+        one call per batch. Steps on which training metrics are computed
+        (see `train_metrics_every_iter`) are still run one at a time.
     l2 : non-negative float
         L2 weight decay coefficient.
     sample_v_states, sample_h_states : bool
@@ -52,6 +63,8 @@ class BaseRBM(EnergyBasedModel):
         for DBM pre-training to address "double counting evidence" problem [4].
     metrics_config : dict
         Parameters that controls which metrics and how often they are computed.
+        Ops are built only for the enabled metrics, so they cannot be enabled
+        once the model is initialized.
         Possible (optional) commands:
         * l2_loss : bool, default False
             Whether to compute weight decay penalty.
@@ -60,20 +73,47 @@ class BaseRBM(EnergyBasedModel):
         * pll : bool, default False
             Whether to compute pseudo-loglikelihood estimation. Only makes sense
             to compute for binary visible units (BernoulliRBM, MultinomialRBM).
+        * pll_n_flips : None or positive int, default None
+            If None, estimate PLL by flipping one random visible unit in each
+            sample [3]. Otherwise flip (one at a time) each of `pll_n_flips`
+            visible units, drawn for each batch (all of them if `pll_n_flips`
+            >= n_visible), and average exact conditionals computed from rank-1
+            updates of hidden pre-activations. This gives much less noisy
+            estimation, but requires O(batch_size * pll_n_flips * n_hidden)
+            memory.
         * feg : bool, default False
             Whether to compute free energy gap.
+        * ais : bool, default False
+            Whether to estimate log partition function using AIS with a reduced
+            (cheap) schedule, and average log-likelihood of validation data
+            (if provided) from it. This gives noisy and typically overestimated
+            log-likelihood, which is still useful for monitoring.
         * l2_loss_fmt : str, default '.2e'
         * msre_fmt : str, default '.4f'
         * pll_fmt : str, default '.3f'
         * feg_fmt : str, default '.2f'
+        * ais_fmt : str, default '.2f'
         * train_metrics_every_iter : non-negative int, default 10
         * val_metrics_every_epoch : non-negative int, default 1
         * feg_every_epoch : non-negative int, default 2
         * n_batches_for_feg : non-negative int, default 10
+            Size (in batches) of random subsets of training and validation
+            data to compute free energy gap on. They are drawn once per `fit`
+            and kept in the graph, so that free energies of all of their
+            samples are computed in a single call.
+        * ais_every_epoch : positive int, default 2
+        * ais_n_betas : positive int, default 100
+            Number of intermediate distributions for monitoring.
+        * ais_n_runs : positive int, default 16
+            Number of AIS runs for monitoring.
     verbose : bool
         Whether to display progress during training.
     save_after_each_epoch : bool
         If False, save model only after the whole training is complete.
+        Otherwise checkpoints are written by a background thread, with at most
+        `max_pending_saves` snapshots of variables in flight (if 0, they are
+        written synchronously), and only `tf_saver_params['max_to_keep']`
+        newest of them are kept.
     display_filters : non-negative int
         Number of weights filters to display during training (in TensorBoard).
     display_hidden_activations : non-negative int
@@ -91,12 +131,15 @@ class BaseRBM(EnergyBasedModel):
         url: http://deeplearning.net/tutorial/rbm.html
     [4] R. Salakhutdinov and G. Hinton. Deep boltzmann machines.
         In AISTATS, pp. 448-455. 2009
+    [5] R. Salakhutdinov and I. Murray. On the quantitative analysis of
+        deep belief networks. In ICML, pp. 872-879. 2008
     """
     def __init__(self,
                  n_visible=784, v_layer_cls=None, v_layer_params=None,
                  n_hidden=256, h_layer_cls=None, h_layer_params=None,
                  W_init=0.01, vb_init=0., hb_init=0., n_gibbs_steps=1,
-                 learning_rate=0.01, momentum=0.9, max_epoch=10, batch_size=10, l2=1e-4,
+                 learning_rate=0.01, momentum=0.9, max_epoch=10, batch_size=10, stage_input=False, fuse_train_steps=False,
+                 l2=1e-4,
                  sample_v_states=False, sample_h_states=True, dropout=None,
                  sparsity_target=0.1, sparsity_cost=0., sparsity_damping=0.9,
                  dbm_first=False, dbm_last=False,
@@ -145,6 +188,8 @@ class BaseRBM(EnergyBasedModel):
         self.momentum = make_list_from(momentum)
         self.max_epoch = max_epoch
         self.batch_size = batch_size
+        self.stage_input = stage_input
+        self.fuse_train_steps = fuse_train_steps
         self.l2 = l2
 
         # According to [2], the training goes less noisy and slightly faster, if
@@ -167,21 +212,37 @@ class BaseRBM(EnergyBasedModel):
         self.metrics_config.setdefault('l2_loss', False)
         self.metrics_config.setdefault('msre', False)
         self.metrics_config.setdefault('pll', False)
+        self.metrics_config.setdefault('pll_n_flips', None)
         self.metrics_config.setdefault('feg', False)
+        self.metrics_config.setdefault('ais', False)
         self.metrics_config.setdefault('l2_loss_fmt', '.2e')
         self.metrics_config.setdefault('msre_fmt', '.4f')
         self.metrics_config.setdefault('pll_fmt', '.3f')
         self.metrics_config.setdefault('feg_fmt', '.2f')
+        self.metrics_config.setdefault('ais_fmt', '.2f')
         self.metrics_config.setdefault('train_metrics_every_iter', 10)
         self.metrics_config.setdefault('val_metrics_every_epoch', 1)
         self.metrics_config.setdefault('feg_every_epoch', 2)
         self.metrics_config.setdefault('n_batches_for_feg', 10)
+        self.metrics_config.setdefault('ais_every_epoch', 2)
+        self.metrics_config.setdefault('ais_n_betas', 100)
+        self.metrics_config.setdefault('ais_n_runs', 16)
         self._metrics_names_map={
             'feg': 'free_energy_gap',
+            'ais': 'log_Z',
             'l2_loss': 'l2_loss',
             'msre': 'mean_squared_reconstruction_error',
             'pll': 'pseudo_loglikelihood'
         }
+        # builders of metrics ops (methods taking input batch and visible means
+        # at the end of Gibbs chain) and collections to add them to, by metric
+        # names; only metrics enabled in `metrics_config` are added to the graph
+        self._metrics_builders = {
+            'l2_loss': ('l2_loss', '_make_l2_loss'),
+            'msre': ('msre', '_make_msre'),
+            'pll': ('pll', '_make_pll'),
+            'feg': ('feg', '_make_feg'),
+        }
         self._train_metrics_names = ('l2_loss', 'msre', 'pll')
         self._train_metrics_map = {}
         self._val_metrics_names = ('msre', 'pll')
@@ -221,7 +282,9 @@ class BaseRBM(EnergyBasedModel):
         self._learning_rate = None
         self._momentum = None
         self._n_gibbs_steps = None
+        self._batch_size = None
         self._X_batch = None
+        self._X_input = None
 
         # tf vars
         self._W = None
@@ -234,12 +297,23 @@ class BaseRBM(EnergyBasedModel):
 
         self._q_means = None
 
+        # names of the vars above, updated on each training step
+        self._train_params_names = ('_W', '_vb', '_hb', '_dW', '_dvb', '_dhb', '_q_means')
+
         # tf operations
         self._train_op = None
+        self._fused_train_op = None
         self._transform_op = None
         self._msre = None
         self._pll = None
-        self._free_energy_op = None
+        self._feg = None
+        self._feg_summary = None
+        self._legacy_feg_data = None
+        self._free_energies_op = None
+        self._train_metrics_update = None
+        self._train_metrics_reset = None
+        self._val_metrics_update = None
+        self._val_metrics_reset = None
 
     def _make_constants(self):
         with tf.name_scope('constants'):
@@ -266,15 +340,21 @@ class BaseRBM(EnergyBasedModel):
             self._learning_rate = tf.placeholder(self._tf_dtype, [], name='learning_rate')
             self._momentum = tf.placeholder(self._tf_dtype, [], name='momentum')
             self._n_gibbs_steps = tf.placeholder(tf.int32, [], name='n_gibbs_steps')
-            self._X_batch = tf.placeholder(self._tf_dtype, [None, self.n_visible], name='X_batch')
+            self._batch_size = tf.placeholder(tf.int32, [], name='batch_size')
+            X_staged = self._make_input_pipeline(self.n_visible, self._batch_size) \
+                       if self.stage_input else None
+            if X_staged is not None:
+                self._X_batch = tf.placeholder_with_default(X_staged, [None, self.n_visible], name='X_batch')
+            else:
+                self._X_batch = tf.placeholder(self._tf_dtype, [None, self.n_visible], name='X_batch')
 
     def _make_vars(self):
         # initialize weights and biases
         with tf.name_scope('weights'):
             if hasattr(self.W_init, '__iter__'):
-                W_init = tf.constant(self.W_init, dtype=self._tf_dtype)
+                W_init = tf.constant(self._pack_W(self.W_init), dtype=self._tf_dtype)
             else:
-                W_init = tf.random_normal([self._n_visible, self._n_hidden],
+                W_init = tf.random_normal(self._W_shape(),
                                            mean=0.0, stddev=self.W_init,
                                            seed=self.random_seed, dtype=self._tf_dtype)
             W_init = tf.identity(W_init, name='W_init')
@@ -299,7 +379,7 @@ class BaseRBM(EnergyBasedModel):
         # visualize filters
         if self.display_filters:
             with tf.name_scope('filters_visualization'):
-                W_display = tf.transpose(self._W, [1, 0])
+                W_display = tf.transpose(self._dense_W(), [1, 0])
                 W_display = tf.reshape(W_display, [self.n_hidden, self.v_shape[2],
                                                    self.v_shape[0], self.v_shape[1]])
                 W_display = tf.transpose(W_display, [0, 2, 3, 1])
@@ -308,7 +388,7 @@ class BaseRBM(EnergyBasedModel):
         # initialize gradients accumulators
         with tf.name_scope('grads_accumulators'):
             dW_init = tf.constant(self._dW_init, dtype=self._tf_dtype) if self._dW_init is not None else \
-                      tf.zeros([self._n_visible, self._n_hidden], dtype=self._tf_dtype)
+                      tf.zeros(self._W_shape(), dtype=self._tf_dtype)
             dvb_init = tf.constant(self._dvb_init, dtype=self._tf_dtype) if self._dvb_init is not None else \
                        tf.zeros([self._n_visible], dtype=self._tf_dtype)
             dhb_init = tf.constant(self._dhb_init, dtype=self._tf_dtype) if self._dhb_init is not None else \
@@ -326,21 +406,45 @@ class BaseRBM(EnergyBasedModel):
         with tf.name_scope('hidden_activations_means'):
             self._q_means = tf.Variable(tf.zeros([self._n_hidden], dtype=self._tf_dtype), name='q_means')
 
-    def _propup(self, v):
+    def _W_shape(self):
+        """Shape of weights variable."""
+        return [self._n_visible, self._n_hidden]
+
+    def _pack_W(self, W):
+        """Convert (n_visible, n_hidden) np.ndarray of weights
+        to the representation used for weights variable."""
+        return W
+
+    def _dense_W(self):
+        """(n_visible, n_hidden) weights tensor."""
+        return self._W
+
+    def _associations(self, v, h):
+        """Compute sum over batch of outer products of `v` and `h`,
+        shaped like weights variable."""
+        return tf.matmul(v, h, transpose_a=True)
+
+    def _broadcast_to_W(self, x):
+        """Broadcast (n_hidden,) tensor `x` to the shape of weights
+        variable (the same for all the visible units)."""
+        return x
+
+    def _propup(self, v, W=None):
         with tf.name_scope('prop_up'):
-            t = tf.matmul(v, self._W)
+            t = tf.matmul(v, self._W if W is None else W)
         return t
 
-    def _propdown(self, h):
+    def _propdown(self, h, W=None):
         with tf.name_scope('prop_down'):
-            t = tf.matmul(a=h, b=self._W, transpose_b=True)
+            t = tf.matmul(a=h, b=self._W if W is None else W, transpose_b=True)
         return t
 
-    def _means_h_given_v(self, v):
-        """Compute means E(h|v)."""
+    def _means_h_given_v(self, v, W=None, hb=None):
+        """Compute means E(h|v) (using weights `W` and biases `hb`,
+        if given, instead of the model variables)."""
         with tf.name_scope('means_h_given_v'):
-            x  = self._propup_multiplier * self._propup(v)
-            hb = self._propup_multiplier * self._hb
+            x  = self._propup_multiplier * self._propup(v, W=W)
+            hb = self._propup_multiplier * (self._hb if hb is None else hb)
             h_means = self._h_layer.activation(x=x, b=hb)
         return h_means
 
@@ -350,11 +454,12 @@ class BaseRBM(EnergyBasedModel):
             h_samples = self._h_layer.sample(means=h_means)
         return h_samples
 
-    def _means_v_given_h(self, h):
-        """Compute means E(v|h)."""
+    def _means_v_given_h(self, h, W=None, vb=None):
+        """Compute means E(v|h) (using weights `W` and biases `vb`,
+        if given, instead of the model variables)."""
         with tf.name_scope('means_v_given_h'):
-            x  = self._propdown_multiplier * self._propdown(h)
-            vb = self._propdown_multiplier * self._vb
+            x  = self._propdown_multiplier * self._propdown(h, W=W)
+            vb = self._propdown_multiplier * (self._vb if vb is None else vb)
             v_means = self._v_layer.activation(x=x, b=vb)
         return v_means
 
@@ -364,41 +469,41 @@ class BaseRBM(EnergyBasedModel):
             v_samples = self._v_layer.sample(means=v_means)
         return v_samples
 
-    def _make_gibbs_step(self, h_states):
+    def _make_gibbs_step(self, h_states, W=None, vb=None, hb=None):
         """Compute one Gibbs step."""
         with tf.name_scope('gibbs_step'):
-            v_states = v_means = self._means_v_given_h(h_states)
+            v_states = v_means = self._means_v_given_h(h_states, W=W, vb=vb)
             if self.sample_v_states:
                 v_states = self._sample_v_given_h(v_means)
 
-            h_states = h_means = self._means_h_given_v(v_states)
+            h_states = h_means = self._means_h_given_v(v_states, W=W, hb=hb)
             if self.sample_h_states:
                 h_states = self._sample_h_given_v(h_means)
 
         return v_states, v_means, h_states, h_means
 
-    def _make_gibbs_chain_fixed(self, h_states):
-        v_states = v_means = h_means = None
+    def _make_gibbs_chain_fixed(self, h_states, h_means=None, **params):
+        v_states = v_means = None
         for _ in xrange(self.n_gibbs_steps[0]):
-            v_states, v_means, h_states, h_means = self._make_gibbs_step(h_states)
+            v_states, v_means, h_states, h_means = self._make_gibbs_step(h_states, **params)
         return v_states, v_means, h_states, h_means
 
-    def _make_gibbs_chain_variable(self, h_states):
+    def _make_gibbs_chain_variable(self, h_states, h_means=None, **params):
         def cond(step, max_step, v_states, v_means, h_states, h_means):
             return step < max_step
 
         def body(step, max_step, v_states, v_means, h_states, h_means):
-            v_states, v_means, h_states, h_means = self._make_gibbs_step(h_states)
+            v_states, v_means, h_states, h_means = self._make_gibbs_step(h_states, **params)
             return step + 1, max_step, v_states, v_means, h_states, h_means
 
         _, _, v_states, v_means, h_states, h_means = \
             tf.while_loop(cond=cond, body=body,
                           loop_vars=[tf.constant(0),
                                      self._n_gibbs_steps,
-                                     tf.zeros_like(self._X_batch),
-                                     tf.zeros_like(self._X_batch),
+                                     tf.zeros([tf.shape(h_states)[0], self._n_visible], dtype=self._tf_dtype),
+                                     tf.zeros([tf.shape(h_states)[0], self._n_visible], dtype=self._tf_dtype),
                                      h_states,
-                                     tf.zeros_like(h_states)],
+                                     h_means if h_means is not None else tf.zeros_like(h_states)],
                           back_prop=False,
                           parallel_iterations=1)
 
@@ -412,81 +517,191 @@ class BaseRBM(EnergyBasedModel):
         else:
             return self._make_gibbs_chain_variable(*args, **kwargs)
 
-    def _make_train_op(self):
+    def _make_cd_step(self, X_batch, params=None):
+        """Compute one CD-k update for `X_batch`.
+
+        Parameters
+        ----------
+        X_batch : tf.Tensor
+            Input batch.
+        params : None or list of tf.Tensor
+            Current values of parameters from `_train_params_names`
+            (e.g. loop variables of an in-graph loop). If None, the
+            corresponding variables of the model are used. They are
+            only read, not assigned to.
+
+        Returns
+        -------
+        X_batch : tf.Tensor
+            Input batch (after dropout, if any).
+        v_means, h_means : tf.Tensor
+            Means at the end of Gibbs chain.
+        new_params : list of tf.Tensor
+            Updated values of parameters from `_train_params_names`.
+        """
+        if params is None:
+            params = [getattr(self, name) for name in self._train_params_names]
+        W, vb, hb, dW_old, dvb_old, dhb_old, q_means_old = params
+
         # apply dropout if necessary
         if self.dropout is not None:
-            self._X_batch = tf.nn.dropout(self._X_batch, keep_prob=self._dropout)
+            X_batch = tf.nn.dropout(X_batch, keep_prob=self._dropout)
 
         # Run Gibbs chain for specified number of steps.
         with tf.name_scope('gibbs_chain'):
-            h0_means = self._means_h_given_v(self._X_batch)
+            h0_means = self._means_h_given_v(X_batch, W=W, hb=hb)
             h0_samples = self._sample_h_given_v(h0_means)
             h_states = h0_samples if self.sample_h_states else h0_means
 
-            v_states, v_means, _, h_means = self._make_gibbs_chain(h_states)
-
-        # visualize hidden activation means
-        if self.display_hidden_activations:
-            with tf.name_scope('hidden_activations_visualization'):
-                h_means_display = h_means[:, :self.display_hidden_activations]
-                h_means_display = tf.cast(h_means_display, tf.float32)
-                h_means_display = tf.expand_dims(h_means_display, 0)
-                h_means_display = tf.expand_dims(h_means_display, -1)
-                tf.summary.image('hidden_activation_means', h_means_display)
-
-        # encoded data, used by the transform method
-        with tf.name_scope('transform'):
-            transform_op = tf.identity(h_means)
-            tf.add_to_collection('transform_op', transform_op)
+            # hidden means of the data are returned if chain has no steps
+            v_states, v_means, _, h_means = self._make_gibbs_chain(h_states, h_means=h0_means,
+                                                                   W=W, vb=vb, hb=hb)
 
         # compute gradients estimates (= positive - negative associations)
         with tf.name_scope('grads_estimates'):
             # number of training examples might not be divisible by batch size
-            N = tf.cast(tf.shape(self._X_batch)[0], dtype=self._tf_dtype)
+            N = tf.cast(tf.shape(X_batch)[0], dtype=self._tf_dtype)
             with tf.name_scope('dW'):
-                dW_positive = tf.matmul(self._X_batch, h0_means, transpose_a=True)
-                dW_negative = tf.matmul(v_states, h_means, transpose_a=True)
-                dW = (dW_positive - dW_negative) / N - self._l2 * self._W
+                dW_positive = self._associations(X_batch, h0_means)
+                dW_negative = self._associations(v_states, h_means)
+                dW = (dW_positive - dW_negative) / N - self._l2 * W
             with tf.name_scope('dvb'):
-                dvb = tf.reduce_mean(self._X_batch - v_states, axis=0) # == sum / N
+                dvb = tf.reduce_mean(X_batch - v_states, axis=0) # == sum / N
             with tf.name_scope('dhb'):
                 dhb = tf.reduce_mean(h0_means - h_means, axis=0) # == sum / N
 
         # apply sparsity targets if needed
         with tf.name_scope('sparsity_targets'):
             q_means = tf.reduce_sum(h_means, axis=0)
-            q_update = self._q_means.assign(self._sparsity_damping * self._q_means + \
-                                            (1 - self._sparsity_damping) * q_means)
-            sparsity_penalty = self._sparsity_cost * (q_update - self._sparsity_target)
+            q_means_new = self._sparsity_damping * q_means_old + \
+                          (1 - self._sparsity_damping) * q_means
+            sparsity_penalty = self._sparsity_cost * (q_means_new - self._sparsity_target)
             dhb -= sparsity_penalty
-            dW  -= sparsity_penalty
+            dW  -= self._broadcast_to_W(sparsity_penalty)
 
         # update parameters
         with tf.name_scope('momentum_updates'):
             with tf.name_scope('dW'):
-                dW_update = self._dW.assign(self._learning_rate * (self._momentum * self._dW + dW))
-                W_update = self._W.assign_add(dW_update)
+                dW_new = self._learning_rate * (self._momentum * dW_old + dW)
+                W_new = W + dW_new
             with tf.name_scope('dvb'):
-                dvb_update = self._dvb.assign(self._learning_rate * (self._momentum * self._dvb + dvb))
-                vb_update = self._vb.assign_add(dvb_update)
+                dvb_new = self._learning_rate * (self._momentum * dvb_old + dvb)
+                vb_new = vb + dvb_new
             with tf.name_scope('dhb'):
-                dhb_update = self._dhb.assign(self._learning_rate * (self._momentum * self._dhb + dhb))
-                hb_update = self._hb.assign_add(dhb_update)
+                dhb_new = self._learning_rate * (self._momentum * dhb_old + dhb)
+                hb_new = hb + dhb_new
+
+        new_params = [W_new, vb_new, hb_new, dW_new, dvb_new, dhb_new, q_means_new]
+        return X_batch, v_means, h_means, new_params
+
+    def _make_fused_train_op(self, X_batches):
+        """Apply CD-k updates for consecutive batches of size
+        `batch_size` of `X_batches` within a single in-graph loop."""
+        with tf.name_scope('fused_training_steps'):
+            params = [getattr(self, name) for name in self._train_params_names]
+            n_steps = (tf.shape(X_batches)[0] + self._batch_size - 1) // self._batch_size
+
+            def cond(step, *values):
+                return step < n_steps
+
+            def body(step, *values):
+                X_batch = X_batches[(step * self._batch_size):((step + 1) * self._batch_size)]
+                _, _, _, new_params = self._make_cd_step(X_batch, params=list(values))
+                return [step + 1] + new_params
+
+            outputs = tf.while_loop(cond=cond, body=body,
+                                    loop_vars=[tf.constant(0)] + [tf.identity(p) for p in params],
+                                    back_prop=False,
+                                    parallel_iterations=1)
+            fused_train_op = tf.group(*[p.assign(v) for p, v in zip(params, outputs[1:])])
+            tf.add_to_collection('fused_train_op', fused_train_op)
+
+    def _make_pll_flips(self, v, n_flips):
+        """Per sample average pseudo-loglikelihood of binary `v`, from
+        conditionals log p(v_i|v_{-i}) = log sigmoid(F(v^(i)) - F(v)) of
+        `n_flips` (random) visible units, where v^(i) is `v` with i-th
+        unit flipped.
+
+        Flip of i-th unit changes hidden pre-activations x = v*W + hb by
+        (1 - 2v_i) * W_i, so all the free energy differences are computed
+        from shared `x`, w/o recomputing `propup` for each corrupted sample.
+        """
+        if n_flips >= self.n_visible:
+            ix = tf.range(self.n_visible)
+        else:
+            ix = tf.random_shuffle(tf.range(self.n_visible))[:n_flips]
+        n_flips = tf.shape(ix)[0]
+        batch_size = tf.shape(v)[0]
+
+        x = self._propup(v)
+        W_ix = tf.gather(self._dense_W(), ix)                    # [K, n_hidden]
+        v_ix = tf.transpose(tf.gather(tf.transpose(v), ix))     # [batch_size, K]
+        d = 1. - 2. * v_ix
+        x_flipped = tf.expand_dims(x, 1) + tf.expand_dims(d, 2) * tf.expand_dims(W_ix, 0)
+        x_flipped = tf.reshape(x_flipped, [batch_size * n_flips, self._n_hidden])
+        log_Z_flipped = self._h_layer.log_partition(x_flipped, self._hb)
+        log_Z_flipped = tf.reshape(log_Z_flipped, [batch_size, n_flips])
+        log_Z = tf.expand_dims(self._h_layer.log_partition(x, self._hb), 1)
+
+        # F(v^(i)) - F(v)
+        dF = -d * tf.gather(self._vb, ix) - log_Z_flipped + log_Z
+        return tf.cast(self._n_visible, dtype=self._tf_dtype) *\
+               tf.reduce_mean(tf.log_sigmoid(dF))
+
+    def _make_train_op(self):
+        if self.fuse_train_steps:
+            self._make_fused_train_op(self._X_batch)
+
+        self._X_batch, v_means, h_means, new_params = self._make_cd_step(self._X_batch)
+
+        # visualize hidden activation means
+        if self.display_hidden_activations:
+            with tf.name_scope('hidden_activations_visualization'):
+                h_means_display = h_means[:, :self.display_hidden_activations]
+                h_means_display = tf.cast(h_means_display, tf.float32)
+                h_means_display = tf.expand_dims(h_means_display, 0)
+                h_means_display = tf.expand_dims(h_means_display, -1)
+                tf.summary.image('hidden_activation_means', h_means_display)
+
+        # encoded data, used by the transform method
+        with tf.name_scope('transform'):
+            transform_op = tf.identity(h_means)
+            tf.add_to_collection('transform_op', transform_op)
 
         # assemble train_op
         with tf.name_scope('training_step'):
-            train_op = tf.group(W_update, vb_update, hb_update)
+            params = [getattr(self, name) for name in self._train_params_names]
+            with tf.control_dependencies(new_params):
+                train_op = tf.group(*[p.assign(v) for p, v in zip(params, new_params)])
             tf.add_to_collection('train_op', train_op)
 
-        # compute metrics
+        # compute metrics (only the enabled ones)
+        metrics_ops = {}
+        for m, (collection, builder) in sorted(self._metrics_builders.items()):
+            if self.metrics_config.get(m):
+                metrics_ops[m] = getattr(self, builder)(self._X_batch, v_means)
+                tf.add_to_collection(collection, metrics_ops[m])
+                if m in self._train_metrics_names:
+                    tf.summary.scalar(self._metrics_names_map[m], metrics_ops[m])
+
+        # and their running averages over epoch (validation set)
+        for name, metrics_names in (('train_metrics', self._train_metrics_names),
+                                    ('val_metrics', self._val_metrics_names)):
+            metrics = {m: metrics_ops[m] for m in metrics_names if m in metrics_ops}
+            if metrics:
+                self._make_metrics_accumulator(name, metrics)
+
+    def _make_l2_loss(self, X_batch, v_means):
         with tf.name_scope('L2_loss'):
             l2_loss = self._l2 * tf.nn.l2_loss(self._W)
-            tf.add_to_collection('l2_loss', l2_loss)
+        return l2_loss
 
+    def _make_msre(self, X_batch, v_means):
         with tf.name_scope('mean_squared_recon_error'):
-            msre = tf.reduce_mean(tf.square(self._X_batch - v_means))
-            tf.add_to_collection('msre', msre)
+            msre = tf.reduce_mean(tf.square(X_batch - v_means))
+        return msre
 
+    def _make_pll(self, X_batch, v_means):
         # Since reconstruction error is fairly poor measure of performance,
         # as this is not what CD-k learning algorithm aims to minimize [2],
         # compute (per sample average) pseudo-loglikelihood (proxy to likelihood)
@@ -494,7 +709,10 @@ class BaseRBM(EnergyBasedModel):
         # learning with PLL is asymptotically consistent [1].
         # More specifically, PLL computed using approximation as in [3].
         with tf.name_scope('pseudo_loglik'):
-            x = self._X_batch
+            if self.metrics_config['pll_n_flips']:
+                return self._make_pll_flips(X_batch, self.metrics_config['pll_n_flips'])
+
+            x = X_batch
             # randomly corrupt one feature in each sample
             x_ = tf.identity(x)
             batch_size = tf.shape(x)[0]
@@ -510,31 +728,117 @@ class BaseRBM(EnergyBasedModel):
 
             pll = tf.cast(self._n_visible, dtype=self._tf_dtype) *\
                   tf.log_sigmoid(self._free_energy(x_)-self._free_energy(x))
-            tf.add_to_collection('pll', pll)
-
-        # add also free energy of input batch to collection (for feg)
-        free_energy_op = self._free_energy(self._X_batch)
-        tf.add_to_collection('free_energy_op', free_energy_op)
+        return pll
+
+    def _make_feg(self, X_batch, v_means):
+        # Fixed subsets of training and validation data are copied into
+        # the graph (see `_stage_feg_data`), and free energies of both of them
+        # are computed in a single call, w/o feeding data each time.
+        # Input batch before dropout is used to preprocess data for staging.
+        with tf.name_scope('free_energy_gap'):
+            X_stages = []
+            for name in ('train', 'val'):
+                # local variables are neither initialized, nor saved with the model
+                X_stage = tf.Variable(tf.zeros([0, self.n_visible], dtype=self._tf_dtype),
+                                      trainable=False, validate_shape=False,
+                                      collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                      name='X_{0}'.format(name))
+                stage_op = tf.assign(X_stage, self._X_input, validate_shape=False,
+                                     name='stage_{0}'.format(name))
+                tf.add_to_collection('feg_stage_ops', stage_op)
+                X_stage = tf.identity(X_stage)
+                X_stage.set_shape([None, self.n_visible])
+                X_stages.append(X_stage)
+
+            n_train = tf.shape(X_stages[0])[0]
+            fes = self._free_energies(tf.concat(X_stages, axis=0))
+            train_fes, val_fes = fes[:n_train], fes[n_train:]
+            tf.add_to_collection('feg_free_energies', train_fes)
+            tf.add_to_collection('feg_free_energies', val_fes)
+            feg = tf.reduce_mean(val_fes) - tf.reduce_mean(train_fes)
+
+            # summaries are written only along with feg (not with the train ones)
+            feg_summary = tf.summary.merge([
+                tf.summary.scalar(self._metrics_names_map['feg'], feg, collections=[]),
+                tf.summary.histogram('free_energies_train', train_fes, collections=[]),
+                tf.summary.histogram('free_energies_val', val_fes, collections=[])
+            ])
+            tf.add_to_collection('feg_summary', feg_summary)
+        return feg
 
-        # collect summaries
-        if self.metrics_config['l2_loss']:
-            tf.summary.scalar(self._metrics_names_map['l2_loss'], l2_loss)
-        if self.metrics_config['msre']:
-            tf.summary.scalar(self._metrics_names_map['msre'], msre)
-        if self.metrics_config['pll']:
-            tf.summary.scalar(self._metrics_names_map['pll'], pll)
+    def _ais_sample_h_given_v(self, v, beta, seed):
+        """Sample hidden states of intermediate AIS model
+        (with weights and hidden biases scaled by `beta`)."""
+        h_means = tf.nn.sigmoid(beta * (self._propup(v) + self._hb))
+        return self._ais_sample_bernoulli(h_means, seed)
+
+    def _ais_sample_v_given_h(self, h, beta, seed):
+        """Sample visible states of intermediate AIS model
+        (with weights scaled by `beta`)."""
+        raise NotImplementedError('`_ais_sample_v_given_h` is not implemented')
+
+    def _make_ais_transition(self, v, beta, step):
+        # AIS is run on a state space x = {v} with h analytically summed out,
+        # annealing from a base-rate model with the same visible biases
+        # and zero weights (and hidden biases) as in [5]
+        def cond(j, v):
+            return j < self._ais_n_gibbs_steps
+
+        def body(j, v):
+            # 2 samples per Gibbs step
+            counter = 2 * (step * tf.cast(self._ais_n_gibbs_steps, tf.int64) + tf.cast(j, tf.int64))
+            h = self._ais_sample_h_given_v(v, beta, self._ais_seed_for(counter))
+            v_new = self._ais_sample_v_given_h(h, beta, self._ais_seed_for(counter + 1))
+            return j + 1, v_new
+
+        _, v_new = tf.while_loop(cond=cond, body=body,
+                                 loop_vars=[tf.constant(0), v],
+                                 parallel_iterations=1,
+                                 back_prop=False)
+        return v_new
+
+    def _sampler_sample_h(self, v, seed):
+        x  = self._propup_multiplier * self._propup(self._v_layer.scale(v))
+        hb = self._propup_multiplier * self._hb
+        return self._h_layer.sample_stateless(x, hb, seed)
+
+    def _make_sampler_v_base(self):
+        return self._v_layer.sample_base_stateless(self._vb, self._sampler_n_chains,
+                                                   self._sampler_seed_for(-1))
+
+    def _make_sampler_init(self, v):
+        return [self._sampler_sample_h(v, self._sampler_seed_for(-2))]
+
+    def _make_sampler_step(self, state, step):
+        # unlike in the training chains, both v and h are always sampled
+        with tf.name_scope('sampler_step'):
+            h, = state
+            x  = self._propdown_multiplier * self._propdown(h)
+            vb = self._propdown_multiplier * self._vb
+            v_means = self._v_layer.activation(x=x, b=vb)
+            v = self._v_layer.sample_stateless(x, vb, self._sampler_seed_for(2 * step))
+            h = self._sampler_sample_h(v, self._sampler_seed_for(2 * step + 1))
+        return [h], v, v_means
 
     def _make_tf_model(self):
         self._make_constants()
         self._make_placeholders()
         self._make_vars()
+        self._X_input = self._X_batch
         self._make_train_op()
-
-    def _make_tf_feed_dict(self, X_batch, n_gibbs_steps=None):
+        self._make_ais(self.n_visible)
+        with tf.name_scope('log_proba'):
+            log_p = self._unnormalized_log_prob_ais(self._X_input, 1.)
+        tf.add_to_collection('unnormalized_log_proba', log_p)
+        tf.add_to_collection('free_energies', self._free_energies(self._X_input))
+        self._make_sampler(self.n_visible)
+
+    def _make_tf_feed_dict(self, X_batch=None, n_gibbs_steps=None):
         d = {}
         d['learning_rate'] = self.learning_rate[min(self.epoch_, len(self.learning_rate) - 1)]
         d['momentum'] = self.momentum[min(self.epoch_, len(self.momentum) - 1)]
-        d['X_batch'] = X_batch
+        if X_batch is not None:
+            d['X_batch'] = X_batch
         if n_gibbs_steps is not None:
             d['n_gibbs_steps'] = n_gibbs_steps
         else:
@@ -546,99 +850,177 @@ class BaseRBM(EnergyBasedModel):
             feed_dict['input_data/{0}:0'.format(k)] = v
         return feed_dict
 
+    def _get_metric_op(self, m):
+        collection = tf.get_collection(self._metrics_builders[m][0])
+        if not collection:
+            raise ValueError("metric '{0}' was disabled when the graph was built, "
+                             "so it cannot be computed for this model".format(m))
+        return collection[0]
+
     def _train_epoch(self, X):
-        results = [[] for _ in xrange(len(self._train_metrics_map))]
-        for X_batch in batch_iter(X, self.batch_size,
-                                  verbose=self.verbose):
-            self.iter_ += 1
-            if self.iter_ % self.metrics_config['train_metrics_every_iter'] == 0:
-                run_ops = [v for _, v in sorted(self._train_metrics_map.items())]
-                run_ops += [self._tf_merged_summaries, self._train_op]
-                outputs = \
-                self._tf_session.run(run_ops,
-                                     feed_dict=self._make_tf_feed_dict(X_batch))
-                values = outputs[:len(self._train_metrics_map)]
-                for i, v in enumerate(values):
-                    results[i].append(v)
-                train_s = outputs[len(self._train_metrics_map)]
+        feed_dict = self._make_tf_feed_dict()
+        every = self.metrics_config['train_metrics_every_iter']
+        block_size = None
+        if self._train_metrics_map:
+            self._tf_session.run(self._train_metrics_reset)
+        if self._input_staged or self._fused_train_op is not None:
+            feed_dict['input_data/batch_size:0'] = self.batch_size
+        if self._fused_train_op is not None:
+            # fuse all the steps up to the next one with metrics
+            block_size = lambda i: max(every - self.iter_ % every - 1, 1)
+        feed_dicts = self._train_feed_dicts(X, feed_dict, self.batch_size,
+                                            verbose=self.verbose, block_size=block_size)
+        for feed_dict, n_batches in feed_dicts:
+            self.iter_ += n_batches
+            if n_batches > 1:
+                self._tf_session.run(self._fused_train_op, feed_dict=feed_dict)
+            elif self.iter_ % every == 0:
+                # metrics are accumulated in the graph and fetched once per epoch
+                run_ops = [self._tf_merged_summaries, self._train_op]
+                if self._train_metrics_map:
+                    run_ops.append(self._train_metrics_update)
+                train_s = self._tf_session.run(run_ops, feed_dict=feed_dict)[0]
                 self._tf_train_writer.add_summary(train_s, self.iter_)
             else:
-                self._tf_session.run(self._train_op,
-                                     feed_dict=self._make_tf_feed_dict(X_batch))
+                self._tf_session.run(self._train_op, feed_dict=feed_dict)
 
         # aggregate and return metrics values
-        results = map(lambda r: np.mean(r) if r else None, results)
-        return dict(zip(sorted(self._train_metrics_map), results))
+        if not self._train_metrics_map:
+            return {}
+        return self._fetch_metrics(self._train_metrics_map)
 
     def _run_val_metrics(self, X_val):
-        results = [[] for _ in xrange(len(self._val_metrics_map))]
+        if not self._val_metrics_map:
+            return {}
+        self._tf_session.run(self._val_metrics_reset)
         for X_vb in batch_iter(X_val, batch_size=self.batch_size):
-            run_ops = [v for _, v in sorted(self._val_metrics_map.items())]
-            values = \
-            self._tf_session.run(run_ops,
+            self._tf_session.run(self._val_metrics_update,
                                  feed_dict=self._make_tf_feed_dict(X_vb))
-            for i, v in enumerate(values):
-                results[i].append(v)
-        for i, r in enumerate(results):
-            results[i] = np.mean(r) if r else None
+        results = self._fetch_metrics(self._val_metrics_map)
         summary_value = []
-        for i, m in enumerate(sorted(self._val_metrics_map)):
+        for m, v in sorted(results.items()):
             summary_value.append(summary_pb2.Summary.Value(tag=self._metrics_names_map[m],
-                                                           simple_value=results[i]))
+                                                           simple_value=v))
         val_s = summary_pb2.Summary(value=summary_value)
         self._tf_val_writer.add_summary(val_s, self.iter_)
-        return dict(zip(sorted(self._val_metrics_map), results))
-
-    def _run_feg(self, X, X_val):
+        return results
+
+    def _stage_feg_data(self, X, X_val):
+        """Copy random subsets of `X` and `X_val` (of `n_batches_for_feg`
+        batches each) into the graph to compute free energy gap on."""
+        n = self.metrics_config['n_batches_for_feg'] * self.batch_size
+        rng = RNG(seed=self.make_random_seed())
+        subsets = []
+        for X_ in (X, X_val):
+            ind = np.sort(rng.choice(len(X_), min(n, len(X_)), replace=False))
+            subsets.append(X_[ind])
+        if self._feg is None:
+            # graph predates staged subsets, so they are fed on each run
+            self._legacy_feg_data = subsets
+            return
+        for stage_op, X_ in zip(tf.get_collection('feg_stage_ops'), subsets):
+            self._tf_session.run(stage_op, feed_dict={'input_data/X_batch:0': X_})
+
+    def _run_feg(self):
         """Calculate difference between average free energies of subsets
         of validation and training sets to monitor overfitting,
         as proposed in [2]. If the model is not overfitting at all, this
         quantity should be close to zero. Once this value starts
         growing, the model is overfitting and the value ("free energy gap")
         represents the amount of overfitting.
+
+        Histograms of free energies of all the samples of both subsets
+        are written along with it.
         """
-        self._free_energy_op = tf.get_collection('free_energy_op')[0]
-
-        train_fes = []
-        for _, X_b in zip(xrange(self.metrics_config['n_batches_for_feg']),
-                          batch_iter(X, batch_size=self.batch_size)):
-            train_fe = self._tf_session.run(self._free_energy_op,
-                                            feed_dict=self._make_tf_feed_dict(X_b))
-            train_fes.append(train_fe)
-
-        val_fes = []
-        for _, X_vb in zip(xrange(self.metrics_config['n_batches_for_feg']),
-                           batch_iter(X_val, batch_size=self.batch_size)):
-            val_fe = self._tf_session.run(self._free_energy_op,
-                                          feed_dict=self._make_tf_feed_dict(X_vb))
-            val_fes.append(val_fe)
-
-        feg = np.mean(val_fes) - np.mean(train_fes)
+        if self._feg is None:
+            return self._run_legacy_feg()
+        feg, feg_s = self._tf_session.run([self._feg, self._feg_summary])
+        self._tf_val_writer.add_summary(feg_s, self.iter_)
+        return feg
+
+    def _run_legacy_feg(self):
+        """`_run_feg` for graphs restored from checkpoints that predate
+        in-graph free energy gap, and only have op computing average
+        free energy of input batch ('free_energy_op' collection)."""
+        free_energy_op = tf.get_collection('free_energy_op')[0]
+        mean_fes = []
+        for X_ in self._legacy_feg_data:
+            fes, weights = [], []
+            for X_b in batch_iter(X_, batch_size=self.batch_size):
+                fes.append(self._tf_session.run(free_energy_op,
+                                                feed_dict=self._make_tf_feed_dict(X_b)))
+                weights.append(len(X_b))
+            mean_fes.append(np.average(fes, weights=weights))
+        feg = mean_fes[1] - mean_fes[0]
         summary_value = [summary_pb2.Summary.Value(tag=self._metrics_names_map['feg'],
                                                    simple_value=feg)]
-        feg_s = summary_pb2.Summary(value=summary_value)
-        self._tf_val_writer.add_summary(feg_s, self.iter_)
+        self._tf_val_writer.add_summary(summary_pb2.Summary(value=summary_value), self.iter_)
         return feg
 
+    def _run_ais(self, X_val=None):
+        """Estimate log partition function using AIS with reduced
+        schedule (and average log-likelihood of `X_val` if provided)."""
+        values = self._ais_job(self.make_random_seed(),
+                               self.metrics_config['ais_n_runs'],
+                               self.metrics_config['ais_n_betas'],
+                               1, self.metrics_config['ais_n_betas'])
+        log_Z = ais_summary(values)[0]
+        summary_value = [summary_pb2.Summary.Value(tag=self._metrics_names_map['ais'],
+                                                   simple_value=log_Z)]
+        log_p = None
+        if X_val is not None:
+            log_p_op = tf.get_collection('unnormalized_log_proba')[0]
+            log_ps = []
+            for X_vb in batch_iter(X_val, batch_size=self.batch_size):
+                log_ps.append(self._tf_session.run(log_p_op, feed_dict=self._make_tf_feed_dict(X_vb)))
+            log_p = np.mean(np.concatenate(log_ps)) - log_Z
+            summary_value.append(summary_pb2.Summary.Value(tag='ais_log_likelihood',
+                                                           simple_value=log_p))
+        ais_s = summary_pb2.Summary(value=summary_value)
+        self._tf_val_writer.add_summary(ais_s, self.iter_)
+        return log_Z, log_p
+
     def _fit(self, X, X_val=None, *args, **kwargs):
         # load ops requested
         self._train_op = tf.get_collection('train_op')[0]
+        fused_train_op = tf.get_collection('fused_train_op')
+        self._fused_train_op = fused_train_op[0] if fused_train_op else None
 
         self._train_metrics_map = {}
+        train_metrics = {}
         for m in self._train_metrics_names:
             if self.metrics_config[m]:
-                self._train_metrics_map[m] = tf.get_collection(m)[0]
+                train_metrics[m] = self._get_metric_op(m)
+        if train_metrics:
+            self._train_metrics_update, self._train_metrics_reset, self._train_metrics_map = \
+                self._get_metrics_accumulator('train_metrics', train_metrics)
 
         self._val_metrics_map = {}
+        val_metrics = {}
         for m in self._val_metrics_names:
             if self.metrics_config[m]:
-                self._val_metrics_map[m] = tf.get_collection(m)[0]
+                val_metrics[m] = self._get_metric_op(m)
+        if val_metrics:
+            self._val_metrics_update, self._val_metrics_reset, self._val_metrics_map = \
+                self._get_metrics_accumulator('val_metrics', val_metrics)
+        self._feg = None
+        if self.metrics_config['feg'] and not tf.get_collection('free_energy_op'):
+            self._feg = self._get_metric_op('feg')
+            self._feg_summary = tf.get_collection('feg_summary')[0]
+
+        # copy training data into the graph if needed
+        self._input_staged = False
+        if self.stage_input:
+            self._stage_input(X)
+        if X_val is not None and self.metrics_config['feg']:
+            self._stage_feg_data(X, X_val)
 
         # main loop
         for self.epoch_ in epoch_iter(start_epoch=self.epoch_, max_epoch=self.max_epoch,
                                       verbose=self.verbose):
             val_results = {}
             feg = None
+            log_Z, log_p = None, None
             train_results = self._train_epoch(X)
 
             # run validation metrics if needed
@@ -646,7 +1028,10 @@ class BaseRBM(EnergyBasedModel):
                 val_results = self._run_val_metrics(X_val)
             if X_val is not None and self.metrics_config['feg'] and \
                     self.epoch_ % self.metrics_config['feg_every_epoch'] == 0:
-                feg = self._run_feg(X, X_val)
+                feg = self._run_feg()
+            if self.metrics_config['ais'] and \
+                    self.epoch_ % self.metrics_config['ais_every_epoch'] == 0:
+                log_Z, log_p = self._run_ais(X_val)
 
             # print progress
             if self.verbose:
@@ -659,11 +1044,15 @@ class BaseRBM(EnergyBasedModel):
                         s += "; val.{0}: {1:{2}}".format(m, v, self.metrics_config['{0}_fmt'.format(m)])
                 if feg is not None:
                     s += " ; feg: {0:{1}}".format(feg, self.metrics_config['feg_fmt'])
+                if log_Z is not None:
+                    s += "; log_Z: {0:{1}}".format(log_Z, self.metrics_config['ais_fmt'])
+                if log_p is not None:
+                    s += "; val.ais_logp: {0:{1}}".format(log_p, self.metrics_config['ais_fmt'])
                 write_during_training(s)
 
             # save if needed
             if self.save_after_each_epoch:
-                self._save_model(global_step=self.epoch_)
+                self._save_model_async(global_step=self.epoch_)
 
     def init_from(self, rbm):
         if type(self) != type(rbm):
@@ -684,17 +1073,117 @@ class BaseRBM(EnergyBasedModel):
             if is_attribute_name(k):
                 setattr(self, k, v)
 
-    @run_in_tf_session(update_seed=True)
-    def transform(self, X, np_dtype=None):
-        """Compute hidden units' activation probabilities."""
+    def _inference_size(self):
+        # input batch, hidden pre-activations and activations
+        return self.n_visible + 2 * self.n_hidden
+
+    def transform(self, X, np_dtype=None, batch_size=None, max_memory=None):
+        """Compute hidden units' activation probabilities.
+
+        If transform cache is set (see `set_transform_cache`),
+        the result is loaded from it when possible.
+
+        Parameters
+        ----------
+        batch_size : None or positive int
+            Number of examples per TF session call, not tied to the one
+            used for training. If None, use `batch_size` of the model.
+        max_memory : None or positive int
+            If given, choose the largest batch size for which intermediate
+            results fit into this many bytes (instead of `batch_size`).
+        """
         np_dtype = np_dtype or self._np_dtype
+        batch_size = self._inference_batch_size(batch_size, max_memory)
+        return self._cached_transform(partial(self._transform, batch_size=batch_size),
+                                      'transform', X, np_dtype)
 
+    @run_in_tf_session(update_seed=True)
+    def _transform(self, X, np_dtype, batch_size):
         self._transform_op = tf.get_collection('transform_op')[0]
         H = np.zeros((len(X), self.n_hidden), dtype=np_dtype)
+        # hidden means are taken at the end of the Gibbs chain
+        n_gibbs_steps = self.n_gibbs_steps[min(self.epoch_, len(self.n_gibbs_steps) - 1)]
+        feed_dict = {'input_data/n_gibbs_steps:0': n_gibbs_steps}
         start = 0
-        for X_b in batch_iter(X, batch_size=self.batch_size,
+        for X_b in batch_iter(X, batch_size=batch_size,
                               verbose=self.verbose, desc='transform'):
-            H_b = self._transform_op.eval(feed_dict=self._make_tf_feed_dict(X_b))
-            H[start:(start + self.batch_size)] = H_b
-            start += self.batch_size
+            feed_dict['input_data/X_batch:0'] = X_b
+            H_b = self._transform_op.eval(feed_dict=feed_dict)
+            H[start:(start + len(X_b))] = H_b
+            start += len(X_b)
         return H
+
+    def _restore_tf_params(self):
+        """Bind weights, biases and input batch to the tensors of the graph
+        restored from checkpoint, to make ops missing from it."""
+        graph = tf.get_default_graph()
+        self._W = graph.get_tensor_by_name('weights/W:0')
+        self._vb = graph.get_tensor_by_name('weights/vb:0')
+        self._hb = graph.get_tensor_by_name('weights/hb:0')
+        self._X_batch = graph.get_tensor_by_name('input_data/X_batch:0')
+
+    @run_in_tf_session()
+    def _free_energies_batch(self, X_b):
+        if not tf.get_collection('free_energies'):
+            # graph restored from checkpoint that predates the op
+            self._restore_tf_params()
+            tf.add_to_collection('free_energies', self._free_energies(self._X_batch))
+        self._free_energies_op = tf.get_collection('free_energies')[0]
+        return self._free_energies_op.eval(feed_dict={'input_data/X_batch:0': X_b})
+
+    def iter_free_energy(self, X, batch_size=None, max_memory=None):
+        """Compute free energies of samples of `X` (e.g. memory-mapped),
+        and yield them batch by batch.
+
+        Parameters
+        ----------
+        batch_size : None or positive int
+            Number of examples per TF session call. If None,
+            use `batch_size` of the model.
+        max_memory : None or positive int
+            If given, choose the largest batch size for which intermediate
+            results fit into this many bytes (instead of `batch_size`).
+
+        Yields
+        ------
+        F_b : (batch_size,) np.ndarray
+        """
+        batch_size = self._inference_batch_size(batch_size, max_memory)
+        with self._kept_session():
+            for X_b in batch_iter(X, batch_size=batch_size,
+                                  verbose=self.verbose, desc='free_energy'):
+                yield self._free_energies_batch(X_b)
+
+    def free_energy(self, X, batch_size=None, max_memory=None):
+        """Compute free energy F(v) = -log sum_h exp(-E(v, h))
+        of each sample of `X` (see `iter_free_energy`).
+
+        Returns
+        -------
+        F : (n_samples,) np.ndarray
+        """
+        F = list(self.iter_free_energy(X, batch_size=batch_size, max_memory=max_memory))
+        return np.concatenate(F) if F else np.zeros(0, dtype=self._np_dtype)
+
+    def score_samples(self, X, top_k=None, batch_size=None, max_memory=None):
+        """Compute unnormalized log-probabilities -F(v) of samples of `X`
+        (lower for anomalies), or find the most anomalous of them.
+
+        Parameters
+        ----------
+        top_k : None or positive int
+            If given, return only indices of `top_k` samples with the
+            lowest scores (found w/o keeping all the scores in memory).
+        batch_size, max_memory : see `iter_free_energy`
+
+        Returns
+        -------
+        scores : (n_samples,) np.ndarray
+            If `top_k` is None.
+        ind : (top_k,) np.ndarray
+            Otherwise, from the most anomalous sample.
+        """
+        if top_k is not None:
+            return top_k_indices(self.iter_free_energy(X, batch_size=batch_size,
+                                                       max_memory=max_memory), top_k)
+        return -self.free_energy(X, batch_size=batch_size, max_memory=max_memory)
@@ -1,10 +1,10 @@
 import numpy as np
 import tensorflow as tf
-from tensorflow.contrib.distributions import Multinomial
 
 import env
 from base_rbm import BaseRBM
 from boltzmann_machines.layers import BernoulliLayer, MultinomialLayer, GaussianLayer
+from boltzmann_machines.utils import make_list_from
 
 
 class BernoulliRBM(BaseRBM):
@@ -14,13 +14,31 @@ class BernoulliRBM(BaseRBM):
                                            h_layer_cls=BernoulliLayer,
                                            model_path=model_path, *args, **kwargs)
 
-    def _free_energy(self, v):
+    def _free_energies(self, v):
         with tf.name_scope('free_energy'):
             T1 = -tf.einsum('ij,j->i', v, self._vb)
             T2 = -tf.reduce_sum(tf.nn.softplus(self._propup(v) + self._hb), axis=1)
-            fe = tf.reduce_mean(T1 + T2, axis=0)
+            fe = T1 + T2
         return fe
 
+    def _unnormalized_log_prob_ais(self, v, beta):
+        T1 = tf.einsum('ij,j->i', v, self._vb)
+        T2 = tf.reduce_sum(tf.nn.softplus(beta * (self._propup(v) + self._hb)), axis=1)
+        return T1 + T2
+
+    def _ais_sample_v_given_h(self, h, beta, seed):
+        v_means = tf.nn.sigmoid(beta * self._propdown(h) + self._vb)
+        return self._ais_sample_bernoulli(v_means, seed)
+
+    def _make_ais_base(self):
+        # v_0 ~ Ber(sigmoid(vb)), log(Z_0) = sum(log(1 + exp(vb))) + H * log(2)
+        v_means = tf.nn.sigmoid(self._vb) * tf.ones(tf.stack([self._ais_n_runs, self._n_visible]),
+                                                   dtype=self._tf_dtype)
+        v_0 = self._ais_sample_bernoulli(v_means, self._ais_seed_for(-1))
+        log_Z0 = tf.reduce_sum(tf.nn.softplus(self._vb))
+        log_Z0 += tf.cast(self._n_hidden, dtype=self._tf_dtype) * np.log(2.)
+        return v_0, log_Z0
+
 
 class MultinomialRBM(BaseRBM):
     """RBM with Bernoulli visible and single Multinomial hidden unit
@@ -47,18 +65,41 @@ class MultinomialRBM(BaseRBM):
                                              h_layer_params=dict(n_samples=self.n_samples),
                                              model_path=model_path, *args, **kwargs)
 
-    def _free_energy(self, v):
-        K = float(self.n_hidden)
+    # hidden unit is summed out analytically (as `n_samples` softmax units
+    # with tied weights), the same way as for AIS below
+    def _free_energies(self, v):
         M = float(self.n_samples)
         with tf.name_scope('free_energy'):
             T1 = -tf.einsum('ij,j->i', v, self._vb)
-            T2 = -tf.matmul(v, self._W)
-            h_hat = Multinomial(total_count=M, logits=tf.ones([K])).sample()
-            T3 = tf.einsum('ij,j->i', T2, h_hat)
-            fe = tf.reduce_mean(T1 + T3, axis=0)
-            fe += -tf.lgamma(M + K) + tf.lgamma(M + 1) + tf.lgamma(K)
+            T2 = -M * tf.reduce_logsumexp(self._propup(v) + self._hb, axis=1)
+            fe = T1 + T2
         return fe
 
+    # For AIS, hidden unit is summed out analytically, treating it as `n_samples`
+    # softmax units with tied weights: sum_h exp(h * x) = sum_k(exp(x_k)) ** M
+    def _unnormalized_log_prob_ais(self, v, beta):
+        M = float(self.n_samples)
+        T1 = tf.einsum('ij,j->i', v, self._vb)
+        T2 = M * tf.reduce_logsumexp(beta * (self._propup(v) + self._hb), axis=1)
+        return T1 + T2
+
+    def _ais_sample_h_given_v(self, v, beta, seed):
+        logits = beta * (self._propup(v) + self._hb)
+        return self._ais_sample_multinomial(logits, int(self.n_samples), seed)
+
+    def _ais_sample_v_given_h(self, h, beta, seed):
+        v_means = tf.nn.sigmoid(beta * self._propdown(h) + self._vb)
+        return self._ais_sample_bernoulli(v_means, seed)
+
+    def _make_ais_base(self):
+        # v_0 ~ Ber(sigmoid(vb)), log(Z_0) = sum(log(1 + exp(vb))) + M * log(K)
+        v_means = tf.nn.sigmoid(self._vb) * tf.ones(tf.stack([self._ais_n_runs, self._n_visible]),
+                                                   dtype=self._tf_dtype)
+        v_0 = self._ais_sample_bernoulli(v_means, self._ais_seed_for(-1))
+        log_Z0 = tf.reduce_sum(tf.nn.softplus(self._vb))
+        log_Z0 += float(self.n_samples) * tf.log(tf.cast(self._n_hidden, dtype=self._tf_dtype))
+        return v_0, log_Z0
+
     def transform(self, *args, **kwargs):
         H = super(MultinomialRBM, self).transform(*args, **kwargs)
         H /= float(self.n_samples)
@@ -106,15 +147,198 @@ class GaussianRBM(BaseRBM):
             self._sigma = tf.reshape(self._sigma, [1, self.n_visible])
             self._X_batch = tf.divide(self._X_batch, self._sigma)
 
-    def _free_energy(self, v):
+    def _restore_tf_params(self):
+        super(GaussianRBM, self)._restore_tf_params()
+        # made in the second 'input_data' name scope, hence uniquified one
+        sigma, = [v for v in tf.global_variables() if v.op.name.endswith('/sigma')]
+        self._sigma = tf.reshape(sigma, [1, self.n_visible])
+        self._X_batch = tf.divide(self._X_batch, self._sigma)
+
+    def _free_energies(self, v):
         with tf.name_scope('free_energy'):
             T1 = tf.divide(tf.reshape(self._vb, [1, self.n_visible]), self._sigma)
             T2 = tf.square(tf.subtract(v, T1))
             T3 = 0.5 * tf.reduce_sum(T2, axis=1)
             T4 = -tf.reduce_sum(tf.nn.softplus(self._propup(v) + self._hb), axis=1)
-            fe = tf.reduce_mean(T3 + T4, axis=0)
+            fe = T3 + T4
         return fe
 
+    # AIS is run on visible units divided by `sigma`, while log(Z) is reported
+    # for the density of the original ones, i.e. it includes sum(log(sigma))
+    def _unnormalized_log_prob_ais(self, v, beta):
+        T1 = tf.divide(tf.reshape(self._vb, [1, self.n_visible]), self._sigma)
+        T2 = -0.5 * tf.reduce_sum(tf.square(v - T1), axis=1)
+        T3 = tf.reduce_sum(tf.nn.softplus(beta * (self._propup(v) + self._hb)), axis=1)
+        return T2 + T3
+
+    def _ais_sample_v_given_h(self, h, beta, seed):
+        T1 = tf.divide(tf.reshape(self._vb, [1, self.n_visible]), self._sigma)
+        return self._ais_sample_gaussian(T1 + beta * self._propdown(h), seed)
+
+    def _make_ais_base(self):
+        # v_0 ~ N(vb / sigma, 1),
+        # log(Z_0) = V/2 * log(2 * pi) + H * log(2) + sum(log(sigma))
+        T1 = tf.divide(tf.reshape(self._vb, [1, self.n_visible]), self._sigma)
+        v_means = T1 * tf.ones(tf.stack([self._ais_n_runs, self._n_visible]), dtype=self._tf_dtype)
+        v_0 = self._ais_sample_gaussian(v_means, self._ais_seed_for(-1))
+        log_Z0 = 0.5 * self.n_visible * np.log(2. * np.pi) + self.n_hidden * np.log(2.)
+        log_Z0 += tf.reduce_sum(tf.log(self._sigma))
+        return v_0, log_Z0
+
+
+class BlockGaussianRBM(GaussianRBM):
+    """Gaussian RBM with block-sparse weights (locally connected).
+
+    Hidden units are split into consecutive blocks, and each block
+    is connected only to its receptive field (a subset of visible units,
+    e.g. a patch of an image). Only the weights within the blocks
+    are stored and learned, and propagations are computed as batched
+    products of small matrices (one batch per run of consecutive blocks
+    of the same shape), which saves both memory and computation when
+    receptive fields are small.
+
+    Note that `W_init` (if iterable) and weights 'W' returned by
+    `get_tf_params` are dense (n_visible, n_hidden) matrices, with
+    zeros outside of the blocks, so that the model can be used (e.g.
+    for DBM pre-training) as any other RBM. Gradients accumulators
+    ('dW') are stored in the packed form.
+
+    Parameters
+    ----------
+    receptive_fields : list of iterables of int
+        Indices of visible units connected to each block.
+    block_sizes : positive int or iterable of such
+        Number of hidden units in each block. `n_hidden` is the sum of those.
+    """
+    def __init__(self, receptive_fields=None, block_sizes=1,
+                 model_path='bg_rbm_model/', *args, **kwargs):
+        if not receptive_fields:
+            raise ValueError('`receptive_fields` should be non-empty')
+        self.receptive_fields = [np.asarray(f, dtype=np.int64).tolist() for f in receptive_fields]
+        self.block_sizes = make_list_from(block_sizes)
+        if len(self.block_sizes) == 1:
+            self.block_sizes *= len(self.receptive_fields)
+        if len(self.block_sizes) != len(self.receptive_fields):
+            raise ValueError('`block_sizes` should be given for each receptive field')
+        n_hidden = sum(self.block_sizes)
+        if kwargs.setdefault('n_hidden', n_hidden) != n_hidden:
+            raise ValueError('`n_hidden` should be equal to the sum of `block_sizes`')
+        super(BlockGaussianRBM, self).__init__(model_path=model_path, *args, **kwargs)
+        for f in self.receptive_fields:
+            if not f or min(f) < 0 or max(f) >= self.n_visible:
+                raise ValueError('receptive fields should be non-empty subsets of visible units')
+
+        # group runs of consecutive blocks of the same shape:
+        # (receptive fields of shape (K, p), block size n, offset of
+        # the first hidden unit, offset of the first packed weight)
+        self._groups = []
+        h_offset = W_offset = 0
+        for f, n in zip(self.receptive_fields, self.block_sizes):
+            if self._groups and self._groups[-1][0][0].shape == (len(f),) and self._groups[-1][1] == n:
+                self._groups[-1][0].append(np.asarray(f))
+            else:
+                self._groups.append(([np.asarray(f)], n, h_offset, W_offset))
+            h_offset += n
+            W_offset += len(f) * n
+        self._n_packed = W_offset
+        self._groups = [(np.stack(g[0]),) + g[1:] for g in self._groups]
+
+    def _W_shape(self):
+        return [self._n_packed]
+
+    def _pack_W(self, W):
+        W = np.asarray(W)
+        blocks = []
+        for fields, n, h_offset, _ in self._groups:
+            for k, f in enumerate(fields):
+                h = h_offset + k * n
+                blocks.append(W[f, h:(h + n)].ravel())
+        return np.concatenate(blocks)
+
+    def _unpack_W(self, W_packed):
+        W = np.zeros((self.n_visible, self.n_hidden), dtype=W_packed.dtype)
+        for fields, n, h_offset, W_offset in self._groups:
+            K, p = fields.shape
+            blocks = W_packed[W_offset:(W_offset + K * p * n)].reshape((K, p, n))
+            for k, f in enumerate(fields):
+                h = h_offset + k * n
+                W[f, h:(h + n)] = blocks[k]
+        return W
+
+    def _W_blocks(self, W, g):
+        """Weights of g-th group as (K, p, n) tensor."""
+        fields, n, _, W_offset = self._groups[g]
+        K, p = fields.shape
+        return tf.reshape(W[W_offset:(W_offset + K * p * n)], [K, p, n])
+
+    def _v_blocks(self, v, g):
+        """Visible units of g-th group as (K, N, p) tensor."""
+        fields = tf.constant(self._groups[g][0], dtype=tf.int32)
+        return tf.transpose(tf.gather(v, fields, axis=1), [1, 0, 2])
+
+    def _h_blocks(self, h, g):
+        """Hidden units of g-th group as (K, N, n) tensor."""
+        fields, n, h_offset, _ = self._groups[g]
+        K = len(fields)
+        h = tf.reshape(h[:, h_offset:(h_offset + K * n)], [-1, K, n])
+        return tf.transpose(h, [1, 0, 2])
+
+    def _dense_W(self):
+        W = 0.
+        for g, (fields, n, h_offset, _) in enumerate(self._groups):
+            K, p = fields.shape
+            v_ind = tf.tile(tf.constant(fields[:, :, np.newaxis], dtype=tf.int32), [1, 1, n])
+            h_ind = h_offset + tf.range(K)[:, None, None] * n + tf.range(n)[None, None, :]
+            h_ind = tf.tile(h_ind, [1, p, 1])
+            ind = tf.stack([v_ind, h_ind], axis=-1)  # (K, p, n, 2)
+            W += tf.scatter_nd(ind, self._W_blocks(self._W, g), [self.n_visible, self.n_hidden])
+        return W
+
+    def _associations(self, v, h):
+        A = []
+        for g in xrange(len(self._groups)):
+            A_g = tf.matmul(self._v_blocks(v, g), self._h_blocks(h, g), transpose_a=True)  # (K, p, n)
+            A.append(tf.reshape(A_g, [-1]))
+        return tf.concat(A, axis=0)
+
+    def _broadcast_to_W(self, x):
+        B = []
+        for fields, n, h_offset, _ in self._groups:
+            K, p = fields.shape
+            x_g = tf.reshape(x[h_offset:(h_offset + K * n)], [K, 1, n])
+            B.append(tf.reshape(tf.tile(x_g, [1, p, 1]), [-1]))
+        return tf.concat(B, axis=0)
+
+    def _propup(self, v, W=None):
+        W = self._W if W is None else W
+        with tf.name_scope('prop_up'):
+            T = []
+            for g in xrange(len(self._groups)):
+                T_g = tf.matmul(self._v_blocks(v, g), self._W_blocks(W, g))  # (K, N, n)
+                T_g = tf.transpose(T_g, [1, 0, 2])
+                T.append(tf.reshape(T_g, [tf.shape(v)[0], -1]))
+            t = tf.concat(T, axis=1)
+        return t
+
+    def _propdown(self, h, W=None):
+        W = self._W if W is None else W
+        with tf.name_scope('prop_down'):
+            t = 0.
+            for g, (fields, _, _, _) in enumerate(self._groups):
+                T_g = tf.matmul(self._h_blocks(h, g), self._W_blocks(W, g),
+                                transpose_b=True)  # (K, N, p)
+                T_g = tf.reshape(tf.transpose(T_g, [0, 2, 1]), [-1, tf.shape(h)[0]])  # (K * p, N)
+                t += tf.unsorted_segment_sum(T_g, fields.ravel(), self.n_visible)
+            t = tf.transpose(t)
+        return t
+
+    def get_tf_params(self, scope=None):
+        params = super(BlockGaussianRBM, self).get_tf_params(scope=scope)
+        for k in params:
+            if k in ('W', 'weights/W'):
+                params[k] = self._unpack_W(params[k])
+        return params
+
 
 def logit_mean(X):
     p = np.mean(X, axis=0)
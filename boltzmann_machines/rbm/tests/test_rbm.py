@@ -1,12 +1,19 @@
 import os
+import sys
+import json
+import subprocess
 import numpy as np
+import tensorflow as tf
 from shutil import rmtree
+from textwrap import dedent
 from numpy.testing import (assert_allclose,
                            assert_almost_equal,
                            assert_raises)
 
-from boltzmann_machines.rbm import BernoulliRBM, MultinomialRBM, GaussianRBM
-from boltzmann_machines.utils import RNG
+from boltzmann_machines import NumpyRBM, fit_parallel
+from boltzmann_machines.rbm import (BernoulliRBM, MultinomialRBM, GaussianRBM,
+                                    BlockGaussianRBM)
+from boltzmann_machines.utils import RNG, ChunkedArray, TransformCache, batch_iter
 
 
 class TestRBM(object):
@@ -22,7 +29,7 @@ class TestRBM(object):
                                random_seed=1337)
 
     def cleanup(self):
-        for d in ('test_rbm_1/', 'test_rbm_2/'):
+        for d in ('test_rbm_1/', 'test_rbm_2/', 'test_rbm_3/'):
             if os.path.exists(d):
                 rmtree(d)
 
@@ -42,6 +49,17 @@ class TestRBM(object):
         assert_allclose(rbm1_weights['hb'], rbm2_weights['hb'])
         assert_allclose(rbm1_weights['vb'], rbm2_weights['vb'])
 
+    def free_energy(self, rbm, weights, V):
+        """Reference free energies of `V` (sigma = 1.)."""
+        from scipy.misc import logsumexp
+        W, vb, hb = weights['W'], weights['vb'], weights['hb']
+        if isinstance(rbm, MultinomialRBM):
+            return -V.dot(vb) - rbm.n_samples * logsumexp(V.dot(W) + hb, axis=1)
+        if isinstance(rbm, GaussianRBM):
+            return 0.5 * np.sum((V - vb) ** 2, axis=1) - \
+                   np.logaddexp(0., V.dot(W) + hb).sum(axis=1)
+        return -V.dot(vb) - np.logaddexp(0., V.dot(W) + hb).sum(axis=1)
+
     def compare_transforms(self, rbm1, rbm2):
         H1 = rbm1.transform(self.X_val)
         H2 = rbm2.transform(self.X_val)
@@ -130,5 +148,511 @@ class TestRBM(object):
         # cleanup
         self.cleanup()
 
+    def test_consistency_stage_input(self):
+        rbm1 = BernoulliRBM(max_epoch=2,
+                            model_path='test_rbm_1/',
+                            stage_input=True,
+                            **self.rbm_config)
+        rbm2 = BernoulliRBM(max_epoch=2,
+                            model_path='test_rbm_2/',
+                            stage_input=True,
+                            **self.rbm_config)
+        rbm3 = BernoulliRBM(max_epoch=2,
+                            model_path='test_rbm_3/',
+                            stage_input=True,
+                            **self.rbm_config)
+        W_init = rbm3.init().get_tf_params(scope='weights')['W']
+
+        rbm1.fit(self.X, self.X_val)
+        rbm2.fit(self.X, self.X_val)
+
+        self.compare_weights(rbm1, rbm2)
+        self.compare_transforms(rbm1, rbm2)
+        assert not np.allclose(rbm1.get_tf_params(scope='weights')['W'], W_init)
+
+        # train for 1 more epoch after loading from disk
+        rbm1 = BernoulliRBM.load_model('test_rbm_1/')
+        rbm2 = BernoulliRBM.load_model('test_rbm_2/')
+        rbm1.set_params(max_epoch=rbm1.max_epoch + 1).fit(self.X)
+        rbm2.set_params(max_epoch=rbm2.max_epoch + 1).fit(self.X)
+
+        self.compare_weights(rbm1, rbm2)
+        self.compare_transforms(rbm1, rbm2)
+
+        # cleanup
+        self.cleanup()
+
+    def test_async_saves(self):
+        # checkpoints written in background are the same as written synchronously
+        for i, max_pending_saves in enumerate((0, 2)):
+            rbm = BernoulliRBM(max_epoch=4,
+                               model_path='test_rbm_{0}/'.format(i + 1),
+                               tf_saver_params=dict(max_to_keep=2),
+                               max_pending_saves=max_pending_saves,
+                               **self.rbm_config)
+            rbm.fit(self.X)
+            assert sorted(f for f in os.listdir(rbm._model_dirpath) if f.endswith('.index')) == \
+                   ['model-4.index', 'model.index']
+        rbm1 = BernoulliRBM.load_model('test_rbm_1/')
+        rbm2 = BernoulliRBM.load_model('test_rbm_2/')
+        self.compare_weights(rbm1, rbm2)
+
+        # cleanup
+        self.cleanup()
+
+    def test_fuse_train_steps(self):
+        # w/o sampling and dropout CD-k is deterministic, so fused
+        # updates should match the ones applied one at a time
+        config = dict(n_visible=self.n_visible, n_hidden=self.n_hidden,
+                      W_init=RNG(seed=1).randn(self.n_visible, self.n_hidden) * 0.1,
+                      sample_v_states=False, sample_h_states=False,
+                      sparsity_cost=1e-2, max_epoch=2, batch_size=3,
+                      metrics_config=dict(msre=True, train_metrics_every_iter=4),
+                      verbose=False, random_seed=1337)
+        block_params = dict(receptive_fields=[range(4), range(4, 8), range(2, 6), range(self.n_visible)],
+                            block_sizes=[2, 2, 2, 2])
+        for rbm_cls, params in ((BernoulliRBM, {}), (BlockGaussianRBM, block_params)):
+            rbm1 = rbm_cls(model_path='test_rbm_1/', **dict(config, **params))
+            rbm2 = rbm_cls(model_path='test_rbm_2/', fuse_train_steps=True, **dict(config, **params))
+            rbm1.fit(self.X)
+            rbm2.fit(self.X)
+
+            assert rbm1.iter_ == rbm2.iter_ == 12
+            for scope in ('weights', 'grads_accumulators', 'hidden_activations_means'):
+                rbm1_params = rbm1.get_tf_params(scope=scope)
+                rbm2_params = rbm2.get_tf_params(scope=scope)
+                for k in rbm1_params:
+                    assert_allclose(rbm1_params[k], rbm2_params[k], rtol=1e-5, atol=1e-6)
+
+            # cleanup
+            self.cleanup()
+
+    def test_chunked_array(self):
+        X = RNG(seed=1337).randint(256, size=(16, self.n_visible)).astype(np.uint8)
+        rbm1 = BernoulliRBM(max_epoch=2,
+                            model_path='test_rbm_1/',
+                            **self.rbm_config)
+        rbm2 = BernoulliRBM(max_epoch=2,
+                            model_path='test_rbm_2/',
+                            **self.rbm_config)
+        rbm1.fit(X / 255.)
+        rbm2.fit(ChunkedArray([X[:5], X[5:]], scale=1. / 255.))
+        rbm1_weights = rbm1.get_tf_params(scope='weights')
+        rbm2_weights = rbm2.get_tf_params(scope='weights')
+        for k in ('W', 'vb', 'hb'):
+            assert_allclose(rbm1_weights[k], rbm2_weights[k], atol=1e-6)
+
+        # cleanup
+        self.cleanup()
+
+    def test_fit_parallel(self):
+        rbm1 = BernoulliRBM(max_epoch=2,
+                            model_path='test_rbm_1/',
+                            **self.rbm_config)
+        rbm1.fit(self.X, self.X_val)
+
+        rbms = [BernoulliRBM(max_epoch=2, model_path='test_rbm_{0}/'.format(i), **self.rbm_config)
+                for i in (1, 2, 3)]
+        data = [(self.X, self.X_val), (self.X, None), lambda: (self.X, self.X_val)]
+        # (sessions were already run in this process, so no forking)
+        rbms = fit_parallel(rbms, data, n_jobs=1)
+
+        # already trained model is not retrained
+        self.compare_weights(rbm1, rbms[0])
+        self.compare_weights(rbms[0], rbms[2])
+        for rbm in rbms:
+            assert rbm.epoch_ == 2
+
+        # second call skips all of them
+        mtimes = [os.path.getmtime(rbm._params_filepath) for rbm in rbms]
+        fit_parallel(rbms, data, n_jobs=1)
+        assert mtimes == [os.path.getmtime(rbm._params_filepath) for rbm in rbms]
+
+        # cleanup
+        self.cleanup()
+
+    def test_fit_parallel_n_jobs(self):
+        # workers are forked, so train in a fresh process,
+        # where no TF session was run yet
+        np.save('test_rbm_X.npy', self.X)
+        np.save('test_rbm_X_val.npy', self.X_val)
+        code = dedent('''
+            import os, sys, json
+            import numpy as np
+            from boltzmann_machines import fit_parallel
+            from boltzmann_machines.rbm import BernoulliRBM
+
+            X, X_val = np.load('test_rbm_X.npy'), np.load('test_rbm_X_val.npy')
+            rbms = [BernoulliRBM(max_epoch=2, model_path='test_rbm_{0}/'.format(i),
+                                 **json.loads(sys.argv[1])) for i in (1, 2, 3)]
+            data = [(X, X_val), (X, None), lambda: (X, X_val)]
+            fit_parallel(rbms, data, n_jobs=2)
+
+            # second call skips already trained models
+            mtimes = [os.path.getmtime(rbm._params_filepath) for rbm in rbms]
+            fit_parallel(rbms, data, n_jobs=2)
+            assert mtimes == [os.path.getmtime(rbm._params_filepath) for rbm in rbms]
+        ''')
+        try:
+            subprocess.check_call([sys.executable, '-c', code, json.dumps(self.rbm_config)])
+        finally:
+            for fname in ('test_rbm_X.npy', 'test_rbm_X_val.npy'):
+                os.remove(fname)
+
+        rbms = [BernoulliRBM.load_model('test_rbm_{0}/'.format(i)) for i in (1, 2, 3)]
+        self.compare_weights(rbms[0], rbms[2])
+        for rbm in rbms:
+            assert rbm.epoch_ == 2
+
+        # cleanup
+        self.cleanup()
+
+    def test_block_gaussian_rbm(self):
+        fields = [range(4), range(4, 8), range(2, 6), range(self.n_visible)]
+        block_sizes = [2, 2, 2, 2]
+        mask = np.zeros((self.n_visible, self.n_hidden))
+        for k, f in enumerate(fields):
+            mask[f, 2 * k:2 * (k + 1)] = 1.
+        # w/o sampling, one step of block RBM should match the step
+        # of dense RBM restricted to the blocks
+        config = dict(n_visible=self.n_visible, n_hidden=self.n_hidden,
+                      W_init=mask * RNG(seed=1).randn(self.n_visible, self.n_hidden) * 0.1,
+                      sample_v_states=False, sample_h_states=False,
+                      sparsity_cost=1e-2, max_epoch=1, batch_size=len(self.X),
+                      verbose=False, random_seed=1337)
+        rbm1 = GaussianRBM(model_path='test_rbm_1/', **config)
+        rbm2 = BlockGaussianRBM(receptive_fields=fields, block_sizes=block_sizes,
+                                model_path='test_rbm_2/', **config)
+        rbm1.fit(self.X)
+        rbm2.fit(self.X)
+        rbm1_weights = rbm1.get_tf_params(scope='weights')
+        rbm2_weights = rbm2.get_tf_params(scope='weights')
+        assert rbm2.get_tf_params(scope='grads_accumulators')['dW'].shape == (4 * 2 * 3 + 12 * 2,)
+        assert_allclose(mask * rbm1_weights['W'], rbm2_weights['W'], atol=1e-6)
+        assert np.all(rbm2_weights['W'][mask == 0] == 0.)
+        for k in ('vb', 'hb'):
+            assert_allclose(rbm1_weights[k], rbm2_weights[k], atol=1e-6)
+
+        # cleanup
+        self.cleanup()
+
+    def test_transform_cache(self):
+        rbm = BernoulliRBM(max_epoch=1,
+                           model_path='test_rbm_1/',
+                           **self.rbm_config)
+        rbm.fit(self.X)
+        rbm.set_transform_cache(TransformCache('test_rbm_1/cache/'))
+        # transform is stochastic, so cache hit returns exactly the same result
+        H = rbm.transform(self.X_val)
+        memo = rbm._checkpoint_fingerprint_memo
+        assert_allclose(rbm.transform(self.X_val), H)
+        assert len(rbm._transform_cache._load_index()) == 1
+        # (checkpoint is not rehashed while its files are unchanged)
+        assert rbm._checkpoint_fingerprint_memo is memo
+
+        # new checkpoint or data result in cache miss
+        rbm.set_params(max_epoch=2).fit(self.X)
+        rbm.transform(self.X_val)
+        assert rbm._checkpoint_fingerprint_memo[1] != memo[1]
+        rbm.transform(self.X_val[:4])
+        assert len(rbm._transform_cache._load_index()) == 3
+
+        # cleanup
+        self.cleanup()
+
+    def test_log_Z(self):
+        from itertools import product
+        from scipy.misc import logsumexp
+        V = np.array(list(product([0., 1.], repeat=self.n_visible)))
+        H = np.array(list(product([0., 1.], repeat=self.n_hidden)))
+        for C in (BernoulliRBM, MultinomialRBM, GaussianRBM):
+            rbm = C(max_epoch=1,
+                    W_init=0.3,
+                    model_path='test_rbm_1/',
+                    metrics_config=dict(ais=True, ais_every_epoch=1),
+                    **self.rbm_config)
+            rbm.fit(self.X, self.X_val)
+            weights = rbm.get_tf_params(scope='weights')
+            W, vb, hb = weights['W'], weights['vb'], weights['hb']
+            # exact log Z (sigma = 1.)
+            if C is BernoulliRBM:
+                log_Z = logsumexp(V.dot(vb) + np.logaddexp(0., V.dot(W) + hb).sum(axis=1))
+            if C is MultinomialRBM:
+                log_Z = logsumexp(V.dot(vb) + rbm.n_samples * logsumexp(V.dot(W) + hb, axis=1))
+            if C is GaussianRBM:
+                T = 0.5 * np.sum((vb + H.dot(W.T)) ** 2, axis=1) - 0.5 * np.sum(vb ** 2)
+                log_Z = logsumexp(H.dot(hb) + T) + 0.5 * self.n_visible * np.log(2. * np.pi)
+
+            log_mean, _, values = rbm.log_Z(n_betas=500, n_runs=20, n_gibbs_steps=1, chunk_size=128)
+            assert len(values) == 20
+            assert_allclose(log_mean, log_Z, atol=0.1)
+
+            # cleanup
+            self.cleanup()
+
+    def test_pll_n_flips(self):
+        X = (self.X > 0.5).astype(np.float32)
+        for C in (BernoulliRBM, MultinomialRBM):
+            rbm = C(max_epoch=1,
+                    W_init=0.3,
+                    model_path='test_rbm_1/',
+                    metrics_config=dict(pll=True, pll_n_flips=self.n_visible),
+                    **dict(self.rbm_config, dropout=None))
+            rbm.fit(X)
+            weights = rbm.get_tf_params(scope='weights')
+            log_p = lambda V: -self.free_energy(rbm, weights, V)
+            # exact PLL
+            pll = 0.
+            for i in xrange(self.n_visible):
+                X_flipped = X.copy()
+                X_flipped[:, i] = 1. - X_flipped[:, i]
+                pll -= np.mean(np.logaddexp(0., log_p(X_flipped) - log_p(X)))
+
+            with rbm.load_graph():
+                pll_op = rbm._tf_graph.get_collection('pll')[0]
+                assert_allclose(rbm._tf_session.run(pll_op, feed_dict={'input_data/X_batch:0': X}),
+                                pll, rtol=1e-5)
+
+            # cleanup
+            self.cleanup()
+
+    def test_lazy_metrics(self):
+        rbm = BernoulliRBM(max_epoch=1,
+                           model_path='test_rbm_1/',
+                           metrics_config=dict(msre=True, feg=True),
+                           **self.rbm_config)
+        rbm.fit(self.X, self.X_val)
+        with rbm.load_graph():
+            collections = rbm._tf_graph.get_all_collection_keys()
+        assert 'msre' in collections and 'feg' in collections
+        assert 'pll' not in collections and 'l2_loss' not in collections
+
+        # metrics cannot be enabled once the graph is built
+        rbm.set_params(metrics_config=dict(rbm.metrics_config, pll=True), max_epoch=2)
+        assert_raises(ValueError, rbm.fit, self.X, self.X_val)
+
+        # cleanup
+        self.cleanup()
+
+    def test_metrics_accumulators(self):
+        rbm = BernoulliRBM(n_visible=self.n_visible, n_hidden=self.n_hidden,
+                           sample_v_states=False, sample_h_states=False,
+                           max_epoch=1, batch_size=3, model_path='test_rbm_1/',
+                           metrics_config=dict(msre=True),
+                           verbose=False, random_seed=1337)
+        with rbm:
+            rbm.fit(self.X)
+            weights = rbm.get_tf_params(scope='weights')
+            val_results = rbm._run_val_metrics(self.X_val)
+        # average of per batch values
+        sigmoid = lambda x: 1. / (1. + np.exp(-x))
+        msres = []
+        for X_vb in batch_iter(self.X_val, batch_size=3):
+            H = sigmoid(X_vb.dot(weights['W']) + weights['hb'])
+            V = sigmoid(H.dot(weights['W'].T) + weights['vb'])
+            msres.append(np.mean((X_vb - V) ** 2))
+        assert_allclose(val_results['msre'], np.mean(msres), rtol=1e-5)
+
+        # cleanup
+        self.cleanup()
+
+    def test_feg(self):
+        for C in (BernoulliRBM, MultinomialRBM, GaussianRBM):
+            # subsets cover whole training and validation sets
+            rbm = C(max_epoch=1,
+                    model_path='test_rbm_1/',
+                    metrics_config=dict(feg=True, n_batches_for_feg=100),
+                    **self.rbm_config)
+            with rbm:
+                rbm.fit(self.X, self.X_val)
+                weights = rbm.get_tf_params(scope='weights')
+                feg = rbm._run_feg()
+            F_val = self.free_energy(rbm, weights, self.X_val)
+            F_train = self.free_energy(rbm, weights, self.X)
+            assert_allclose(feg, np.mean(F_val) - np.mean(F_train), atol=1e-5)
+
+            # cleanup
+            self.cleanup()
+
+    def test_free_energy(self):
+        np.save('test_rbm_2.npy', self.X_val)
+        X_val = np.load('test_rbm_2.npy', mmap_mode='r')
+        for C in (BernoulliRBM, MultinomialRBM, GaussianRBM):
+            rbm = C(max_epoch=1,
+                    model_path='test_rbm_1/',
+                    **self.rbm_config)
+            rbm.fit(self.X)
+            F = self.free_energy(rbm, rbm.get_tf_params(scope='weights'), X_val)
+            assert_allclose(rbm.free_energy(X_val, batch_size=3), F, rtol=1e-5)
+            assert_allclose(rbm.score_samples(X_val), -F, rtol=1e-5)
+            top_3 = np.argsort(-F)[:3]
+            assert_allclose(rbm.score_samples(X_val, top_k=3, batch_size=5), top_3)
+
+            np_rbm = NumpyRBM.from_model(rbm, batch_size=3)
+            assert_allclose(np_rbm.free_energy(X_val), F, rtol=1e-5)
+            assert_allclose(np_rbm.score_samples(X_val, top_k=3), top_3)
+
+            # cleanup
+            self.cleanup()
+        os.remove('test_rbm_2.npy')
+
+    def test_warm_session(self):
+        rbm = BernoulliRBM(max_epoch=2,
+                           model_path='test_rbm_1/',
+                           **self.rbm_config)
+        rbm.fit(self.X)
+        weights = rbm.get_tf_params(scope='weights')
+
+        with rbm:
+            H = rbm.transform(self.X_val)
+            session = rbm._tf_session
+            assert session is not None
+            assert H.shape == (len(self.X_val), self.n_hidden)
+            assert_allclose(rbm.get_tf_params(scope='weights')['W'], weights['W'])
+            assert rbm._tf_session is session
+
+            # session is rebuilt once parameters change
+            rbm.set_params(max_epoch=rbm.max_epoch + 1)
+            assert rbm._tf_session is None
+            rbm.fit(self.X)
+            assert rbm._tf_session is not None
+            assert rbm._tf_session is not session
+        assert rbm._tf_session is None
+
+        # graph can be loaded explicitly, and is reused by later calls
+        with rbm.load_graph():
+            session = rbm._tf_session
+            assert session is not None
+            assert 'transform_op' in rbm._tf_graph.get_all_collection_keys()
+            rbm.transform(self.X_val)
+            assert rbm._tf_session is session
+        assert rbm._tf_session is None
+        assert_raises(RuntimeError, BernoulliRBM().load_graph)
+
+        # cleanup
+        self.cleanup()
+
+    def test_numpy_inference(self):
+        for C in (BernoulliRBM, MultinomialRBM, GaussianRBM):
+            # no Gibbs steps (after the first epoch) and no dropout
+            # when transforming, as NumpyRBM computes E(h|v) of the data
+            rbm = C(max_epoch=1,
+                    model_path='test_rbm_1/',
+                    **dict(self.rbm_config, n_gibbs_steps=[1, 0], dropout=None))
+            rbm.fit(self.X)
+            weights = rbm.get_tf_params(scope='weights')
+            T = self.X_val.dot(weights['W']) + weights['hb']
+            if C is BernoulliRBM:
+                H = 1. / (1. + np.exp(-T))
+            if C is MultinomialRBM:
+                H = np.exp(T) / np.exp(T).sum(axis=1)[:, np.newaxis]
+            if C is GaussianRBM:  # sigma = 1.
+                H = 1. / (1. + np.exp(-T))
+
+            np_rbm = NumpyRBM.from_model(rbm, batch_size=3)
+            assert_allclose(np_rbm.transform(self.X_val), H, rtol=1e-5)
+            assert_allclose(np_rbm.transform(self.X_val), rbm.transform(self.X_val), rtol=1e-5)
+            assert_allclose(np_rbm.transform(ChunkedArray([self.X_val[:5], self.X_val[5:]])), H, rtol=1e-5)
+
+            np_rbm.save('test_rbm_1/np_rbm.npz')
+            np_rbm = NumpyRBM.load('test_rbm_1/np_rbm.npz')
+            assert_allclose(np_rbm.transform(self.X_val), H, rtol=1e-5)
+
+            # cleanup
+            self.cleanup()
+
+    def test_array_params(self):
+        # arrays of any size are stored next to JSON manifest, and restored exactly
+        W_init = RNG(seed=1337).randn(1200, 1000).astype(np.float32)
+        vb_init = RNG(seed=42).randn(1200)
+        rbm = BernoulliRBM(n_visible=1200, n_hidden=1000, W_init=W_init, vb_init=vb_init,
+                           max_epoch=1, model_path='test_rbm_1/', verbose=False, random_seed=1337)
+        rbm.init()
+        assert os.path.getsize('test_rbm_1/params.json') < 10000
+        rbm = BernoulliRBM.load_model('test_rbm_1/')
+        assert_allclose(rbm.W_init, W_init, rtol=0, atol=0)
+        assert_allclose(rbm.vb_init, vb_init, rtol=0, atol=0)
+        assert rbm.W_init.dtype == np.float32
+        mtime = os.path.getmtime('test_rbm_1/params_arrays/W_init.npy')
+        rbm.fit(RNG(seed=1).rand(4, 1200))
+        assert os.path.getmtime('test_rbm_1/params_arrays/W_init.npy') == mtime
+        assert rbm.make_random_seed() == BernoulliRBM.load_model('test_rbm_1/').make_random_seed()
+
+        # cleanup
+        self.cleanup()
+
+    def test_legacy_checkpoint(self):
+        vb_init = RNG(seed=42).randn(self.n_visible)
+        rbm = BernoulliRBM(vb_init=vb_init, max_epoch=1,
+                           model_path='test_rbm_1/', **self.rbm_config)
+        rbm.fit(self.X)
+        rbm = BernoulliRBM.load_model('test_rbm_1/')
+
+        # convert checkpoint to the old format, with arrays stored as
+        # lists in params.json and random state in random_state.json
+        with open('test_rbm_1/params.json', 'r') as f:
+            params = json.load(f)
+        for k, v in params.items():
+            if isinstance(v, dict) and '__ndarray__' in v:
+                params[k] = np.load(os.path.join('test_rbm_1/params_arrays/', v['__ndarray__'])).tolist()
+        with open('test_rbm_1/params.json', 'w') as f:
+            json.dump(params, f)
+        rmtree('test_rbm_1/params_arrays/')
+        with open('test_rbm_1/random_state.json', 'w') as f:
+            json.dump(RNG().load_state('test_rbm_1/random_state.npz').get_state(), f)
+        os.remove('test_rbm_1/random_state.npz')
+
+        legacy_rbm = BernoulliRBM.load_model('test_rbm_1/')
+        assert_allclose(legacy_rbm.vb_init, vb_init)
+        assert legacy_rbm.make_random_seed() == rbm.make_random_seed()
+        self.compare_weights(legacy_rbm, rbm)
+
+        # ops missing from the old graph are made on demand
+        meta_graph = tf.MetaGraphDef()
+        with open(legacy_rbm._tf_meta_graph_filepath, 'rb') as f:
+            meta_graph.ParseFromString(f.read())
+        del meta_graph.collection_def['free_energies']
+        with open(legacy_rbm._tf_meta_graph_filepath, 'wb') as f:
+            f.write(meta_graph.SerializeToString())
+        legacy_rbm = BernoulliRBM.load_model('test_rbm_1/')
+        assert_allclose(legacy_rbm.free_energy(self.X), rbm.free_energy(self.X), rtol=1e-6)
+
+        # cleanup
+        self.cleanup()
+
+    def test_inference_batch_size(self):
+        # inference batch size does not depend on the one used for training
+        rbm = BernoulliRBM(n_visible=self.n_visible, n_hidden=self.n_hidden,
+                           sample_v_states=False, sample_h_states=False, n_gibbs_steps=[1, 2],
+                           max_epoch=1, batch_size=5, model_path='test_rbm_1/',
+                           verbose=False, random_seed=1337)
+        rbm.fit(self.X)
+        H = rbm.transform(self.X)
+        # float32 input, hidden pre-activations and activations per example
+        assert rbm._inference_batch_size(max_memory=1000) == 1000 // (4 * (12 + 2 * 8))
+        for kwargs in (dict(batch_size=3), dict(batch_size=100), dict(max_memory=1000)):
+            assert_allclose(rbm.transform(self.X, **kwargs), H, rtol=1e-5)
+
+        # cleanup
+        self.cleanup()
+
+    def test_sample(self):
+        # samples depend only on the seed, not on how chains are split into chunks
+        rbm = BernoulliRBM(max_epoch=2, model_path='test_rbm_1/', **self.rbm_config)
+        rbm.fit(self.X)
+        kwargs = dict(n_gibbs_steps=2, burn_in=3, thin=2, n_chains=10, random_seed=1337)
+        V1 = rbm.sample(95, chunk_size=3, **kwargs)
+        V2 = rbm.sample(95, out='test_rbm_1/samples.npy', **kwargs)
+        assert V1.shape == (95, self.n_visible)
+        assert isinstance(V2, np.memmap)
+        assert_allclose(V1, np.load('test_rbm_1/samples.npy'))
+        assert set(np.unique(V1)) == {0., 1.}
+        V_means = rbm.sample(8, v_init=self.X[:4], means=True)
+        assert V_means.shape == (8, self.n_visible)
+        assert np.all((V_means > 0.) & (V_means < 1.))
+
+        # cleanup
+        self.cleanup()
+
     def tearDown(self):
         self.cleanup()
@@ -0,0 +1,234 @@
+import os
+import numpy as np
+import tensorflow as tf
+from glob import glob
+from shutil import rmtree
+from itertools import product
+from scipy.misc import logsumexp
+from numpy.testing import assert_allclose, assert_raises
+
+from boltzmann_machines import DBM, NumpyDBM
+from boltzmann_machines.rbm import BernoulliRBM, GaussianRBM
+from boltzmann_machines.utils import RNG, ChunkedArray
+
+
+def exact_log_Z_and_log_p(dbm, X, sigma=None):
+    """Exact log(Z) of Bernoulli (or Gaussian-visible, if `sigma` is given)
+    DBM and log p(v) of `X`, by enumerating all states of hidden layers."""
+    weights = dbm.get_tf_params(scope='weights')
+    n_layers = dbm.n_layers_
+    W = [weights['W']] + [weights['W_{0}'.format(i)] for i in xrange(1, n_layers)]
+    b = [weights['vb'], weights['hb']] + [weights['hb_{0}'.format(i)] for i in xrange(1, n_layers)]
+
+    log_Z_terms, log_p_terms = [], []
+    for H in product(*[product([0., 1.], repeat=n) for n in dbm.n_hiddens_]):
+        H = map(np.asarray, H)
+        a = sum(h.dot(b_h) for h, b_h in zip(H, b[1:]))
+        a += sum(H[i].dot(W[i + 1]).dot(H[i + 1]) for i in xrange(n_layers - 1))
+        t = W[0].dot(H[0])
+        if sigma is None:
+            log_Z_terms.append(a + np.logaddexp(0., b[0] + t).sum())
+            log_p_terms.append(a + X.dot(b[0] + t))
+        else:
+            # Gaussian integral over visible units
+            log_Z_terms.append(a + (b[0] * t / sigma + t ** 2 / 2.).sum() +
+                               len(t) * np.log(np.sqrt(2. * np.pi) * sigma))
+            log_p_terms.append(a - ((X - b[0]) ** 2).sum(axis=1) / (2. * sigma ** 2) +
+                               X.dot(t) / sigma)
+    log_Z = logsumexp(log_Z_terms)
+    return log_Z, logsumexp(log_p_terms, axis=0) - log_Z
+
+
+class TestDBM(object):
+    def __init__(self):
+        self.n_units = (12, 8, 6)
+        self.X = (RNG(seed=1337).rand(40, self.n_units[0]) > 0.5).astype(np.float32)
+        self.rbm_config = dict(max_epoch=1, batch_size=10,
+                               verbose=False, random_seed=1337)
+        self.dbm_config = dict(n_particles=10, max_epoch=2, batch_size=10,
+                               verbose=False, random_seed=1337)
+
+    def cleanup(self):
+        for d in glob('test_dbm_*/'):
+            rmtree(d)
+
+    def make_rbms(self, n_units=None, X=None, v_rbm_cls=BernoulliRBM,
+                  rbm_config=None, v_rbm_params=None):
+        """Pre-train RBMs with `n_units` units per layer
+        (the first one of class `v_rbm_cls`) on `X`."""
+        n_units = n_units or self.n_units
+        X = self.X if X is None else X
+        rbm_config = dict(self.rbm_config, **(rbm_config or {}))
+        rbms, Q = [], X
+        for i in xrange(len(n_units) - 1):
+            rbm_cls, rbm_params = BernoulliRBM, {}
+            if i == 0:
+                rbm_cls, rbm_params = v_rbm_cls, v_rbm_params or {}
+            rbm = rbm_cls(n_visible=n_units[i], n_hidden=n_units[i + 1],
+                          dbm_first=(i == 0), dbm_last=(i == len(n_units) - 2),
+                          model_path='test_dbm_rbm_{0}/'.format(i + 1),
+                          **dict(rbm_config, **rbm_params))
+            rbm.fit(Q)
+            rbms.append(rbm)
+            Q = rbm.transform(Q)
+        return rbms
+
+    def make_dbm(self, n_units=None, X=None, v_rbm_cls=BernoulliRBM,
+                 rbm_config=None, v_rbm_params=None, **params):
+        """Jointly train DBM from RBMs pre-trained by `make_rbms`."""
+        X = self.X if X is None else X
+        rbms = self.make_rbms(n_units=n_units, X=X, v_rbm_cls=v_rbm_cls,
+                              rbm_config=rbm_config, v_rbm_params=v_rbm_params)
+        dbm = DBM(rbms=rbms, model_path='test_dbm_1/',
+                  **dict(self.dbm_config, **params))
+        dbm.fit(X)
+        return dbm
+
+    def test_numpy_inference(self):
+        dbm = self.make_dbm()
+        np_dbm = NumpyDBM.from_model(dbm, batch_size=7)
+        assert_allclose(np_dbm.transform(self.X), dbm.transform(self.X), atol=1e-5)
+        assert_allclose(np_dbm.reconstruct(self.X), dbm.reconstruct(self.X), atol=1e-5)
+
+        # input is read batch by batch
+        X_chunked = ChunkedArray([self.X[:15], self.X[15:]])
+        assert_allclose(np_dbm.transform(X_chunked), np_dbm.transform(self.X))
+        assert_allclose(np_dbm.reconstruct(X_chunked), np_dbm.reconstruct(self.X))
+
+        # cleanup
+        self.cleanup()
+
+    def test_chunked_array(self):
+        # uint8 data is read batch by batch and converted on the fly
+        class NoArrayChunkedArray(ChunkedArray):
+            def __array__(self, dtype=None):
+                raise AssertionError('whole array should not be loaded')
+
+        dbm = self.make_dbm()
+        X_uint8 = (self.X * 255).astype(np.uint8)
+        X_chunked = NoArrayChunkedArray([X_uint8[:15], X_uint8[15:]], scale=1. / 255.)
+        X_recon = dbm.reconstruct(X_chunked)
+        assert X_recon.dtype == np.float32
+        assert X_recon.shape == self.X.shape
+        assert np.all((X_recon > 0.) & (X_recon < 1.))
+        assert_allclose(X_recon, dbm.reconstruct(self.X), atol=1e-6)
+        assert_allclose(dbm.transform(X_chunked), dbm.transform(self.X), atol=1e-6)
+
+        # cleanup
+        self.cleanup()
+
+    def test_inference_batch_size(self):
+        # mean-field state does not depend on batch size, and incomplete
+        # last batches are handled correctly
+        dbm = self.make_dbm()
+        H = dbm.transform(self.X)
+        log_p = dbm.log_proba(self.X, 0.)
+        for batch_size in (3, 7, 17, 64):
+            assert len(self.X) % batch_size != 0
+            assert_allclose(dbm.transform(self.X, batch_size=batch_size), H, atol=1e-6)
+            assert_allclose(dbm.log_proba(self.X, 0., batch_size=batch_size), log_p, rtol=1e-6)
+
+        # cleanup
+        self.cleanup()
+
+    def test_mf_per_sample(self):
+        # per-sample and batch convergence yield the same mean-field
+        # fixed points (for the same weights)
+        rbms = self.make_rbms()
+        results = []
+        for mf_per_sample in (False, True):
+            dbm = DBM(rbms=rbms, model_path='test_dbm_{0}/'.format(1 + mf_per_sample),
+                      mf_per_sample=mf_per_sample, mf_tol=1e-5, max_mf_updates=100,
+                      **self.dbm_config).init()
+            results.append((dbm.transform(self.X), dbm.log_proba(self.X, 0.)))
+        assert_allclose(results[1][0], results[0][0], atol=1e-4)
+        assert_allclose(results[1][1], results[0][1], rtol=1e-4)
+
+        # number of updates per sample is summarized when training
+        self.cleanup()
+        dbm = self.make_dbm(mf_per_sample=True, train_metrics_every_iter=1)
+        tags = set()
+        for filepath in glob(os.path.join(dbm._train_summary_dirpath, 'events.*')):
+            for event in tf.train.summary_iterator(filepath):
+                tags.update(v.tag for v in event.summary.value if v.HasField('histo'))
+        assert any(tag.endswith('n_mf_updates_per_sample') for tag in tags)
+
+        # cleanup
+        self.cleanup()
+
+    def test_sample_v(self):
+        dbm = self.make_dbm()
+        particles = dbm.get_tf_params(scope='negative_particles')
+        V = dbm.sample_v(n_particles=25)
+        assert V.shape == (25, self.n_units[0])
+
+        # new chains cycle through the stored particles, and visible means
+        # w/o Gibbs steps depend only on the particles of the first hidden layer
+        weights = dbm.get_tf_params(scope='weights')
+        H = particles['h_particle/h']
+        V_expected = 1. / (1. + np.exp(-H.dot(weights['W'].T) - weights['vb']))
+        assert_allclose(V[:10], V_expected, atol=1e-5)
+        assert_allclose(V[10:20], V[:10])
+        assert_allclose(V[20:], V[:5])
+
+        # stored particles are left intact
+        dbm.sample_v(n_gibbs_steps=3, n_particles=5)
+        for k, v in dbm.get_tf_params(scope='negative_particles').items():
+            assert_allclose(v, particles[k], rtol=0, atol=0)
+
+        # cleanup
+        self.cleanup()
+
+    def test_log_Z_and_log_proba(self):
+        X = self.X[:, :5]
+        X_gauss = RNG(seed=42).randn(40, 5).astype(np.float32)
+        for X, v_rbm_cls, sigma in (
+                (X, BernoulliRBM, None),
+                (X_gauss, GaussianRBM, 0.7),
+        ):
+            v_rbm_params = {} if sigma is None else dict(sigma=sigma)
+            dbm = self.make_dbm(n_units=(5, 3, 3, 3), X=X, v_rbm_cls=v_rbm_cls,
+                                rbm_config=dict(W_init=0.8, hb_init=0.2),
+                                v_rbm_params=v_rbm_params)
+            log_Z, log_p = exact_log_Z_and_log_p(dbm, X[:10], sigma=sigma)
+
+            # AIS estimate is close to exact value
+            log_Z_ais = dbm.log_Z(n_betas=2000, n_runs=20, n_gibbs_steps=1)[0]
+            assert abs(log_Z_ais - log_Z) < 0.05
+
+            # ELBO is lower bound of log p(v)
+            elbo = dbm.log_proba(X[:10], log_Z)
+            assert np.all(elbo <= log_p + 1e-4)
+            assert np.all(elbo > log_p - 1.)
+
+            # cleanup
+            self.cleanup()
+
+    def test_log_Z_tol(self):
+        # runs are split into smaller jobs, so that AIS stops early
+        dbm = self.make_dbm()
+        log_Z, _, values = dbm.log_Z(n_betas=100, n_runs=100, n_gibbs_steps=1, tol=10.)
+        assert 1 < len(values) < 100
+        assert np.isfinite(log_Z)
+
+        # cleanup
+        self.cleanup()
+
+    def test_legacy_checkpoint(self):
+        # graph w/o AIS ops (saved before they were made) gives clear error
+        dbm = self.make_dbm()
+        meta_graph = tf.MetaGraphDef()
+        with open(dbm._tf_meta_graph_filepath, 'rb') as f:
+            meta_graph.ParseFromString(f.read())
+        for name in ('ais_x0', 'ais_log_Z0', 'ais_log_w', 'ais_x'):
+            del meta_graph.collection_def[name]
+        with open(dbm._tf_meta_graph_filepath, 'wb') as f:
+            f.write(meta_graph.SerializeToString())
+        legacy_dbm = DBM.load_model('test_dbm_1/')
+        assert_raises(RuntimeError, legacy_dbm.log_Z, n_betas=10, n_runs=2)
+
+        # cleanup
+        self.cleanup()
+
+    def tearDown(self):
+        self.cleanup()
@@ -0,0 +1,10 @@
+import sys
+import subprocess
+
+
+def test_no_tf_import():
+    # NumPy inference can be used w/o importing TensorFlow
+    code = ("import sys; import boltzmann_machines.np_inference; "
+            "from boltzmann_machines import NumpyRBM, NumpyDBM; "
+            "assert 'tensorflow' not in sys.modules")
+    assert subprocess.call([sys.executable, '-c', code]) == 0
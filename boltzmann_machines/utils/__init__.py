@@ -2,3 +2,5 @@ from rng import *
 from utils import *
 from plot_utils import *
 from stopwatch import *
+from chunked_array import *
+from transform_cache import *
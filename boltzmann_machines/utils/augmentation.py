@@ -1,5 +1,9 @@
+import os
 import numpy as np
 import scipy.ndimage as nd
+from multiprocessing.pool import ThreadPool
+
+from rng import RNG
 
 
 def shift(x, offset=(0, 0)):
@@ -14,3 +18,294 @@ def shift(x, offset=(0, 0)):
 def horizontal_mirror(x):
     y = np.fliplr(x[:,:,...])
     return y
+
+def _shift_slices(d, n):
+    """Slices along an axis of size `n` for integer shift `d`:
+    destination and source of the copied part, and destination
+    and source of the replicated edge."""
+    d = max(-(n - 1), min(n - 1, d))
+    if d >= 0:
+        return slice(d, n), slice(0, n - d), slice(0, d), slice(d, d + 1)
+    return slice(0, n + d), slice(-d, n), slice(n + d, n), slice(n + d - 1, n + d)
+
+def shift_batch(X, offset=(0, 0), out=None):
+    """Shift batch of images by integer `offset` (in pixels),
+    replicating edge pixels. The same as applying `shift` to each
+    image, but uses only array slicing.
+
+    Parameters
+    ----------
+    X : (n_samples, H, W) or (n_samples, H, W, C) np.ndarray
+    offset : (int, int) or (n_samples, 2) array-like
+        Vertical and horizontal offsets, common for all the images
+        or per image.
+    out : None or np.ndarray
+        Preallocated array of the same shape as `X` to write result to
+        (should not overlap with `X`). If None, allocate a new one.
+
+    Returns
+    -------
+    out : np.ndarray
+
+    Examples
+    --------
+    >>> X = np.arange(2 * 4 * 5 * 3).reshape((2, 4, 5, 3))
+    >>> for offset in ((1, 0), (-1, 2), (0, -3), (4, 4), (0, 0)):
+    ...     Y = np.stack([shift(x, offset=offset) for x in X])
+    ...     assert np.array_equal(shift_batch(X, offset=offset), Y)
+    >>> shift_batch(np.arange(4).reshape((1, 2, 2)), offset=(0, 1))
+    array([[[0, 0],
+            [2, 2]]])
+    >>> offsets = [(1, -1), (0, 2)]
+    >>> Y = np.stack([shift(x, offset=o) for x, o in zip(X, offsets)])
+    >>> out = np.empty_like(X)
+    >>> assert shift_batch(X, offset=offsets, out=out) is out
+    >>> assert np.array_equal(out, Y)
+    """
+    X = np.asarray(X)
+    if out is None:
+        out = np.empty_like(X)
+    elif out.shape != X.shape:
+        raise ValueError('`out` has invalid shape {0} != {1}'.format(out.shape, X.shape))
+    elif np.may_share_memory(out, X):
+        raise ValueError('`out` should not overlap with `X`')
+
+    offset = np.asarray(offset, dtype=int)
+    if offset.ndim == 2:
+        # apply each distinct offset to the corresponding group of images
+        H, W = X.shape[1:3]
+        dy = np.clip(offset[:, 0], -(H - 1), H - 1)
+        dx = np.clip(offset[:, 1], -(W - 1), W - 1)
+        offsets, groups = np.unique((dy + H) * (2 * W + 1) + (dx + W), return_inverse=True)
+        if len(offsets) > 1:
+            for g in xrange(len(offsets)):
+                ind = np.flatnonzero(groups == g)
+                out[ind] = shift_batch(X[ind], offset=offset[ind[0]])
+            return out
+        offset = offset[0]
+
+    r_dst, r_src, r_edge, r_edge_src = _shift_slices(offset[0], X.shape[1])
+    c_dst, c_src, c_edge, c_edge_src = _shift_slices(offset[1], X.shape[2])
+    out[:, r_dst, c_dst] = X[:, r_src, c_src]
+    out[:, r_dst, c_edge] = out[:, r_dst, c_edge_src]
+    out[:, r_edge] = out[:, r_edge_src]
+    return out
+
+def mirror_batch(X, mask=None, out=None):
+    """Horizontally mirror batch of images.
+
+    Parameters
+    ----------
+    X : (n_samples, H, W) or (n_samples, H, W, C) np.ndarray
+    mask : None or (n_samples,) bool array-like
+        Which images to mirror (the rest are copied as is).
+        If None, mirror all of them.
+    out : None or np.ndarray
+        Preallocated array of the same shape as `X` to write result to
+        (can be `X` itself). If None, allocate a new one.
+
+    Returns
+    -------
+    out : np.ndarray
+
+    Examples
+    --------
+    >>> X = np.random.rand(3, 4, 5, 2)
+    >>> Y = np.stack([horizontal_mirror(x) for x in X])
+    >>> assert np.array_equal(mirror_batch(X), Y)
+    >>> Y[1] = X[1]
+    >>> assert np.array_equal(mirror_batch(X, mask=[True, False, True], out=X), Y)
+    >>> assert np.array_equal(X, Y)
+    """
+    X = np.asarray(X)
+    if out is None:
+        out = np.empty_like(X)
+    elif out.shape != X.shape:
+        raise ValueError('`out` has invalid shape {0} != {1}'.format(out.shape, X.shape))
+
+    if mask is None:
+        out[...] = X[:, :, ::-1]
+        return out
+    mask = np.asarray(mask, dtype=bool)
+    if out is not X:
+        out[~mask] = X[~mask]
+    out[mask] = X[mask][:, :, ::-1]
+    return out
+
+
+class AugmentedArray(object):
+    """
+    Read-only 2D array of augmented images (shifted and optionally
+    mirrored versions of `X`), which are computed lazily when they are
+    accessed, so it can be passed to `fit` instead of precomputed
+    augmented data. Consecutive rows are computed in chunks by a pool
+    of threads ahead of the consumer.
+
+    Rows [k * n_samples, (k + 1) * n_samples) hold the k-th variant
+    of all the images: first the ones shifted by `offsets`, then the
+    mirrored ones (if `mirror`), unless the rows are permuted.
+
+    Parameters
+    ----------
+    X : (n_samples, H, W) or (n_samples, H, W, C) array-like
+        Original images (can be memory-mapped).
+    offsets : sequence of (int, int)
+        Offsets for `shift_batch`; (0, 0) stands for the original images.
+    mirror : bool
+        Whether to add horizontally mirrored versions of shifted images.
+    random_seed : None or int
+        If not None, permute rows (once) using this seed.
+    postprocess : None or callable
+        Function applied to each batch of augmented images, e.g. to convert,
+        scale and flatten them. If None, only flatten.
+    key : None or str
+        Identifier mixed into the fingerprint of the array (see `fingerprint`),
+        which otherwise does not cover `postprocess`, so different ones
+        should be given different keys.
+    n_workers : non-negative int
+        Number of threads computing chunks ahead. If 0, compute
+        all the rows synchronously.
+    chunk_size : positive int
+        Number of rows computed by one worker at a time.
+    n_prefetch : positive int
+        Number of chunks to compute ahead of the last accessed row.
+
+    Examples
+    --------
+    >>> X = np.random.rand(5, 4, 4, 3)
+    >>> A = AugmentedArray(X, offsets=((0, 0), (1, 0)), mirror=True,
+    ...                    n_workers=2, chunk_size=3)
+    >>> A.shape
+    (20, 48)
+    >>> Y = np.concatenate([X, shift_batch(X, (1, 0))])
+    >>> Y = np.concatenate([Y, mirror_batch(Y)]).reshape((20, -1))
+    >>> assert np.array_equal(A[:7], Y[:7])
+    >>> assert np.array_equal(A[7:20], Y[7:])
+    >>> assert np.array_equal(A[[19, 0, 8]], Y[[19, 0, 8]])
+    >>> B = AugmentedArray(X, offsets=((0, 0), (1, 0)), mirror=True,
+    ...                    random_seed=1337, n_workers=0)
+    >>> assert np.array_equal(B[:], Y[RNG(seed=1337).permutation(20)])
+    >>> A[5:5].shape, B[5:5].shape
+    ((0, 48), (0, 48))
+    >>> A.close()
+    """
+    def __init__(self, X, offsets=((0, 0), (1, 0), (-1, 0), (0, 1), (0, -1)),
+                 mirror=True, random_seed=None, postprocess=None, key=None,
+                 n_workers=2, chunk_size=256, n_prefetch=4):
+        self.X = X if hasattr(X, 'shape') else np.asarray(X)
+        self.offsets = [tuple(offset) for offset in offsets]
+        self.mirror = mirror
+        self.random_seed = random_seed
+        self.postprocess = postprocess
+        self.key = key
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.n_prefetch = n_prefetch
+
+        self.n_samples = len(self.X)
+        self.n_variants = len(self.offsets) * (2 if self.mirror else 1)
+        self._perm = None
+        if self.random_seed is not None:
+            self._perm = RNG(seed=self.random_seed).permutation(len(self))
+
+        self._pool = None
+        self._pool_pid = None
+        self._chunks = {}
+        Y = self._compute(np.arange(1))
+        self._n_features = Y.shape[1]
+        self._dtype = Y.dtype
+
+    @property
+    def shape(self):
+        return (self.n_samples * self.n_variants, self._n_features)
+
+    def __len__(self):
+        return self.n_samples * self.n_variants
+
+    def _compute(self, ind):
+        """Augmented rows for (global) indices `ind`."""
+        if len(ind) == 0:
+            return np.empty((0, self._n_features), dtype=self._dtype)
+        if self._perm is not None:
+            ind = self._perm[ind]
+        variant, sample = np.divmod(ind, self.n_samples)
+        offsets = np.asarray(self.offsets, dtype=int).reshape((-1, 2))
+        Y = shift_batch(self.X[sample], offset=offsets[variant % len(offsets)])
+        if self.mirror:
+            mirror_batch(Y, mask=(variant >= len(offsets)), out=Y)
+        if self.postprocess is not None:
+            return self.postprocess(Y)
+        return Y.reshape((len(Y), -1))
+
+    def _compute_chunk(self, i):
+        start = i * self.chunk_size
+        return self._compute(np.arange(start, min(start + self.chunk_size, len(self))))
+
+    def _get_chunk(self, i):
+        chunk = self._chunks.get(i)
+        if chunk is None:
+            chunk = self._compute_chunk(i)
+        elif hasattr(chunk, 'get'):
+            chunk = chunk.get()
+        self._chunks[i] = chunk
+        return chunk
+
+    def _prefetch(self, i):
+        """Start computing `n_prefetch` chunks after the i-th one
+        (wrapping around, for the next epoch), and forget all the
+        others, except the i-th one."""
+        n_chunks = (len(self) + self.chunk_size - 1) // self.chunk_size
+        ahead = [(i + k) % n_chunks for k in xrange(1, self.n_prefetch + 1)]
+        for j in self._chunks.keys():
+            if j != i and j not in ahead:
+                del self._chunks[j]
+        if self._pool is None:
+            self._pool = ThreadPool(self.n_workers)
+            self._pool_pid = os.getpid()
+        for j in ahead:
+            if j not in self._chunks:
+                self._chunks[j] = self._pool.apply_async(self._compute_chunk, (j,))
+
+    def __getitem__(self, key):
+        N = len(self)
+        if np.isscalar(key):
+            return self[np.asarray([key])][0]
+        if not isinstance(key, slice) or key.step not in (None, 1) or not self.n_workers:
+            return self._compute(np.arange(N)[key])
+
+        start, stop, _ = key.indices(N)
+        if stop <= start:
+            return self._compute(np.arange(0))
+        if self._pool is not None and self._pool_pid != os.getpid():
+            # worker threads are not inherited by forked processes
+            # (e.g. in `fit_parallel`), so start over in this one
+            self._pool = None
+            self._chunks.clear()
+        first, last = start // self.chunk_size, (stop - 1) // self.chunk_size
+        Y = np.concatenate([self._get_chunk(i) for i in xrange(first, last + 1)])
+        self._prefetch(last)
+        offset = first * self.chunk_size
+        return Y[(start - offset):(stop - offset)]
+
+    def __array__(self, dtype=None):
+        Y = self._compute(np.arange(len(self)))
+        return Y if dtype is None else Y.astype(dtype)
+
+    def close(self):
+        """Stop worker threads."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        self._chunks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+if __name__ == '__main__':
+    # run corresponding tests
+    from testing import run_tests
+    run_tests(__file__)
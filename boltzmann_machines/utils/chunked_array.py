@@ -0,0 +1,131 @@
+import os
+import glob
+import numpy as np
+
+
+class ChunkedArray(object):
+    """
+    Read-only 2D array, backed by one or several (typically memory-mapped)
+    chunks of rows, that converts and scales rows to `dtype` only when
+    they are accessed. This allows to store large datasets on disk
+    in a compact form (e.g. as 'uint8' pixel intensities) and to pass
+    them directly to `fit`, `transform` etc. without loading them
+    into memory.
+
+    Parameters
+    ----------
+    chunks : array-like or list of such
+        Chunks of rows, with the same number of features.
+    dtype : str or np.dtype
+        Type of the returned rows.
+    scale, shift : float or (n_features,) array-like
+        Returned rows are computed as `X[i] * scale + shift`.
+
+    Examples
+    --------
+    >>> X = np.arange(12, dtype=np.uint8).reshape((6, 2))
+    >>> C = ChunkedArray([X[:4], X[4:]], scale=0.5, shift=1.)
+    >>> len(C), C.shape, C.dtype
+    (6, (6, 2), dtype('float32'))
+    >>> C[3:5]
+    array([[ 4. ,  4.5],
+           [ 5. ,  5.5]], dtype=float32)
+    >>> C[-1]
+    array([ 6. ,  6.5], dtype=float32)
+    >>> C[[5, 0]]
+    array([[ 6. ,  6.5],
+           [ 1. ,  1.5]], dtype=float32)
+    >>> np.testing.assert_allclose(np.asarray(C), X * 0.5 + 1.)
+    """
+    def __init__(self, chunks, dtype='float32', scale=1., shift=0.):
+        if isinstance(chunks, np.ndarray) or not hasattr(chunks, '__iter__'):
+            chunks = [chunks]
+        self.chunks = [c if hasattr(c, 'shape') else np.asarray(c) for c in chunks]
+        if not self.chunks:
+            raise ValueError('at least one chunk is required')
+        n_features = self.chunks[0].shape[1:]
+        for c in self.chunks:
+            if c.ndim != 2 or c.shape[1:] != n_features:
+                raise ValueError('all chunks must be 2D with {0} features'.format(n_features[0]))
+        self.dtype = np.dtype(dtype)
+        self.scale = scale
+        self.shift = shift
+        self._offsets = np.cumsum([0] + [len(c) for c in self.chunks])
+
+    @classmethod
+    def from_path(cls, path, mmap_mode='r', **kwargs):
+        """Open .npy file or directory of .npy shards (in the
+        lexicographic order of file names) as `ChunkedArray`."""
+        if os.path.isdir(path):
+            fnames = sorted(glob.glob(os.path.join(path, '*.npy')))
+            if not fnames:
+                raise ValueError("no .npy shards found in '{0}'".format(path))
+        else:
+            fnames = [path]
+        return cls([np.load(fname, mmap_mode=mmap_mode) for fname in fnames], **kwargs)
+
+    @property
+    def shape(self):
+        return (int(self._offsets[-1]), self.chunks[0].shape[1])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _convert(self, X):
+        X = X.astype(self.dtype)
+        if not np.isscalar(self.scale) or self.scale != 1.:
+            X *= np.asarray(self.scale, dtype=self.dtype)
+        if not np.isscalar(self.shift) or self.shift != 0.:
+            X += np.asarray(self.shift, dtype=self.dtype)
+        return X
+
+    def _rows(self, start, stop):
+        """Rows [start, stop) as a raw (not converted) array."""
+        parts = []
+        i = max(np.searchsorted(self._offsets, start, side='right') - 1, 0)
+        while start < stop and i < len(self.chunks):
+            offset = self._offsets[i]
+            end = min(stop, self._offsets[i + 1])
+            if end > start:
+                parts.append(self.chunks[i][(start - offset):(end - offset)])
+                start = end
+            i += 1
+        if not parts:
+            return self.chunks[0][:0]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def __getitem__(self, key):
+        N = len(self)
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(N)
+            return self._convert(self._rows(start, max(start, stop)))
+        if np.isscalar(key):
+            key = int(key)
+            if key < 0:
+                key += N
+            if not 0 <= key < N:
+                raise IndexError('index {0} is out of bounds for size {1}'.format(key, N))
+            return self[key:(key + 1)][0]
+
+        # arbitrary slices, integer or boolean indices
+        ind = np.arange(N)[key]
+        chunk_ind = np.searchsorted(self._offsets, ind, side='right') - 1
+        X = np.empty((len(ind), self.shape[1]), dtype=self.chunks[0].dtype)
+        for i in np.unique(chunk_ind):
+            mask = chunk_ind == i
+            X[mask] = self.chunks[i][ind[mask] - self._offsets[i]]
+        return self._convert(X)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None):
+        X = self[:]
+        return X if dtype is None else X.astype(dtype)
+
+
+if __name__ == '__main__':
+    # run corresponding tests
+    from testing import run_tests
+    run_tests(__file__)
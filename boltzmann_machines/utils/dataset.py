@@ -7,10 +7,16 @@ import matplotlib.pyplot as plt
 from rng import RNG
 
 
-def load_mnist(mode='train', path='.'):
+def load_mnist(mode='train', path='.', dtype=float):
     """
     Load and return MNIST dataset.
 
+    Parameters
+    ----------
+    dtype : str or np.dtype
+        Type of returned data. Use 'uint8' to keep it compact,
+        e.g. to save and then open it as `ChunkedArray`.
+
     Returns
     -------
     data : (n_samples, 784) np.ndarray
@@ -37,12 +43,17 @@ def load_mnist(mode='train', path='.'):
         magic, n_samples = struct.unpack(">II", ftarget.read(8))
         target = np.fromfile(ftarget, dtype=np.int8)
 
-    return data.astype(float), target
+    return data.astype(dtype), target
 
-def load_cifar10(mode='train', path='.'):
+def load_cifar10(mode='train', path='.', dtype=float):
     """
     Load and return CIFAR-10 dataset.
 
+    Parameters
+    ----------
+    dtype : str or np.dtype
+        Type of returned data (see `load_mnist`).
+
     Returns
     -------
     data : (n_samples, 3 * 32 * 32) np.ndarray
@@ -59,7 +70,7 @@ def load_cifar10(mode='train', path='.'):
     else:
         raise ValueError("`mode` must be 'train' or 'test'")
     n_samples = batch_size * len(fnames)
-    data = np.zeros(shape=(n_samples, 3 * 32 * 32), dtype=float)
+    data = np.zeros(shape=(n_samples, 3 * 32 * 32), dtype=dtype)
     target = np.zeros(shape=(n_samples,), dtype=int)
     start = 0
     for fname in fnames:
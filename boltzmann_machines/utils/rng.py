@@ -1,3 +1,4 @@
+import os
 import numpy as np
 
 
@@ -37,6 +38,9 @@ class RNG(np.random.RandomState):
     ...     loaded_state = json.load(f)
     >>> rng.set_state(loaded_state).rand()
     0.2620246750155817
+    >>> rng.save_state('random_state.npz')
+    >>> RNG().load_state('random_state.npz').rand()
+    0.1586839721544656
     """
     def __init__(self, seed=None):
         self._seed = seed
@@ -61,6 +65,22 @@ class RNG(np.random.RandomState):
         super(RNG, self).set_state(state)
         return self
 
+    def save_state(self, filepath):
+        """Save inner state to `filepath` in .npz format (atomically)."""
+        algorithm, keys, pos, has_gauss, cached_gaussian = super(RNG, self).get_state()
+        tmp_filepath = filepath + '.tmp.npz'
+        np.savez(tmp_filepath, algorithm=algorithm, keys=keys, pos=pos,
+                 has_gauss=has_gauss, cached_gaussian=cached_gaussian)
+        os.rename(tmp_filepath, filepath)
+
+    def load_state(self, filepath):
+        """Complementary method to `save_state`."""
+        with np.load(filepath) as f:
+            state = (str(f['algorithm']), f['keys'], int(f['pos']),
+                     int(f['has_gauss']), float(f['cached_gaussian']))
+        super(RNG, self).set_state(state)
+        return self
+
 
 if __name__ == '__main__':
     # run corresponding tests
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+from chunked_array import ChunkedArray
+from augmentation import AugmentedArray
+
+
+def _update_hash(h, X, batch_size=4096):
+    """Update hash `h` with contents of (array-like) `X`."""
+    h.update(repr((X.shape, str(getattr(X, 'dtype', '')))))
+    for start in xrange(0, len(X), batch_size):
+        h.update(np.ascontiguousarray(X[start:(start + batch_size)]).data)
+
+def fingerprint(X):
+    """Compute fingerprint of (array-like) data `X`.
+
+    Memory-mapped arrays (and `ChunkedArray`-s of such) are identified by
+    their source file path, its size and modification time, and their
+    location within the file, without reading the data. `AugmentedArray`-s
+    are identified by the fingerprint of the original images and parameters
+    of augmentation (and its `key`, but not `postprocess`), without computing
+    augmented images. Other arrays are identified by the hash of their contents.
+
+    Examples
+    --------
+    >>> X = np.arange(12.).reshape((4, 3))
+    >>> fingerprint(X) == fingerprint(X.copy())
+    True
+    >>> fingerprint(X) == fingerprint(X[:3])
+    False
+    >>> fingerprint(X) == fingerprint(X.astype(np.float32))
+    False
+    >>> fingerprint(X) == fingerprint(ChunkedArray(X, dtype=np.float64))
+    False
+    >>> I = np.arange(48.).reshape((3, 4, 4))
+    >>> A = AugmentedArray(I, offsets=((0, 0), (1, 0)), n_workers=0)
+    >>> fingerprint(A) == fingerprint(AugmentedArray(I.copy(), offsets=((0, 0), (1, 0)), n_workers=0))
+    True
+    >>> fingerprint(A) == fingerprint(AugmentedArray(I, offsets=((0, 0), (1, 0)), mirror=False, n_workers=0))
+    False
+    >>> fingerprint(A) == fingerprint(AugmentedArray(I, offsets=((0, 0), (1, 0)), key='v2', n_workers=0))
+    False
+    """
+    h = hashlib.sha1()
+    if isinstance(X, ChunkedArray):
+        h.update(repr(('chunked', str(X.dtype), np.asarray(X.scale).tolist(),
+                       np.asarray(X.shift).tolist())))
+        for chunk in X.chunks:
+            h.update(fingerprint(chunk))
+        return h.hexdigest()
+
+    if isinstance(X, AugmentedArray):
+        h.update(repr(('augmented', X.offsets, X.mirror, X.random_seed, X.key, X.shape)))
+        h.update(fingerprint(X.X))
+        return h.hexdigest()
+
+    mm = getattr(X, '_mmap', None)
+    filename = getattr(X, 'filename', None)
+    if isinstance(X, np.memmap) and mm is not None and filename and os.path.isfile(filename):
+        stat = os.stat(filename)
+        start = np.frombuffer(mm, dtype=np.uint8).ctypes.data
+        h.update(repr(('mmap', os.path.realpath(filename), stat.st_size, stat.st_mtime,
+                       X.ctypes.data - start, X.shape, X.strides, str(X.dtype))))
+        return h.hexdigest()
+
+    if not hasattr(X, 'shape'):
+        X = np.asarray(X)
+    _update_hash(h, X)
+    return h.hexdigest()
+
+
+class TransformCache(object):
+    """
+    Directory of memory-mapped `.npy` files with results of (expensive)
+    computations, such as `transform` of trained models, with
+    size-bounded LRU eviction.
+
+    Parameters
+    ----------
+    dirpath : str
+        Directory to store cached arrays in.
+    max_bytes : None or positive int
+        Maximum total size of cached arrays. Least recently used ones
+        are evicted once it is exceeded. If None, do not evict.
+    mmap_mode : None or {'r', 'c', 'r+'}
+        Mode to load cached arrays with. Default 'c' (copy-on-write)
+        allows modifying returned arrays without affecting the cache.
+
+    Examples
+    --------
+    >>> import tempfile, shutil
+    >>> dirpath = tempfile.mkdtemp()
+    >>> cache = TransformCache(dirpath, max_bytes=200)
+    >>> X = np.arange(12.).reshape((4, 3))
+    >>> key = cache.make_key('model', X, 'float64')
+    >>> cache.get(key) is None
+    True
+    >>> cache.put(key, 2 * X)
+    >>> cache.get(key)[-1]
+    memmap([ 18.,  20.,  22.])
+    >>> cache.put('other', np.zeros(10))
+    >>> cache.put('another', np.zeros(10))  # evicts the least recently used
+    >>> cache.get(key) is None, cache.get('another') is None
+    (True, False)
+    >>> shutil.rmtree(dirpath)
+    """
+    def __init__(self, dirpath, max_bytes=None, mmap_mode='c'):
+        self.dirpath = dirpath
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        self._index_filepath = os.path.join(self.dirpath, 'index.json')
+        if not os.path.isdir(self.dirpath):
+            os.makedirs(self.dirpath)
+
+    @staticmethod
+    def make_key(model_fingerprint, X, dtype):
+        """Make key for the result of a computation on `X` by a model
+        with `model_fingerprint`, converted to `dtype`."""
+        h = hashlib.sha1()
+        h.update(model_fingerprint)
+        h.update(fingerprint(X))
+        h.update(str(np.dtype(dtype)))
+        return h.hexdigest()
+
+    def _filepath(self, key):
+        return os.path.join(self.dirpath, '{0}.npy'.format(key))
+
+    def _load_index(self):
+        if not os.path.isfile(self._index_filepath):
+            return {}
+        with open(self._index_filepath, 'r') as f:
+            index = json.load(f)
+        # forget entries whose files were removed
+        return {k: v for k, v in index.items() if os.path.isfile(self._filepath(k))}
+
+    def _save_index(self, index):
+        tmp_filepath = self._index_filepath + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp_filepath, self._index_filepath)
+
+    def get(self, key):
+        """Return cached array for `key`, or None if there is none."""
+        index = self._load_index()
+        if key not in index:
+            return None
+        index[key]['last_used'] = time.time()
+        self._save_index(index)
+        return np.load(self._filepath(key), mmap_mode=self.mmap_mode)
+
+    def put(self, key, X):
+        """Store array `X` for `key`, evicting least recently used
+        arrays if needed."""
+        X = np.asarray(X)
+        filepath = self._filepath(key)
+        tmp_filepath = filepath + '.tmp.npy'
+        np.save(tmp_filepath, X)
+        os.rename(tmp_filepath, filepath)
+
+        index = self._load_index()
+        index[key] = dict(size=os.path.getsize(filepath), last_used=time.time())
+        if self.max_bytes is not None:
+            total = sum(v['size'] for v in index.values())
+            for k in sorted(index, key=lambda k: index[k]['last_used']):
+                if total <= self.max_bytes or k == key:
+                    break
+                total -= index.pop(k)['size']
+                os.remove(self._filepath(k))
+        self._save_index(index)
+
+    def clear(self):
+        """Remove all cached arrays."""
+        for k in self._load_index():
+            os.remove(self._filepath(k))
+        self._save_index({})
+
+
+if __name__ == '__main__':
+    # run corresponding tests
+    from testing import run_tests
+    run_tests(__file__)
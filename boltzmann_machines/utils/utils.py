@@ -32,7 +32,10 @@ def batch_iter(X, batch_size=10, verbose=False, desc='epoch'):
     [[30 31 32]
      [33 34 35]]
     """
-    X = np.asarray(X)
+    # array-likes such as `np.memmap` or `ChunkedArray`
+    # are sliced lazily, without loading all the data
+    if not hasattr(X, 'shape'):
+        X = np.asarray(X)
     N = len(X)
     n_batches = N / batch_size + (N % batch_size > 0)
     gen = range(n_batches)
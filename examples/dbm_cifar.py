@@ -44,71 +44,62 @@ from keras.layers import Dense, Activation, Dropout, BatchNormalization as BN
 from sklearn.metrics import accuracy_score
 
 import env
-from boltzmann_machines import DBM
-from boltzmann_machines.rbm import GaussianRBM, MultinomialRBM
-from boltzmann_machines.utils import (RNG, Stopwatch,
+from boltzmann_machines import DBM, fit_parallel
+from boltzmann_machines.rbm import GaussianRBM, BlockGaussianRBM, MultinomialRBM
+from boltzmann_machines.utils import (RNG, Stopwatch, TransformCache,
                                       one_hot, one_hot_decision_function, unhot)
-from boltzmann_machines.utils.augmentation import shift, horizontal_mirror
+from boltzmann_machines.utils.augmentation import AugmentedArray
 from boltzmann_machines.utils.dataset import (load_cifar10,
                                               im_flatten, im_unflatten)
 from boltzmann_machines.utils.optimizers import MultiAdam
 
 
-def make_augmentation(X_train, y_train, n_train, args):
-    X_aug = None
-    X_aug_path = os.path.join(args.data_path, 'X_aug.npy')
-    y_train = y_train.tolist() * 10
-    RNG(seed=1337).shuffle(y_train)
-
-    augment = True
-    if os.path.isfile(X_aug_path):
-        print "\nLoading augmented data ..."
-        X_aug = np.load(X_aug_path)
-        print "Checking augmented data ..."
-        if len(X_aug) == 10 * n_train:
-            augment = False
-
-    if augment:
-        print "\nAugmenting data ..."
-        s = Stopwatch(verbose=True).start()
-
-        X_aug = np.zeros((10 * n_train, 32, 32, 3), dtype=np.float32)
-        X_train = im_unflatten(X_train)
-        X_aug[:n_train] = X_train
-        for i in xrange(n_train):
-            for k, offset in enumerate((
-                    ( 1,  0),
-                    (-1,  0),
-                    ( 0,  1),
-                    ( 0, -1)
-            )):
-                img = X_train[i].copy()
-                X_aug[(k + 1) * n_train + i] = shift(img, offset=offset)
-        for i in xrange(5 * n_train):
-            X_aug[5 * n_train + i] = horizontal_mirror(X_aug[i].copy())
-
-        # shuffle once again
-        RNG(seed=1337).shuffle(X_aug)
-
-        # convert to 'uint8' type to save disk space
-        X_aug *= 255.
-        X_aug = X_aug.astype('uint8')
-
-        # flatten to (10 * `n_train`, 3072) shape
-        X_aug = im_flatten(X_aug)
-
-        # save to disk
-        np.save(X_aug_path, X_aug)
-
-        s.elapsed()
-        print "\n"
-
+def iter_chunks(X, chunk_size=10000):
+    for start in xrange(0, len(X), chunk_size):
+        yield X[start:(start + chunk_size)]
+
+def map_chunks(f, X, chunk_size=10000):
+    """Apply `f` to (array-like) `X` chunk by chunk
+    and concatenate the results."""
+    return np.concatenate([f(X_chunk) for X_chunk in iter_chunks(X, chunk_size)])
+
+def chunked_mean_std(X, chunk_size=10000):
+    """Per-feature mean and std of (array-like) `X`,
+    computed chunk by chunk."""
+    s = np.zeros(X.shape[1])
+    s2 = np.zeros(X.shape[1])
+    for X_chunk in iter_chunks(X, chunk_size):
+        X_chunk = X_chunk.astype(np.float64)
+        s += X_chunk.sum(axis=0)
+        s2 += np.square(X_chunk).sum(axis=0)
+    mean = s / len(X)
+    std = np.sqrt(np.maximum(s2 / len(X) - mean ** 2, 0.))
+    return mean.astype(np.float32), std.astype(np.float32)
+
+def make_augmentation(X_train, y_train, args, X_mean=0., X_std=1.):
+    """Augment training data (x10) lazily: augmented images are computed
+    batch by batch, by a pool of threads ahead of the model consuming
+    them, and are flattened and standardized using `X_mean`, `X_std`."""
+    n_train = len(X_train)
+
+    def postprocess(X_b):
+        X_b = im_flatten(X_b).reshape((len(X_b), -1))
+        X_b -= X_mean
+        X_b /= X_std
+        return X_b
+
+    X_aug = AugmentedArray(im_unflatten(X_train),
+                           offsets=((0, 0), (1, 0), (-1, 0), (0, 1), (0, -1)),
+                           mirror=True,
+                           random_seed=1337,
+                           postprocess=postprocess,
+                           n_workers=args.aug_n_workers,
+                           n_prefetch=args.aug_n_prefetch)
+    # labels permuted the same way as augmented images
+    y_train = np.tile(y_train, 10)[RNG(seed=1337).permutation(10 * n_train)]
     return X_aug, y_train
 
 def make_small_rbms((X_train, X_val), args):
-    X_train = im_unflatten(X_train)
-    X_val = im_unflatten(X_val)
-
     small_rbm_config = dict(n_visible=8 * 8 * 3,
                             n_hidden=300,
                             sigma=1.,
@@ -140,82 +131,46 @@ def make_small_rbms((X_train, X_val), args):
                             v_shape=(8, 8, 3),
                             dtype='float32',
                             tf_saver_params=dict(max_to_keep=1))
-    small_rbms = []
+    small_rbms, small_rbms_data = [], []
+
+    def make_small_rbm(rbm_id, random_seed, make_patches):
+        rbm_dirpath = args.small_dirpath_prefix + str(rbm_id) + '/'
+        small_rbms.append(GaussianRBM(random_seed=random_seed,
+                                      model_path=rbm_dirpath,
+                                      **small_rbm_config))
+        # patches are extracted (chunk by chunk) within the worker process
+        f = lambda X: make_patches(im_unflatten(X))
+        small_rbms_data.append(lambda: (map_chunks(f, X_train), map_chunks(f, X_val)))
 
     # first 16 ...
     for i in xrange(4):
         for j in xrange(4):
             rbm_id = 4 * i + j
-            rbm_dirpath = args.small_dirpath_prefix + str(rbm_id) + '/'
-
-            if os.path.isdir(rbm_dirpath):
-                print "\nLoading small RBM #{0} ...\n\n".format(rbm_id)
-                rbm = GaussianRBM.load_model(rbm_dirpath)
-            else:
-                print "\nTraining small RBM #{0} ...\n\n".format(rbm_id)
-                X_patches = X_train[:, 8 * i:8 * (i + 1),
-                                       8 * j:8 * (j + 1), :]
-                X_patches_val = X_val[:, 8 * i:8 * (i + 1),
-                                         8 * j:8 * (j + 1), :]
-                X_patches = im_flatten(X_patches)
-                X_patches_val = im_flatten(X_patches_val)
-
-                rbm = GaussianRBM(random_seed=9000 + rbm_id,
-                                  model_path=rbm_dirpath,
-                                  **small_rbm_config)
-                rbm.fit(X_patches, X_patches_val)
-            small_rbms.append(rbm)
+            make_small_rbm(rbm_id, 9000 + rbm_id,
+                           lambda X, i=i, j=j: im_flatten(X[:, 8 * i:8 * (i + 1),
+                                                               8 * j:8 * (j + 1), :]))
 
     # next 9 ...
     for i in xrange(3):
         for j in xrange(3):
             rbm_id = 16 + 3 * i + j
-            rbm_dirpath = args.small_dirpath_prefix + str(rbm_id) + '/'
-
-            if os.path.isdir(rbm_dirpath):
-                print "\nLoading small RBM #{0} ...\n\n".format(rbm_id)
-                rbm = GaussianRBM.load_model(rbm_dirpath)
-            else:
-                print "\nTraining small RBM #{0} ...\n\n".format(rbm_id)
-                X_patches = X_train[:, 4 + 8 * i:4 + 8 * (i + 1),
-                                       4 + 8 * j:4 + 8 * (j + 1), :]
-                X_patches_val = X_val[:, 4 + 8 * i:4 + 8 * (i + 1),
-                                         4 + 8 * j:4 + 8 * (j + 1), :]
-                X_patches = im_flatten(X_patches)
-                X_patches_val = im_flatten(X_patches_val)
-
-                rbm = GaussianRBM(random_seed=args.small_random_seed + rbm_id,
-                                  model_path=rbm_dirpath,
-                                  **small_rbm_config)
-                rbm.fit(X_patches, X_patches_val)
-            small_rbms.append(rbm)
+            make_small_rbm(rbm_id, args.small_random_seed + rbm_id,
+                           lambda X, i=i, j=j: im_flatten(X[:, 4 + 8 * i:4 + 8 * (i + 1),
+                                                               4 + 8 * j:4 + 8 * (j + 1), :]))
 
     # ... and the last one
-    rbm_id = 25
-    rbm_dirpath = args.small_dirpath_prefix + str(rbm_id) + '/'
-
-    if os.path.isdir(rbm_dirpath):
-        print "\nLoading small RBM #{0} ...\n\n".format(rbm_id)
-        rbm = GaussianRBM.load_model(rbm_dirpath)
-    else:
-        print "\nTraining small RBM #{0} ...\n\n".format(rbm_id)
-        X_patches = X_train.copy()  # (N, 32, 32, 3)
+    def make_patches(X):
+        X_patches = X.copy()  # (N, 32, 32, 3)
         X_patches = X_patches.transpose(0, 3, 1, 2)  # (N, 3, 32, 32)
         X_patches = X_patches.reshape((-1, 3, 4, 8, 4, 8)).mean(axis=4).mean(axis=2)  # (N, 3, 8, 8)
         X_patches = X_patches.transpose(0, 2, 3, 1)  # (N, 8, 8, 3)
-        X_patches = im_flatten(X_patches)  # (N, 8*8*3)
-
-        X_patches_val = X_val.copy()
-        X_patches_val = X_patches_val.transpose(0, 3, 1, 2)
-        X_patches_val = X_patches_val.reshape((-1, 3, 4, 8, 4, 8)).mean(axis=4).mean(axis=2)
-        X_patches_val = X_patches_val.transpose(0, 2, 3, 1)
-        X_patches_val = im_flatten(X_patches_val)
-
-        rbm = GaussianRBM(random_seed=9000 + rbm_id,
-                          model_path=rbm_dirpath,
-                          **small_rbm_config)
-        rbm.fit(X_patches, X_patches_val)
-    small_rbms.append(rbm)
+        return im_flatten(X_patches)  # (N, 8*8*3)
+    make_small_rbm(25, 9000 + 25, make_patches)
+
+    # train all of them concurrently (or load already trained ones)
+    print "\nTraining small RBMs ...\n\n"
+    small_rbms = fit_parallel(small_rbms, small_rbms_data,
+                              n_jobs=args.small_n_jobs, n_threads=args.small_n_threads)
     return small_rbms
 
 def make_large_weights(small_rbms):
@@ -275,48 +230,68 @@ def make_large_weights(small_rbms):
 
     return W, vb, hb
 
+def make_receptive_fields():
+    """Indices of (flattened) pixels covered by each of the small RBMs."""
+    ind = im_unflatten(np.arange(32 * 32 * 3))  # (32, 32, 3)
+    fields = []
+    for i in xrange(4):
+        for j in xrange(4):
+            fields.append(im_flatten(ind[8 * i:8 * (i + 1), 8 * j:8 * (j + 1), :]))
+    for i in xrange(3):
+        for j in xrange(3):
+            fields.append(im_flatten(ind[4 + 8 * i:4 + 8 * (i + 1), 4 + 8 * j:4 + 8 * (j + 1), :]))
+    fields.append(np.arange(32 * 32 * 3))
+    return fields
+
 def make_grbm((X_train, X_val), small_rbms, args):
+    grbm_cls = GaussianRBM
+    grbm_params = {}
+    if args.grbm_block_sparse:
+        grbm_cls = BlockGaussianRBM
+        grbm_params = dict(receptive_fields=make_receptive_fields(), block_sizes=300)
+
     if os.path.isdir(args.grbm_dirpath):
         print "\nLoading G-RBM ...\n\n"
-        grbm = GaussianRBM.load_model(args.grbm_dirpath)
+        grbm = grbm_cls.load_model(args.grbm_dirpath)
     else:
         print "\nAssembling weights for large Gaussian RBM ...\n\n"
         W, vb, hb = make_large_weights(small_rbms)
 
         print "\nTraining G-RBM ...\n\n"
-        grbm = GaussianRBM(n_visible=32 * 32 * 3,
-                           n_hidden=300 * 26,
-                           sigma=1.,
-                           W_init=W,
-                           vb_init=vb,
-                           hb_init=hb,
-                           n_gibbs_steps=args.n_gibbs_steps[0],
-                           learning_rate=args.lr[0],
-                           momentum=np.geomspace(0.5, 0.9, 8),
-                           max_epoch=args.epochs[0],
-                           batch_size=args.batch_size[0],
-                           l2=args.l2[0],
-                           sample_v_states=True,
-                           sample_h_states=True,
-                           sparsity_target=0.1,
-                           sparsity_cost=1e-4,
-                           dbm_first=True,  # !!!
-                           metrics_config=dict(
-                               msre=True,
-                               feg=True,
-                               train_metrics_every_iter=1000,
-                               val_metrics_every_epoch=1,
-                               feg_every_epoch=2,
-                               n_batches_for_feg=50,
-                           ),
-                           verbose=True,
-                           display_filters=24,
-                           display_hidden_activations=36,
-                           v_shape=(32, 32, 3),
-                           random_seed=args.random_seed[0],
-                           dtype='float32',
-                           tf_saver_params=dict(max_to_keep=1),
-                           model_path=args.grbm_dirpath)
+        grbm = grbm_cls(n_visible=32 * 32 * 3,
+                        n_hidden=300 * 26,
+                        sigma=1.,
+                        W_init=W,
+                        vb_init=vb,
+                        hb_init=hb,
+                        n_gibbs_steps=args.n_gibbs_steps[0],
+                        learning_rate=args.lr[0],
+                        momentum=np.geomspace(0.5, 0.9, 8),
+                        max_epoch=args.epochs[0],
+                        batch_size=args.batch_size[0],
+                        l2=args.l2[0],
+                        sample_v_states=True,
+                        sample_h_states=True,
+                        sparsity_target=0.1,
+                        sparsity_cost=1e-4,
+                        dbm_first=True,  # !!!
+                        metrics_config=dict(
+                            msre=True,
+                            feg=True,
+                            train_metrics_every_iter=1000,
+                            val_metrics_every_epoch=1,
+                            feg_every_epoch=2,
+                            n_batches_for_feg=50,
+                        ),
+                        verbose=True,
+                        display_filters=24,
+                        display_hidden_activations=36,
+                        v_shape=(32, 32, 3),
+                        random_seed=args.random_seed[0],
+                        dtype='float32',
+                        tf_saver_params=dict(max_to_keep=1),
+                        model_path=args.grbm_dirpath,
+                        **grbm_params)
         grbm.fit(X_train, X_val)
     return grbm
 
@@ -372,17 +347,10 @@ def make_mrbm((Q_train, Q_val), args):
         mrbm.fit(Q_train, Q_val)
     return mrbm
 
-def make_rbm_transform(rbm, X, path, np_dtype=None):
-    H = None
-    transform = True
-    if os.path.isfile(path):
-        H = np.load(path)
-        if len(X) == len(H):
-            transform = False
-    if transform:
-        H = rbm.transform(X, np_dtype=np_dtype)
-        np.save(path, H)
-    return H
+def make_rbm_transform(rbm, X, cache, np_dtype=None):
+    # (recomputed only if the model or the data have changed)
+    rbm.set_transform_cache(cache)
+    return rbm.transform(X, np_dtype=np_dtype)
 
 def make_dbm((X_train, X_val), rbms, (Q, G), args):
     if os.path.isdir(args.dbm_dirpath):
@@ -453,13 +421,18 @@ def make_mlp((X_train, y_train), (X_val, y_val), (X_test, y_test),
         reduce_lr = ReduceLROnPlateau(monitor=args.mlp_val_metric, factor=0.2, verbose=2,
                                       patience=3, min_lr=1e-5)
         callbacks = [early_stopping, reduce_lr]
+        # feed (possibly not in-memory) training data batch by batch
+        def batches():
+            while True:
+                for start in xrange(0, len(X_train), args.mlp_batch_size):
+                    end = start + args.mlp_batch_size
+                    yield X_train[start:end], one_hot(y_train[start:end], n_classes=10)
         try:
-            mlp.fit(X_train, one_hot(y_train, n_classes=10),
-                    epochs=args.mlp_epochs,
-                    batch_size=args.mlp_batch_size,
-                    shuffle=False,
-                    validation_data=(X_val, one_hot(y_val, n_classes=10)),
-                    callbacks=callbacks)
+            mlp.fit_generator(batches(),
+                              steps_per_epoch=(len(X_train) + args.mlp_batch_size - 1) // args.mlp_batch_size,
+                              epochs=args.mlp_epochs,
+                              validation_data=(X_val, one_hot(y_val, n_classes=10)),
+                              callbacks=callbacks)
         except KeyboardInterrupt:
             pass
 
@@ -489,8 +462,14 @@ def main():
                         help='number of validation examples')
     parser.add_argument('--data-path', type=str, default='../data/', metavar='PATH',
                         help='directory for storing augmented data etc.')
+    parser.add_argument('--transform-cache-size', type=float, default=16., metavar='GB',
+                        help='max size of the cache of extracted features (in GiB)')
     parser.add_argument('--no-aug', action='store_true',
                         help="if enabled, don't augment data")
+    parser.add_argument('--aug-n-workers', type=int, default=4, metavar='N',
+                        help='number of threads computing augmented data')
+    parser.add_argument('--aug-n-prefetch', type=int, default=4, metavar='N',
+                        help='number of chunks of augmented data to compute ahead')
 
     # small RBMs related
     parser.add_argument('--small-lr', type=float, default=1e-3, metavar='LR', nargs='+',
@@ -509,6 +488,10 @@ def main():
                         help="random seeds for models training")
     parser.add_argument('--small-dirpath-prefix', type=str, default='../models/rbm_cifar_small_', metavar='PREFIX',
                         help='directory path prefix to save RBMs trained on patches')
+    parser.add_argument('--small-n-jobs', type=int, default=None, metavar='N',
+                        help='number of small RBMs to train concurrently (default: as many as CPUs allow)')
+    parser.add_argument('--small-n-threads', type=int, default=1, metavar='N',
+                        help='number of TF threads per small RBM')
 
     # M-RBM related
     parser.add_argument('--increase-n-gibbs-steps-every', type=int, default=16, metavar='I',
@@ -530,6 +513,8 @@ def main():
                         help='random seeds for models training')
 
     # save dirpaths
+    parser.add_argument('--grbm-block-sparse', action='store_true',
+                        help='keep weights of G-RBM restricted to receptive fields of small RBMs')
     parser.add_argument('--grbm-dirpath', type=str, default='../models/grbm_cifar/', metavar='DIRPATH',
                         help='directory path to save Gaussian RBM')
     parser.add_argument('--mrbm-dirpath', type=str, default='../models/mrbm_cifar/', metavar='DIRPATH',
@@ -600,34 +585,29 @@ def main():
     y_val = y[-n_val:]
 
     if not args.no_aug:
-        # augment data
-        X_aug, y_train = make_augmentation(X_train, y_train, n_train, args)
-
-        # convert + scale augmented data again
-        X_train = X_aug.astype(np.float32)
-        X_train /= 255.
-        print "Augmented shape: {0}".format(X_train.shape)
-        print "Augmented range: {0}".format((X_train.min(), X_train.max()))
-
-    # center and normalize training data
-    X_mean = X_train.mean(axis=0)
-    X_std = X_train.std(axis=0)
-
-    if not args.no_aug:
-        mean_path = os.path.join(args.data_path, 'X_aug_mean.npy')
-        std_path = os.path.join(args.data_path, 'X_aug_std.npy')
-        if not os.path.isfile(mean_path):
-            np.save(mean_path, X_mean)
-        if not os.path.isfile(std_path):
-            np.save(std_path, X_std)
-
-    X_train -= X_mean
-    X_train /= X_std
-    X_val -= X_mean
-    X_val /= X_std
-    print "Augmented mean: ({0:.3f}, ...); std: ({1:.3f}, ...)".format(X_train.mean(axis=0)[0],
-                                                                       X_train.std(axis=0)[0])
-    print "Augmented range: ({0:.3f}, {1:.3f})\n\n".format(X_train.min(), X_train.max())
+        # augment data (lazily, while training)
+        X_aug, _ = make_augmentation(X_train, y_train, args)
+        print "Augmented shape: {0}".format(X_aug.shape)
+
+        # center and normalize augmented data
+        X_mean, X_std = chunked_mean_std(X_aug)
+        X_aug.close()
+        np.save(os.path.join(args.data_path, 'X_aug_mean.npy'), X_mean)
+        np.save(os.path.join(args.data_path, 'X_aug_std.npy'), X_std)
+        X_val -= X_mean
+        X_val /= X_std
+        X_train, y_train = make_augmentation(X_train, y_train, args,
+                                             X_mean=X_mean, X_std=X_std)
+    else:
+        # center and normalize training data
+        X_mean, X_std = chunked_mean_std(X_train)
+        X_train -= X_mean
+        X_train /= X_std
+        X_val -= X_mean
+        X_val /= X_std
+    X_train_mean, X_train_std = chunked_mean_std(X_train)
+    print "Augmented mean: ({0:.3f}, ...); std: ({1:.3f}, ...)\n\n".format(X_train_mean[0],
+                                                                           X_train_std[0])
 
     # train 26 small Gaussian RBMs on patches
     small_rbms = None
@@ -640,13 +620,13 @@ def main():
 
     # extract features Q = p_{G-RBM}(h|v=X)
     print "\nExtracting features from G-RBM ...\n\n"
+    transform_cache = TransformCache(os.path.join(args.data_path, 'transform_cache_cifar/'),
+                                     max_bytes=int(args.transform_cache_size * 2 ** 30))
     Q_train, Q_val = None, None
     if not os.path.isdir(args.mrbm_dirpath) or not os.path.isdir(args.dbm_dirpath):
-        Q_train_path = os.path.join(args.data_path, 'Q_train_cifar.npy')
-        Q_train = make_rbm_transform(grbm, X_train, Q_train_path, np_dtype=np.float16)
+        Q_train = make_rbm_transform(grbm, X_train, transform_cache, np_dtype=np.float16)
     if not os.path.isdir(args.mrbm_dirpath):
-        Q_val_path = os.path.join(args.data_path, 'Q_val_cifar.npy')
-        Q_val = make_rbm_transform(grbm, X_val, Q_val_path)
+        Q_val = make_rbm_transform(grbm, X_val, transform_cache)
 
     # pre-train Multinomial RBM (M-RBM)
     mrbm = make_mrbm((Q_train, Q_val), args)
@@ -656,8 +636,7 @@ def main():
     Q, G = None, None
     if not os.path.isdir(args.dbm_dirpath):
         Q = Q_train[:args.n_particles]
-        G_path = os.path.join(args.data_path, 'G_train_cifar.npy')
-        G = make_rbm_transform(mrbm, Q, G_path)
+        G = make_rbm_transform(mrbm, Q, transform_cache)
 
     # jointly train DBM
     dbm = make_dbm((X_train, X_val), (grbm, mrbm), (Q, G), args)
@@ -36,7 +36,7 @@ from sklearn.metrics import accuracy_score
 import env
 from boltzmann_machines import DBM
 from boltzmann_machines.rbm import GaussianRBM, MultinomialRBM
-from boltzmann_machines.utils import (RNG, Stopwatch,
+from boltzmann_machines.utils import (RNG, Stopwatch, TransformCache,
                                       one_hot, one_hot_decision_function, unhot)
 from boltzmann_machines.utils.dataset import load_cifar10
 from boltzmann_machines.utils.optimizers import MultiAdam
@@ -155,17 +155,10 @@ def make_mrbm((Q_train, Q_val), args):
         mrbm.fit(Q_train, Q_val)
     return mrbm
 
-def make_rbm_transform(rbm, X, path, np_dtype=None):
-    H = None
-    transform = True
-    if os.path.isfile(path):
-        H = np.load(path)
-        if len(X) == len(H):
-            transform = False
-    if transform:
-        H = rbm.transform(X, np_dtype=np_dtype)
-        np.save(path, H)
-    return H
+def make_rbm_transform(rbm, X, cache, np_dtype=None):
+    # (recomputed only if the model or the data have changed)
+    rbm.set_transform_cache(cache)
+    return rbm.transform(X, np_dtype=np_dtype)
 
 def make_dbm((X_train, X_val), rbms, (Q, G), args):
     if os.path.isdir(args.dbm_dirpath):
@@ -271,6 +264,8 @@ def main():
                         help='number of validation examples')
     parser.add_argument('--data-path', type=str, default='../data/', metavar='PATH',
                         help='directory for storing augmented data etc.')
+    parser.add_argument('--transform-cache-size', type=float, default=16., metavar='GB',
+                        help='max size of the cache of extracted features (in GiB)')
 
     # common for RBMs and DBM
     parser.add_argument('--n-gibbs-steps', type=int, default=(1, 1, 1), metavar='N', nargs='+',
@@ -378,13 +373,13 @@ def main():
 
     # extract features Q = p_{G-RBM}(h|v=X)
     print "\nExtracting features from G-RBM ...\n\n"
+    transform_cache = TransformCache(os.path.join(args.data_path, 'transform_cache_cifar_naive/'),
+                                     max_bytes=int(args.transform_cache_size * 2 ** 30))
     Q_train, Q_val = None, None
     if not os.path.isdir(args.mrbm_dirpath) or not os.path.isdir(args.dbm_dirpath):
-        Q_train_path = os.path.join(args.data_path, 'Q_train_cifar_naive.npy')
-        Q_train = make_rbm_transform(grbm, X_train, Q_train_path)
+        Q_train = make_rbm_transform(grbm, X_train, transform_cache)
     if not os.path.isdir(args.mrbm_dirpath):
-        Q_val_path = os.path.join(args.data_path, 'Q_val_cifar_naive.npy')
-        Q_val = make_rbm_transform(grbm, X_val, Q_val_path)
+        Q_val = make_rbm_transform(grbm, X_val, transform_cache)
 
     # pre-train Multinomial RBM (M-RBM)
     mrbm = make_mrbm((Q_train, Q_val), args)
@@ -394,8 +389,7 @@ def main():
     Q, G = None, None
     if not os.path.isdir(args.dbm_dirpath):
         Q = Q_train[:args.n_particles]
-        G_path = os.path.join(args.data_path, 'G_train_cifar_naive.npy')
-        G = make_rbm_transform(mrbm, Q, G_path)
+        G = make_rbm_transform(mrbm, Q, transform_cache)
 
     # jointly train DBM
     dbm = make_dbm((X_train, X_val), (grbm, mrbm), (Q, G), args)